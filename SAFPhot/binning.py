@@ -0,0 +1,73 @@
+'''
+Time binning of light curves for SAFPhot.
+
+Points are grouped into windows of a fixed length in time, counted from the
+first point, so runs with several exposure times or gaps are binned
+correctly without splitting them into blocks. Every column of a light curve
+is binned in the same call with segment sums (np.add.reduceat) over the
+points sorted by window, which is linear in the number of points. Missing
+points are left out of the sums, means may be weighted, and errors are
+propagated through the weighted mean.
+
+'''
+
+import numpy as np
+
+def bin_series(t, columns, width, mask=None, weights=None, errors=None):
+    '''Bin columns of shape [columns, points] (or a single column) of a
+    series at times t (days) into windows of width seconds. Points outside
+    mask, or not finite, are ignored. Returns the weighted mean of each
+    column in each window holding any points, the number of points used,
+    and the propagated errors if errors are given. Windows without usable
+    points of a column are NaN.'''
+
+    t = np.asarray(t, dtype=float)
+    columns = np.atleast_2d(np.asarray(columns, dtype=float))
+    ncol = columns.shape[0]
+
+    #Points used for each column
+    use = np.isfinite(columns) & np.isfinite(t)
+    if mask is not None:
+        use &= np.asarray(mask, dtype=bool)
+    if weights is None:
+        weights = np.ones(columns.shape)
+    weights = np.broadcast_to(weights, columns.shape)
+    use &= np.isfinite(weights)
+    if errors is not None:
+        errors = np.broadcast_to(np.asarray(errors, dtype=float),
+                columns.shape)
+        use &= np.isfinite(errors)
+
+    #Window of each point, allowing 1 ms for rounding of the times in days,
+    #sorted so each window is one segment
+    good_t = np.isfinite(t)
+    window = np.zeros(t.shape, dtype=np.int64)
+    window[good_t] = np.floor(((t[good_t] - np.min(t[good_t])) * 86400. +
+        1e-3) / width).astype(np.int64)
+    order = np.argsort(np.where(good_t, window, np.iinfo(np.int64).max),
+            kind='stable')[:np.sum(good_t)]
+    if len(order) == 0:
+        empty = np.empty((ncol, 0))
+        return (empty, empty) if errors is None else (empty, empty, empty)
+    window = window[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(window)) + 1])
+    use = use[:, order]
+
+    #Segment sums of the weights and weighted values
+    w = np.where(use, weights[:, order], 0.)
+    sum_w = np.add.reduceat(w, starts, axis=1)
+    sum_wx = np.add.reduceat(np.where(use, w * columns[:, order], 0.),
+            starts, axis=1)
+    counts = np.add.reduceat(use.astype(int), starts, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = np.where(counts > 0, sum_wx / sum_w, np.nan)
+        if errors is None:
+            return binned, counts
+
+        #Error of the weighted mean
+        sum_we2 = np.add.reduceat(np.where(use, np.square(w *
+            errors[:, order]), 0.), starts, axis=1)
+        binned_err = np.where(counts > 0, np.sqrt(sum_we2) / sum_w, np.nan)
+
+    return binned, counts, binned_err
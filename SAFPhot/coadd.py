@@ -0,0 +1,116 @@
+'''
+Temporal co-adding of frames for SAFPhot.
+
+Short exposure runs contain many more frames than are needed once the light
+curves are binned. Consecutive frames are grouped, either a fixed number at a
+time or all frames within a time window, aligned to the first frame of their
+group using the measured frame shifts and summed, so that photometry is only
+done once per group. The co-added frame is given the mid-time of the whole
+group and the summed exposure time.
+
+'''
+
+import numpy as np
+
+def coadd_groups(nframes, num=1, jd=None, exp=None, window=None):
+    '''Split frames into groups of consecutive frames to co-add. Groups hold
+    num frames, or if window (seconds) is given all frames which lie within
+    the window from the start of the first frame of the group, using their
+    mid-exposure times (days) and exposure times (seconds).'''
+
+    if window is None:
+        return [list(range(k, min(k + num, nframes))) for k in
+                range(0, nframes, num)]
+
+    #Start and end times of each frame
+    start = np.asarray(jd) - 0.5 * np.asarray(exp) / 86400.
+    end = np.asarray(jd) + 0.5 * np.asarray(exp) / 86400.
+
+    #Allow 1 ms for rounding of the times in days
+    groups = []
+    for k in range(nframes):
+        if groups and (end[k] - start[groups[-1][0]] <= (window + 1e-3) /
+                86400.):
+            groups[-1].append(k)
+        else:
+            groups.append([k])
+    return groups
+
+def shift_add(acc, cover, data, dx, dy):
+    '''Add a frame onto the accumulated frame, moved by an integer number of
+    pixels, and count the frames covering each pixel.'''
+
+    ny, nx = data.shape
+
+    #Overlapping region of the frame and the accumulator
+    ya, yb = max(dy, 0), min(ny + dy, ny)
+    xa, xb = max(dx, 0), min(nx + dx, nx)
+    if (ya >= yb) or (xa >= xb):
+        return
+
+    acc[ya:yb, xa:xb] += data[ya-dy:yb-dy, xa-dx:xb-dx]
+    cover[ya:yb, xa:xb] += 1
+
+class CoAdd(object):
+    '''Accumulator for one group of frames. Frames are added with their shift
+    with respect to the reference frame, using the Donuts sign convention,
+    and their times.'''
+
+    def __init__(self, size):
+
+        self.size = size
+        self.n = 0
+
+    def add(self, data, shift_x, shift_y, exp, jd, hjd, bjd, airmass):
+
+        #A frame which is not co-added is passed on untouched
+        if self.size == 1:
+            self.data = data
+            self.shift = (shift_x, shift_y)
+            self.times = (exp, jd, hjd, bjd, airmass)
+            self.n = 1
+            return
+
+        if self.n == 0:
+            self.acc = np.zeros(data.shape)
+            self.cover = np.zeros(data.shape)
+            self.ref_shift = (shift_x, shift_y)
+            self.resid = []
+            self.values = []
+
+        #Move the frame onto the first frame of the group
+        dx = shift_x - self.ref_shift[0]
+        dy = shift_y - self.ref_shift[1]
+        shift_add(self.acc, self.cover, data, int(round(dx)),
+                int(round(dy)))
+        self.resid.append((dx - round(dx), dy - round(dy)))
+        self.values.append((exp, jd, hjd, bjd, airmass))
+        self.n += 1
+
+    def complete(self):
+        return self.n == self.size
+
+    def result(self):
+        '''Return the co-added frame, its shift with respect to the reference
+        frame and its exposure time, mid-time and airmass as a tuple of
+        (exp, jd, hjd, bjd, airmass).'''
+
+        if self.size == 1:
+            return self.data, self.shift, self.times
+
+        #Scale edge pixels not covered by every frame to the full group
+        data = np.where(self.cover > 0, self.acc * self.n /
+                np.maximum(self.cover, 1), 0.)
+
+        #Sub-pixel part of the alignment left over on average
+        resid = np.mean(self.resid, axis=0)
+        shift = (self.ref_shift[0] + resid[0], self.ref_shift[1] + resid[1])
+
+        #Summed exposure and mid-time of the whole group
+        exp, jd, hjd, bjd, airmass = [np.array(v) for v in
+                zip(*self.values)]
+        mid = 0.5 * (np.min(jd - 0.5*exp/86400.) + np.max(jd + 0.5*exp/86400.))
+        times = (np.sum(exp), mid, np.interp(mid, jd, hjd),
+                np.interp(mid, jd, bjd), np.mean(airmass))
+
+        return data, shift, times
@@ -0,0 +1,127 @@
+'''
+Automatic choice of comparison objects for SAFPhot.
+
+The light curves of every catalogue object are read for one aperture and bkg
+param combination, normalised by their median and compared in a single pass
+through the covariance matrix of their logarithms, which gives the pairwise
+correlation and scatter of all objects at once. Objects which scatter
+strongly against all others, such as variables, are left out and the
+ensemble is then grown greedily, adding at each step the object which most
+lowers the out of transit scatter of the target relative to the weighted
+ensemble. The scatter for every candidate is found from the covariance
+matrix without forming any light curves, so the choice stays fast for
+hundreds of objects.
+
+'''
+
+import numpy as np
+
+def best_aperture(f, target, b):
+    '''Aperture with the highest S/N of the target for bkg params b, from
+    the flux statistics of the photometry file f if present.'''
+
+    if 'OBJ_FLUX_STATS' in f:
+        count, mean, std = f['OBJ_FLUX_STATS'][:, :, target, b]
+    else:
+        flux = f['OBJ_FLUX'][:, target, b]
+        flux[flux == 0] = np.nan
+        mean = np.nanmean(flux, axis=-1)
+        std = np.nanstd(flux, axis=-1, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = mean / std
+    return int(np.nanargmax(snr))
+
+def pair_matrices(cov):
+    '''Pairwise correlation and scatter (standard deviation of the ratio of
+    two normalised light curves) from the covariance matrix cov of the log
+    light curves.'''
+
+    var = np.diag(cov)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.sqrt(np.outer(var, var))
+    scatter = np.sqrt(np.maximum(var[:, None] + var[None, :] - 2 * cov, 0))
+    return corr, scatter
+
+def greedy_ensemble(cov, w, ncomp):
+    '''Greedy choice of up to ncomp comparisons minimising the variance of
+    the target relative to their weighted mean. cov is the covariance
+    matrix of the log light curves with the target first and the candidates
+    after it, w the weights of the candidates. Returns candidate indices.'''
+
+    var_t, cov_t, cov_c = cov[0, 0], cov[0, 1:], cov[1:, 1:]
+    var_c = np.diag(cov_c)
+    free = np.isfinite(w) & (w > 0)
+    chosen = []
+
+    #Sums over the chosen comparisons of the weights, weighted covariance
+    #with the target, weighted covariance with each other and weighted
+    #covariance with each candidate
+    W, a, Q = 0., 0., 0.
+    B = np.zeros(len(w))
+    best = np.inf
+    while (len(chosen) < ncomp) and np.any(free):
+
+        #Relative variance of the target if each candidate were added
+        Wn = W + w
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = var_t - 2 * (a + w * cov_t) / Wn + (Q + 2 * w * B +
+                    np.square(w) * var_c) / np.square(Wn)
+        var[~free] = np.inf
+        c = int(np.argmin(var))
+        if not var[c] < best: break
+
+        best = var[c]
+        chosen.append(c)
+        free[c] = False
+        Q += 2 * w[c] * B[c] + np.square(w[c]) * var_c[c]
+        W += w[c]
+        a += w[c] * cov_t[c]
+        B += w[c] * cov_c[c]
+
+    return chosen
+
+def select_comparisons(f, target, b, norm_mask, ncomp, min_frac=0.9,
+        clip=3.0):
+    '''Choose up to ncomp comparison objects for object index target from
+    the photometry file f, using bkg params b and the frames in norm_mask.
+    Objects measured on less than min_frac of these frames, or whose median
+    scatter against the others is over clip times the typical value, are
+    not considered. Returns the object indices chosen.'''
+
+    a = best_aperture(f, target, b)
+    flux = np.asarray(f['OBJ_FLUX'][a, :, b], dtype=float)
+    fluxerr = np.asarray(f['OBJ_FLUX_ERR'][a, :, b], dtype=float)
+    flux[~(flux > 0)] = np.nan
+    frames = np.asarray(norm_mask, dtype=bool) & np.isfinite(flux[target])
+    flux, fluxerr = flux[:, frames], fluxerr[:, frames]
+
+    #Candidates measured on most frames
+    good = np.mean(np.isfinite(flux), axis=1) >= min_frac
+    good[target] = False
+    cand = np.where(good)[0]
+    if len(cand) == 0:
+        return []
+
+    #Log light curves normalised by their median, missing frames being set
+    #to the median, and their covariance in one pass
+    lc = np.log(flux[np.append(target, cand)])
+    lc -= np.nanmedian(lc, axis=1, keepdims=True)
+    lc[~np.isfinite(lc)] = 0.
+    cov = np.cov(lc)
+
+    #Leave out candidates with high scatter against the other candidates
+    scatter = pair_matrices(cov[1:, 1:])[1]
+    np.fill_diagonal(scatter, np.nan)
+    typical = np.nanmedian(scatter, axis=1)
+    keep = ~(typical > clip * np.nanmedian(typical)) if len(cand) > 2 else \
+            np.ones(len(cand), dtype=bool)
+    cand = cand[keep]
+    cov = cov[np.ix_(np.append(True, keep), np.append(True, keep))]
+
+    #Weights as in the comparison ensemble, the mean squared S/N, times the
+    #median flux as the ensemble is a weighted sum of fluxes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.nanmean(np.square(flux[cand] / fluxerr[cand]), axis=1) * \
+                np.nanmedian(flux[cand], axis=1)
+
+    return [int(c) for c in cand[greedy_ensemble(cov, w, ncomp)]]
@@ -0,0 +1,84 @@
+'''
+Systematics detrending of light curves for SAFPhot.
+
+The light curves of every aperture and bkg param combination are fitted by
+linear least squares with a design matrix of a polynomial in time and
+systematics indicators such as the airmass, FWHM, CCD position and
+background flux, using the out of transit frames only, and divided by the
+fitted model. The design matrix only changes with the bkg params, through
+the FWHM and background flux, so its pseudo-inverse is found once for each
+bkg param combination and set of usable frames. All light curves sharing
+them, across apertures and across the ensemble and single comparisons, are
+then fitted with one matrix product.
+
+'''
+
+import numpy as np
+
+def standardise(x):
+    #Regressor scaled to zero mean and unit standard deviation over the
+    #frames (last axis), constant regressors being left at zero
+    x = np.asarray(x, dtype=float)
+    with np.errstate(invalid='ignore'):
+        std = np.nanstd(x, axis=-1, keepdims=True)
+    std[~(std > 0)] = 1.
+    return (x - np.nanmean(x, axis=-1, keepdims=True)) / std
+
+class Detrender(object):
+    '''Least squares detrending of light curves of shape [apertures, bkg
+    params, frames] at frame times t. The regressors have shape [frames] or
+    [bkg params, frames] and only frames in fit_mask are fitted.'''
+
+    def __init__(self, t, regressors=(), fit_mask=None, order=2):
+
+        t = standardise(t)
+        self.fit_mask = (np.ones(t.shape, dtype=bool) if fit_mask is None
+                else np.asarray(fit_mask, dtype=bool))
+        self.columns = [np.power(t, k) for k in range(order + 1)] + [
+                standardise(r) for r in regressors]
+        self._design = {}
+        self._pinv = {}
+
+    def design(self, b):
+        #Design matrix [frames, coefficients] of bkg params b
+        if b not in self._design:
+            self._design[b] = np.stack([c if c.ndim == 1 else c[b] for c in
+                self.columns], axis=-1)
+        return self._design[b]
+
+    def _solver(self, b, rows):
+        #Pseudo-inverse of the design matrix over the frames rows, found once
+        #for each bkg params and set of frames
+        key = (b, rows.tobytes())
+        if key not in self._pinv:
+            self._pinv[key] = np.linalg.pinv(self.design(b)[rows])
+        return self._pinv[key]
+
+    def model(self, flux):
+        '''Fitted systematics model of each light curve of flux, NaN for
+        light curves with too few frames to fit and for frames where a
+        regressor is missing.'''
+
+        model = np.full(flux.shape, np.nan)
+        for b in range(flux.shape[1]):
+            X = self.design(b)
+            usable = self.fit_mask & np.all(np.isfinite(X), axis=1)
+
+            #Group the apertures by the frames they can be fitted on
+            finite = np.isfinite(flux[:, b]) & usable
+            patterns, group = np.unique(finite, axis=0, return_inverse=True)
+            group = group.ravel()
+            for g, rows in enumerate(patterns):
+                if np.sum(rows) <= X.shape[1]: continue
+                a = np.where(group == g)[0]
+                coef = np.dot(self._solver(b, rows), flux[a, b][:, rows].T)
+                model[a, b] = np.dot(X, coef).T
+
+        return model
+
+    def apply(self, flux, flux_err):
+        '''Detrended flux and error, divided by the fitted model.'''
+
+        model = self.model(flux)
+        return ((flux / model).astype(flux.dtype),
+                (flux_err / model).astype(flux_err.dtype))
@@ -0,0 +1,146 @@
+'''
+Comparison ensembles for differential photometry in SAFPhot.
+
+The ensemble comparison flux is the average of the comparison objects,
+weighted by the mean squared S/N of each object, and its error combines the
+comparison errors in inverse quadrature. Both only depend on sums over the
+comparison objects, so the sums are formed once and the comparison for a
+single object or for the ensemble leaving one object out is found by
+subtracting that object's terms, for all apertures and bkg params at once.
+
+Memory is bounded for long runs. The comparison fluxes are kept once as
+float32, the weights are broadcast over the frames rather than repeated,
+and all work is done a chunk of apertures at a time so that temporary
+arrays hold at most CHUNK_SIZE values. The flux arrays may also be lazily
+read HDUs, in which case only the comparison rows are read, a chunk at a
+time. The sums are kept in double precision so that removing one object
+from them does not lose accuracy.
+
+'''
+
+import numpy as np
+
+#Number of values processed at a time, bounding the temporary arrays
+CHUNK_SIZE = 2**22
+
+def chunks(shape, size=CHUNK_SIZE):
+    #Slices along the first axis holding at most size values each
+    step = max(1, size // max(int(np.prod(shape[1:])), 1))
+    return [slice(k, min(k + step, shape[0])) for k in range(0, shape[0],
+        step)]
+
+def object_flux(flux, fluxerr, index, dtype=np.float32):
+    '''Flux and error of object index from arrays of shape [apertures,
+    objects, bkg params, frames], with zeros (unmeasured) set to NaN.'''
+
+    obj_flux = np.array(flux[:, index], dtype=dtype)
+    obj_flux_err = np.array(fluxerr[:, index], dtype=dtype)
+    obj_flux[obj_flux == 0] = np.nan
+    obj_flux_err[obj_flux_err == 0] = np.nan
+    return obj_flux, obj_flux_err
+
+def relative_flux(obj_flux, obj_flux_err, comp_flux, comp_flux_err,
+        norm_mask=None, dtype=np.float32):
+    '''Differential flux and error of an object, normalised by the median
+    over the frames (last axis) in norm_mask.'''
+
+    #If no norm_mask, use all frames
+    if norm_mask is None:
+        norm_mask = np.ones(obj_flux.shape[-1], dtype=bool)
+
+    diff_flux = np.empty(obj_flux.shape, dtype=dtype)
+    diff_flux_err = np.empty(obj_flux.shape, dtype=dtype)
+    for s in (chunks(obj_flux.shape) if obj_flux.ndim > 1 else [Ellipsis]):
+        d, de = diff_flux[s], diff_flux_err[s]
+
+        #Relative errors added in quadrature, in place
+        np.divide(obj_flux[s], comp_flux[s], out=d)
+        np.divide(obj_flux_err[s], obj_flux[s], out=de)
+        np.square(de, out=de)
+        de += np.square(comp_flux_err[s] / comp_flux[s])
+        np.sqrt(de, out=de)
+        de *= d
+
+        diff_norm = np.nanmedian(d[..., norm_mask], axis=-1, keepdims=True)
+        d /= diff_norm
+        de /= diff_norm
+
+    return diff_flux, diff_flux_err
+
+class CompEnsemble(object):
+    '''Weighted sums over the comparison objects comp_index of flux arrays
+    of shape [apertures, objects, bkg params, frames].'''
+
+    def __init__(self, flux, fluxerr, comp_index, dtype=np.float32):
+
+        self.comp_index = list(comp_index)
+        na, nb, nf = flux.shape[0], flux.shape[2], flux.shape[3]
+        shape = (na, len(self.comp_index), nb, nf)
+
+        #Comparison flux and error and the weight of each comparison, its
+        #mean squared S/N over the frames
+        self.flux = np.empty(shape, dtype=dtype)
+        self.flux_err = np.empty(shape, dtype=dtype)
+        self.weights = np.empty(shape[:3] + (1,), dtype=dtype)
+
+        #Sums over the comparisons of weight, weighted flux, inverse
+        #variance and number of comparisons, frames where either flux or
+        #error is missing being left out
+        self.sums = [np.zeros((na, nb, nf)) for n in range(3)] + [
+                np.zeros((na, nb, nf), dtype=np.int32)]
+
+        for s in chunks(shape):
+            f, e = self.flux[s], self.flux_err[s]
+            f[...] = flux[s, self.comp_index]
+            e[...] = fluxerr[s, self.comp_index]
+            f[f == 0] = np.nan
+            e[e == 0] = np.nan
+            self.weights[s] = np.nanmean(np.square(f / e), axis=-1,
+                    keepdims=True)
+            for total, term in zip(self.sums, self._terms(s, slice(None))):
+                total[s] += np.sum(term, axis=1)
+
+    def _terms(self, s, k):
+        #Terms of the comparisons k for the apertures s
+        f, e = self.flux[s, k], self.flux_err[s, k]
+        valid = np.isfinite(f) & np.isfinite(e)
+        w = self.weights[s, k]
+        return (np.where(valid, w, 0.), np.where(valid, w * f, 0.),
+                np.where(valid, 1.0 / np.square(e), 0.), valid)
+
+    def _combine(self, remove=None):
+        #Comparison flux and error from the sums, less the terms of the
+        #comparison remove, NaN without comparisons
+        comp_flux = np.empty(self.sums[0].shape, dtype=self.flux.dtype)
+        comp_flux_err = np.empty(self.sums[0].shape, dtype=self.flux.dtype)
+        for s in chunks(self.flux.shape):
+            w, wf, iv, n = [total[s] for total in self.sums]
+            if remove is not None:
+                w, wf, iv, n = [total - term for total, term in zip(
+                    (w, wf, iv, n), self._terms(s, remove))]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                comp_flux[s] = np.where(n > 0, wf / w, np.nan)
+                comp_flux_err[s] = np.where(n > 0, np.sqrt(1.0 / iv),
+                        np.nan)
+        return comp_flux, comp_flux_err
+
+    def ensemble(self):
+        #Comparison flux and error of the whole ensemble
+        return self._combine()
+
+    def raw(self, obj):
+        #Flux and error of comparison object obj as read, for use as the
+        #object of a differential light curve
+        k = self.comp_index.index(obj)
+        return self.flux[:, k], self.flux_err[:, k]
+
+    def single(self, obj):
+        #Flux and error of comparison object obj alone
+        k = self.comp_index.index(obj)
+        valid = np.isfinite(self.flux[:, k]) & np.isfinite(self.flux_err[:, k])
+        return (np.where(valid, self.flux[:, k], np.nan),
+                np.where(valid, self.flux_err[:, k], np.nan))
+
+    def others(self, obj):
+        #Comparison flux and error of the ensemble without object obj
+        return self._combine(self.comp_index.index(obj))
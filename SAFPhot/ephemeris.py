@@ -0,0 +1,174 @@
+'''
+Interpolated time corrections and airmass for SAFPhot.
+
+The heliocentric and barycentric corrections and the airmass of a fixed
+target change smoothly over a night, so evaluating them with astropy for
+every frame is wasted effort. The Ephemeris class evaluates them exactly on
+a coarse grid of times, aligned to multiples of the grid step, and
+interpolates between grid points with a 4 point (cubic) Lagrange polynomial.
+
+The interpolation error is bounded by 3/128 h^4 times the largest fourth
+derivative. The fastest varying term is the diurnal part of the light travel
+time, with an amplitude of about 21 ms (Earth radius / c), which for the
+default 5 minute step gives an error far below 1 ns and the precision of a
+JD stored as a double. Airmass is the fastest varying term at high airmass,
+and with the default step it is interpolated to better than 2e-5 below an
+airmass of 3, within the 1e-4 bound, while a 10 minute step exceeds the
+bound above an airmass of about 2.5. The error is checked against exact values at the middle of
+new grid intervals and a warning printed if it exceeds these bounds.
+
+Grid points are cached on disk per target and site, so later runs on the same
+field only evaluate grid points they have not seen before.
+
+'''
+
+import hashlib
+import numpy as np
+
+from os.path import join, exists, dirname
+from os import makedirs, rename
+from astropy.time import Time
+from astropy import coordinates as coord, units as u
+
+#Accuracy bounds for the corrections (s) and the airmass
+TIME_TOL = 1e-6
+AIRMASS_TOL = 1e-4
+
+def lagrange4(t, v):
+    '''Cubic interpolation at fractional position t between the second and
+    third of four equally spaced values v, stacked along the first axis.'''
+
+    w = [-t*(t - 1)*(t - 2)/6., (t + 1)*(t - 1)*(t - 2)/2.,
+            -(t + 1)*t*(t - 2)/2., (t + 1)*t*(t - 1)/6.]
+    return sum(w[k][:, None] * v[k] for k in range(4))
+
+class Ephemeris(object):
+    '''HJD, BJD and airmass of a target observed from a site, interpolated
+    from exact values on a grid with a step in seconds.'''
+
+    def __init__(self, ra, dec, loc, step=300., cache_dir=None):
+
+        self.ra = ra.replace(" ", ":")
+        self.dec = dec.replace(" ", ":")
+        self.loc = loc
+        self.step = step / 86400.
+
+        #Target coordinates, made once
+        self.coords = coord.SkyCoord(self.ra, self.dec,
+                unit=(u.hourangle, u.deg), frame='icrs')
+
+        #Grid point numbers and values of the HJD and BJD corrections (s)
+        #and the airmass
+        self.nodes = np.array([], dtype=np.int64)
+        self.values = np.empty((0, 3))
+
+        #Load the grid points cached for this target and site
+        self.cache = None
+        if cache_dir is not None:
+            lon, lat, alt = loc.geodetic[:3]
+            key = "%s %s %.6f %.6f %.1f %.3f" % (self.ra, self.dec,
+                    lon.to(u.deg).value, lat.to(u.deg).value,
+                    alt.to(u.m).value, step)
+            self.cache = join(cache_dir, "ephem_%s.npz" %
+                    hashlib.md5(key.encode()).hexdigest()[:16])
+            if exists(self.cache):
+                with np.load(self.cache) as f:
+                    self.nodes = f['nodes']
+                    self.values = f['values']
+
+    def exact(self, jd):
+        '''Exact HJD and BJD corrections (s) and airmass at times jd (UTC),
+        with shape [times, 3].'''
+
+        times = Time(jd, format='jd', scale='utc', location=self.loc)
+
+        #Light travel times to the Sun and the barycentre
+        ltt_helio = times.light_travel_time(self.coords, 'heliocentric')
+        ltt_bary = times.light_travel_time(self.coords)
+
+        #BJD is also on the TDB time scale
+        tdb = times.tdb
+        tdb_utc = ((tdb.jd1 - times.jd1) + (tdb.jd2 - times.jd2)) * 86400.
+
+        #Airmass from the altitude of the target
+        altaz = self.coords.transform_to(coord.AltAz(obstime=times,
+            location=self.loc))
+
+        return np.column_stack([ltt_helio.to(u.s).value,
+            tdb_utc + ltt_bary.to(u.s).value, altaz.secz.value])
+
+    def _update(self, needed):
+        #Evaluate grid points which are not known yet
+        new = np.setdiff1d(needed, self.nodes)
+        if len(new) == 0:
+            return
+
+        values = self.exact(new * self.step)
+        nodes = np.concatenate([self.nodes, new])
+        srt = np.argsort(nodes)
+        self.nodes = nodes[srt]
+        self.values = np.concatenate([self.values, values])[srt]
+
+        #Check the interpolation at the middle of a few new intervals,
+        #ignoring the airmass of a target close to or below the horizon
+        mids = new[np.linspace(0, len(new)-1, min(3, len(new))).astype(int)]
+        mids = (mids[np.isin(mids - 1, self.nodes) & np.isin(mids + 1,
+            self.nodes) & np.isin(mids + 2, self.nodes)] + 0.5) * self.step
+        if len(mids):
+            exact = self.exact(mids)
+            error = np.abs(self.interpolate(mids) - exact)
+            error[(exact[:, 2] < 1) | (exact[:, 2] > 3), 2] = 0
+            if (np.max(error[:, :2]) > TIME_TOL) or (np.max(error[:, 2]) >
+                    AIRMASS_TOL):
+                print("Warning: ephemeris interpolation error %.2g s, %.2g "
+                        "airmass, use a shorter step." % (
+                            np.max(error[:, :2]), np.max(error[:, 2])))
+
+        #Keep the grid points for later runs
+        if self.cache is not None:
+            cache_dir = dirname(self.cache)
+            if not exists(cache_dir): makedirs(cache_dir)
+            with open(self.cache + '.tmp', 'wb') as f:
+                np.savez(f, nodes=self.nodes, values=self.values)
+            rename(self.cache + '.tmp', self.cache)
+
+    def interpolate(self, jd):
+        '''Interpolated HJD and BJD corrections (s) and airmass at times jd
+        (UTC), with shape [times, 3]. The grid points must be known.'''
+
+        pos = np.asarray(jd, dtype=float) / self.step
+        k = np.floor(pos).astype(np.int64)
+
+        #The four grid points around each time are consecutive
+        i = np.searchsorted(self.nodes, k - 1)
+        v = np.array([self.values[i + n] for n in range(4)])
+        return lagrange4(pos - k, v)
+
+    def evaluate(self, jd):
+        '''HJD, BJD and airmass at times jd (UTC), for a single time or an
+        array of times.'''
+
+        jd_ = np.atleast_1d(np.asarray(jd, dtype=float))
+
+        #Make sure the four grid points around each time are known
+        k = np.unique(np.floor(jd_ / self.step).astype(np.int64))
+        self._update(np.unique(np.concatenate([k + n for n in
+            (-1, 0, 1, 2)])))
+
+        values = self.interpolate(jd_)
+        hjd = jd_ + values[:, 0] / 86400.
+        bjd = jd_ + values[:, 1] / 86400.
+        airmass = values[:, 2]
+
+        if np.ndim(jd) == 0:
+            return hjd[0], bjd[0], airmass[0]
+        return hjd, bjd, airmass
+
+    def hjd(self, jd):
+        return self.evaluate(jd)[0]
+
+    def bjd(self, jd):
+        return self.evaluate(jd)[1]
+
+    def airmass(self, jd):
+        return self.evaluate(jd)[2]
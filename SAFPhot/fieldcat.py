@@ -0,0 +1,91 @@
+'''
+Persistent field catalogues for SAFPhot.
+
+The objects detected on the first frame of the first run on a field are saved
+as the reference catalogue of the field, with a stable ID for each object.
+Later runs on the same field match the brightest sources of their first frame
+to the catalogue and reuse its objects and IDs, so object numbers stay the
+same from night to night. The full source detection at the detection
+threshold is skipped, but the bright sources are still found with a quick
+detection over the whole frame at a higher threshold, as the offset of the
+field is not known beforehand.
+
+A run whose field does not match the catalogue, such as a run with another
+pointing, adds its objects to the catalogue as a new group with its own
+reference positions and new IDs. Later runs are matched to each group in
+turn, so their IDs are never reused for other objects.
+
+Matching allows for a translation of the field only. Each pairing of a
+detected and a catalogue source proposes an offset, and the offset which
+brings the most detected sources within a tolerance of a catalogue source,
+found with a KD-tree, is refined with the median offset of those matches.
+
+'''
+
+import fitsio
+import numpy as np
+
+from os.path import exists, dirname
+from os import makedirs
+from scipy.spatial import cKDTree
+
+#Columns of a field catalogue
+CAT_DTYPE = [('ID', 'i4'), ('X', 'f8'), ('Y', 'f8'), ('FLUX', 'f8'),
+        ('GROUP', 'i4')]
+
+def load_catalogue(path):
+    #Load a field catalogue as a table of ID, X, Y, FLUX and GROUP if it
+    #exists, catalogues saved before groups were added being one group
+    if not exists(path):
+        return None
+    data = fitsio.read(path, ext=1)
+    cat = np.zeros(len(data), dtype=CAT_DTYPE)
+    for name in data.dtype.names:
+        cat[name] = data[name]
+    return cat
+
+def save_catalogue(path, ids, x, y, flux, cat=None):
+    '''Save a field catalogue, positions being on the reference frame. If
+    an existing catalogue cat is given the objects are added to it as a new
+    group, with positions on their own reference frame.'''
+    if not exists(dirname(path)): makedirs(dirname(path))
+    new = np.zeros(len(ids), dtype=CAT_DTYPE)
+    new['ID'], new['X'], new['Y'], new['FLUX'] = ids, x, y, flux
+    if cat is not None:
+        new['GROUP'] = np.max(cat['GROUP']) + 1
+        new = np.concatenate([cat, new])
+    fitsio.write(path, new, extname='FIELD_CAT', clobber=True)
+
+def brightest(x, y, flux, nmax):
+    #Positions of the nmax brightest sources
+    keep = np.argsort(flux)[::-1][:nmax]
+    return np.column_stack([x[keep], y[keep]])
+
+def match_offset(det, ref, tol=2.0, min_match=4):
+    '''Find the offset (dx, dy) which moves the detected positions det onto
+    the reference positions ref, both arrays of shape [sources, 2]. Returns
+    None if fewer than min_match sources agree on an offset, and so always
+    if fewer than min_match sources are detected, as a few sources match
+    any field by chance.'''
+
+    if (len(det) < min_match) or (len(ref) == 0):
+        return None
+
+    tree = cKDTree(ref)
+
+    #Offset proposed by every pairing of a detected and a reference source
+    offsets = (ref[None, :, :] - det[:, None, :]).reshape(-1, 2)
+
+    #Count detected sources landing on a reference source for each offset
+    dist, index = tree.query((det[None, :, :] + offsets[:, None, :]).reshape(
+        -1, 2), distance_upper_bound=tol)
+    votes = np.sum((dist < tol).reshape(len(offsets), len(det)), axis=1)
+
+    best = np.argmax(votes)
+    if votes[best] < min_match:
+        return None
+
+    #Refine with the median offset of the matched sources
+    dist, index = tree.query(det + offsets[best], distance_upper_bound=tol)
+    matched = dist < tol
+    return np.median(ref[index[matched]] - det[matched], axis=0)
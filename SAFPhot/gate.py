@@ -0,0 +1,102 @@
+'''
+Frame quality gating for SAFPhot.
+
+Cloudy, trailed or saturated frames are only rejected by plot.py after the
+full photometry has been done on them. The FrameGate screens each frame
+cheaply before the background estimation and aperture photometry, using the
+sky level from a sparse sample of pixels and the flux and peak of a few bright
+reference objects in small windows, compared with the reference frame. Frames
+which fail are skipped and the reasons recorded as bit flags.
+
+'''
+
+import numpy as np
+
+#Bit flags recording why a frame was skipped
+GATE_SKY = 1
+GATE_FLUX = 2
+GATE_SATURATED = 4
+
+def window_stats(data, x, y, hw):
+    '''Flux above the window median and peak value in a (2*hw+1) pixel square
+    window around each (x, y), with nan for windows off the frame.'''
+
+    flux = np.full(len(x), np.nan)
+    peak = np.full(len(x), np.nan)
+
+    for k in range(len(x)):
+
+        if not (np.isfinite(x[k]) and np.isfinite(y[k])): continue
+
+        xa, ya = int(round(x[k])) - hw, int(round(y[k])) - hw
+        xb, yb = xa + 2*hw + 1, ya + 2*hw + 1
+        if (xa < 0) or (ya < 0) or (xb > data.shape[1]) or (yb > data.shape[0]):
+            continue
+
+        win = data[ya:yb, xa:xb]
+        flux[k] = np.sum(win - np.median(win))
+        peak[k] = np.max(win)
+
+    return flux, peak
+
+def sky_level(data, step=8):
+    #Cheap estimate of the sky level from a sparse sample of pixels
+    return np.median(data[::step, ::step])
+
+class FrameGate(object):
+    '''Pre-screen of frames against the reference frame ref with exposure
+    time exp. A check is switched off by setting its limit to None.'''
+
+    def __init__(self, ref, exp, x_ref, y_ref, nstars=5, hw=6, sky_max=3.0,
+            flux_min=0.5, saturation=None):
+
+        self.hw = hw
+        self.sky_max = sky_max
+        self.flux_min = flux_min
+        self.saturation = saturation
+
+        #Sky level per second on the reference frame
+        self.sky_ref = sky_level(ref) / exp
+
+        #Keep the brightest objects which are not saturated on the reference
+        flux, peak = window_stats(ref, x_ref, y_ref, hw)
+        usable = np.isfinite(flux) & (flux > 0)
+        if saturation is not None:
+            usable &= (peak < saturation)
+        usable = np.where(usable)[0]
+        keep = usable[np.argsort(flux[usable])[::-1][:nstars]]
+        self.x_ref = x_ref[keep]
+        self.y_ref = y_ref[keep]
+        self.flux_ref = flux[keep] / exp
+
+    def check(self, data, shift_x, shift_y, exp, nsum=1):
+        '''Return the flags of a frame with the given shift with respect to
+        the reference frame (Donuts convention) and exposure time. A co-added
+        frame of nsum frames is checked for saturation on average.'''
+
+        flags = 0
+
+        #Sky brighter than allowed, e.g. twilight or moonlit cloud
+        sky = sky_level(data) / exp
+        if (self.sky_max is not None) and (self.sky_ref > 0) and (
+                sky > self.sky_max * self.sky_ref):
+            flags |= GATE_SKY
+
+        if len(self.x_ref) == 0:
+            return flags
+
+        flux, peak = window_stats(data, self.x_ref - shift_x,
+                self.y_ref - shift_y, self.hw)
+
+        #Reference objects fainter than allowed, e.g. cloud or trailing
+        ratio = np.nanmedian(flux / exp / self.flux_ref) if np.any(
+                np.isfinite(flux)) else np.nan
+        if (self.flux_min is not None) and not (ratio >= self.flux_min):
+            flags |= GATE_FLUX
+
+        #Reference objects saturated
+        if (self.saturation is not None) and np.any(peak / nsum >=
+                self.saturation):
+            flags |= GATE_SATURATED
+
+        return flags
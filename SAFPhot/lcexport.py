@@ -0,0 +1,146 @@
+'''
+Columnar export of the light curves of a run for SAFPhot.
+
+All light curves of a target, against the comparison ensemble and each
+single comparison, are written to one file with a typed column per quantity
+and light curve, after the frame columns they share (times, CCD position,
+seeing, exposure time and airmass). The run information is kept as metadata
+along with the aperture radius and bkg params of each light curve.
+
+The file is a FITS binary table (LC_FORMAT = "table"), read with fitsio or
+astropy. FITS tables are stored row by row in big-endian byte order, so
+reading one column still steps through every row and converts its values.
+An Arrow IPC file (LC_FORMAT = "arrow"), written if pyarrow is installed,
+stores each column contiguously in native byte order, so its columns are
+read without copying from a memory map.
+
+'''
+
+import numpy as np
+import fitsio
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+#Columns shared by all light curves of a run and columns of each light curve
+FRAME_COLUMNS = ['JD_UTC', 'HJD_UTC', 'BJD_TDB', 'CCD_X', 'CCD_Y',
+        'SEEING_ARCSECONDS', 'EXPOSURE_TIME_SECONDS', 'AIRMASS']
+CURVE_COLUMNS = ['RELATIVE_FLUX', 'FLUX_ERROR', 'BACKGROUND_FLUX']
+
+#Metadata of each light curve rather than of the run
+CURVE_META = ['APPRADUS', 'BKGPARAM']
+
+#Header keywords describing the FITS table rather than the run
+TABLE_KEYS = ('XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'TFIELDS',
+        'TTYPE', 'TFORM', 'TDIM', 'EXTNAME')
+
+def curve_name(name):
+    #Column suffix of a light curve, the ensemble or a comparison number
+    return ('C%s' % name if isinstance(name, (int, np.integer)) else
+            str(name)).upper()
+
+def check_format(fmt):
+    #Fail before any plotting if light curves cannot be written in fmt
+    assert (fmt != "arrow") or (pa is not None), \
+            "pyarrow is required for LC_FORMAT = 'arrow'"
+
+def to_str(value):
+    #Metadata value as text
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+class LightCurveSet(object):
+    '''Light curves of one run, collected from the tables written by plot.py
+    and written to a single columnar file.'''
+
+    def __init__(self, table):
+
+        #Frame columns and run metadata from the first table
+        self.frame_columns = [(key, np.asarray(table[key])) for key in
+                FRAME_COLUMNS]
+        self.meta = [(key, value) for key, value in table.meta.items() if
+                key not in CURVE_META]
+        self.curves = []
+
+    def add(self, name, table):
+        #Add the light curve of table under name
+        self.curves.append((curve_name(name), [(key, np.asarray(table[key]))
+            for key in CURVE_COLUMNS], [table.meta.get(key) for key in
+                CURVE_META]))
+
+    def columns(self):
+        #All columns as (name, array) in order
+        columns = list(self.frame_columns)
+        for name, curve, meta in self.curves:
+            columns += [('%s_%s' % (key, name), data) for key, data in curve]
+        return columns
+
+    def write_fits(self, path):
+        '''Write a FITS file with the light curves in the LIGHTCURVES table
+        and the aperture radius and bkg params of each in CURVES.'''
+
+        columns = self.columns()
+        data = np.zeros(len(columns[0][1]), dtype=[(key, array.dtype) for
+            key, array in columns])
+        for key, array in columns:
+            data[key] = array
+        header = [{'name': key, 'value': to_str(value)} if isinstance(value,
+            bytes) else {'name': key, 'value': value} for key, value in
+            self.meta]
+        fitsio.write(path, data, extname='LIGHTCURVES', header=header,
+                clobber=True)
+
+        curves = np.zeros(len(self.curves), dtype=[('NAME', 'S16'),
+            ('APPRADUS', 'f8'), ('BKGPARAM', 'S16')])
+        for k, (name, curve, meta) in enumerate(self.curves):
+            curves[k] = (name, np.nan if meta[0] is None else meta[0],
+                    to_str(meta[1]))
+        fitsio.write(path, curves, extname='CURVES')
+
+    def write_arrow(self, path):
+        '''Write an Arrow IPC file with the light curves as columns and the
+        run and light curve information as schema metadata.'''
+
+        check_format("arrow")
+        meta = dict((key, to_str(value)) for key, value in self.meta)
+        for name, curve, (apprad, bkgparam) in self.curves:
+            meta['APPRADUS_%s' % name] = to_str(apprad)
+            meta['BKGPARAM_%s' % name] = to_str(bkgparam)
+        columns = self.columns()
+        table = pa.Table.from_arrays([pa.array(array) for key, array in
+            columns], names=[key for key, array in columns], metadata=meta)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    def write(self, path, fmt):
+        #Write in format fmt, "table" or "arrow"
+        if fmt == "arrow":
+            self.write_arrow(path)
+        else:
+            self.write_fits(path)
+
+def read_lightcurves(path):
+    '''Columns and metadata of a light curve file written by LightCurveSet.
+    Arrow files are memory mapped and their columns read without copying.'''
+
+    if path.endswith('.arrow'):
+        assert pa is not None, "pyarrow is required to read %s" % path
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        columns = dict((key, table.column(key).to_numpy()) for key in
+                table.column_names)
+        meta = dict((key.decode(), value.decode()) for key, value in
+                table.schema.metadata.items())
+        return columns, meta
+
+    with fitsio.FITS(path) as f:
+        data = f['LIGHTCURVES'].read()
+        header = f['LIGHTCURVES'].read_header()
+        meta = dict((key, header[key]) for key in header.keys() if not
+                key.startswith(TABLE_KEYS))
+        for name, apprad, bkgparam in f['CURVES'].read():
+            meta['APPRADUS_%s' % to_str(name).strip()] = apprad
+            meta['BKGPARAM_%s' % to_str(name).strip()] = to_str(
+                    bkgparam).strip()
+    return dict((key, data[key]) for key in data.dtype.names), meta
@@ -19,6 +19,37 @@ def get_params():
     params["SOURCE_THRESH"] = 7.0 # Source detection threshold
     params["BKG_APP_RAD"] = 4.0 # Aperture radius to measure background residuals
     params["NUM_BKG_APPS"] = 100 # Num apertures per frame to measure bkg residuals
+    params["PHOT_MODE"] = "full" # Measure on the [full] frame or on [stamp]s
+    params["STAMP_SIZE"] = 64 # Side length of postage stamps in stamp mode [pix]
+    params["BKG_SEARCH"] = "full" # Measure [full] bkg param grid or [adaptive] search
+    params["BKG_SEARCH_FRAMES"] = 10 # Num frames sampled with full grid (adaptive)
+    params["BKG_SEARCH_KEEP"] = 3 # Num best bkg params kept for other frames (adaptive)
+    params["BKG_SEARCH_RETEST"] = None # Fractional sky change to re-test grid, or None
+    params["TRACKER"] = "donuts" # Frame registration: [donuts] or [centroid] tracking
+    params["TRACKER_STARS"] = 8 # Num bright isolated objects tracked (centroid)
+    params["TRACKER_WINDOW"] = 6 # Half width of centroid window [pix] (centroid)
+    params["TRACKER_MAX_RESID"] = 0.5 # Max centroid scatter before Donuts fallback [pix]
+    params["COADD"] = 1 # Number of consecutive frames to co-add before photometry
+    params["COADD_WINDOW"] = None # Co-add all frames within this time window
+                                  # (s) instead of a fixed number [None, float]
+    params["PARAM_SETS"] = None # Extra parameter sets measured in the same pass,
+                                # e.g. {"wide":{"RADII":[6.0, 8.0]}}, each
+                                # written to <name>_phot_<label>.fits. Sets may
+                                # change RADII, SUBPIX, RMAX, BOX_SIZE,
+                                # FILTER_SIZE, SOURCE_THRESH, BKG_APP_RAD and
+                                # NUM_BKG_APPS.
+    params["CHECKPOINT_EVERY"] = 500 # Save a checkpoint to resume photometry from
+                                     # every this many frames [None, int]
+    params["REPHOT_OBJECTS"] = None # Object IDs re-measured in rephot mode, None
+                                    # for the target and comparison objects
+    params["REPHOT_TIME_RANGE"] = [None, None] # JD range re-measured in rephot
+                                               # mode as list [lower,upper]
+    params["FRAME_GATE"] = False # Skip frames failing the quality checks below
+    params["GATE_STARS"] = 5 # Num bright objects checked on each frame
+    params["GATE_WINDOW"] = 6 # Half width of the window around each object [pix]
+    params["GATE_SKY_MAX"] = 3.0 # Max sky level relative to reference frame [None, float]
+    params["GATE_FLUX_MIN"] = 0.5 # Min object flux relative to reference frame [None, float]
+    params["GATE_SATURATION"] = None # Peak counts of a saturated object [None, float]
 
     #HEADER KEYWORDS 
     '''Here you can either pass in the keyword name contained within the image
@@ -52,6 +83,7 @@ def get_params():
     params["AIRMASS"] = "AIRMASS" # Airmass during observation
     params["HJD"] = "HJD" # Heliocentric Julian Date
     params["BJD"] = "BJD" # Barycentric Julian Date
+    params["EPHEM_STEP"] = 300.0 # Grid step of interpolated HJD/BJD/airmass [s]
     params["LAT"] = -32.375823 # latitude of telescope in Earth geodetic co-ords
     params["LON"] = 20.810808 # longitude of telescope in Earth geodetic co-ords
     params["ALT"] = 1798.0 # Altitude of telescope [meters]
@@ -63,18 +95,43 @@ def get_params():
     params["PHOT_DIR"] = "photometry/" # sub-directory of input folder in which to store
                                     # photometric files
     params["CAL_DIR"] = "calframes/" # sub-directory in which to store calibration frames
+    params["EPHEM_DIR"] = "ephemeris/" # sub-directory in which to cache ephemerides
+    params["FIELD_CAT_DIR"] = None # directory of persistent field catalogues giving
+                                   # objects stable IDs between runs [None, str]
     params["PHOT_PREFIX"] = "SAAO_" # prefix to attach to the photometric output
     params["RED_PREFIX"] = "CAL_" # prefix to attach to reduction output 
+    params["FUSED"] = False # In [both] mode, reduce frames in memory for photometry
+    params["WRITE_REDUCED"] = False # Also write reduced frames when FUSED is True
+    params["PREFETCH_DEPTH"] = 4 # Num frames read ahead of processing, 0 to disable
+    params["PREFETCH_THREADS"] = 1 # Num reader threads used to read ahead, more
+                                   # than one needs a reentrant cfitsio build
+    params["PREFETCH_REUSE"] = True # Reuse frame buffers once processed
+    params["COMPRESS"] = None # Tile compress reduced and calibration frames:
+                              # [None, RICE, HCOMPRESS, GZIP]
+    params["COMPRESS_QLEVEL"] = 16.0 # Quantisation level for compressed float
+                                     # reduced frames
     params["BIASID"] = "BIAS" # keyword to id BIAS frames 
     params["FLATID"] = "FLAT" # keyword to id FLAT frames
 
     #PLOT PARAMETERS
     params["TARGET_OBJECT_NUM"] = 3         # target number from field image [int]
     params["COMPARISON_OBJECT_NUMS"] = [0,1,2,5] # comparison numbers as list [int,int,..]
+                                      # Either may be a dict by TARGET header
+                                      # name, e.g. {"WASP-1":3}, which is needed
+                                      # to plot more than one target at once
+    params["AUTO_COMPARISONS"] = None # choose up to this many comparisons automatically
+                                      # instead of the above, None to disable [int]
     params["NORM_FLUX_LIMITS"] = [None, None] # normalised flux limits as list [lower,upper]
     params["TIME_AXIS_LIMITS"] = [None, None] # time axis limits as list [lower,upper]
     params["PLOT_TIME_FORMAT"] = "JD"       # time format for plotting [JD,HJD,BJD]
     params["BINNING"] = 10*60               # bin time for flightcurves [seconds]
+    params["LC_FORMAT"] = "fits" # light curve output: one FITS table per comparison
+                                 # (fits), or all in one FITS table (table) or
+                                 # Arrow IPC file (arrow, needs pyarrow)
+    params["DETREND"] = None # detrend target light curves against a time polynomial
+                             # and these systematics, None to disable:
+                             # [AIRMASS, FWHM, CCD_X, CCD_Y, BKG]
+    params["DETREND_ORDER"] = 2 # order of time polynomial for detrending [int]
     params["PREDICTED_INGRESS"] = None # in format of "PLOT_TIME_FORMAT"
     params["PREDICTED_EGRESS"] =  None # in format of "PLOT_TIME_FORMAT"
     params["ACTUAL_INGRESS"] = None   # in format of "PLOT_TIME_FORMAT"
@@ -85,6 +142,8 @@ def get_params():
     params["NROWS"] = 3                     # max number of plot rows per page [int]
     params["FIGSIZE"] = (12,8)              # figure size in inches as tuple: (width,height)
     params["DPI"] = 100                     # resolution in dots per inch [int]
+    params["PLOT_DENSITY_POINTS"] = 20000 # plot panels with more points as density
+                                          # maps, None to always plot points [int]
     params["PHOT_FILE_IN"] = "*_phot.fits"  # photometry input file
     params["FIELD_IMAGE_IN"] = "*_field.png"    # field image input file
     
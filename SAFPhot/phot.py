@@ -7,15 +7,23 @@ import matplotlib.pyplot as plt
 from astropy.table import Table
 from astropy import coordinates as coord
 from os.path import join, exists
-from os import makedirs
+from os import makedirs, remove, rename
 from glob import glob
 from random import uniform
 from donuts import Donuts
 from time import time as time_
 from scipy import ndimage
 from copy import copy
-from unpack import convert_jd_hjd, convert_jd_bjd, Mapper # SAFPhot script
+from hashlib import sha1
+from unpack import Mapper # SAFPhot script
 from photsort import get_all_files # SAFPhot script
+from tracker import CentroidTracker # SAFPhot script
+from prefetch import Prefetcher, read_hdu # SAFPhot script
+from coadd import CoAdd, coadd_groups # SAFPhot script
+from ephemeris import Ephemeris # SAFPhot script
+from gate import FrameGate, sky_level # SAFPhot script
+from fieldcat import (load_catalogue, save_catalogue, brightest,
+        match_offset) # SAFPhot script
 
 def makeheader(m):
     #Make general header for each HDU
@@ -104,7 +112,7 @@ def rot(image, xy, angle):
             -org[0]*np.sin(a) + org[1]*np.cos(a) ] + rot_center)
     return im_rot, xy_rot
 
-def star_loc_plot(name, data, x, y, angle):
+def star_loc_plot(name, data, x, y, angle, ids=None):
 
     dmean = np.mean(data)
     dstd = np.std(data)
@@ -116,15 +124,48 @@ def star_loc_plot(name, data, x, y, angle):
     color_range=plt.cm.hsv(np.linspace(0,1,10))
    
     ind = x.shape[0]
+    if ids is None: ids = np.arange(ind)
     for i in range(0, int(ind)):
-        plt.text(x[i], y[i], "%i" % i, fontsize=16)
+        plt.text(x[i], y[i], "%i" % ids[i], fontsize=16)
         #, color=color_range[int(ind[i])])
             
     plt.savefig(name, bbox_inches="tight")
     plt.close('all')
 
+def match_field(first_sub, rms, thresh, cat, nmax=30):
+    '''Match the brightest sources on the first frame to each group of a
+    field catalogue in turn. Returns the objects of the first matching group
+    on the frame as IDs and x, y positions, or None if the field does not
+    match.'''
+
+    #Quick detection of the bright sources only, still over the whole
+    #frame as the offset of the field is not known
+    bright = sep.extract(first_sub, thresh=3*thresh, err=rms)
+    det = brightest(bright['x'], bright['y'], bright['flux'], nmax)
+
+    for group in np.unique(cat['GROUP']):
+        ref = cat[cat['GROUP'] == group]
+        offset = match_offset(det, brightest(ref['X'], ref['Y'], ref['FLUX'],
+            nmax))
+        if offset is None:
+            continue
+
+        #Catalogue objects moved onto this frame, dropping those off it
+        x = ref['X'] - offset[0]
+        y = ref['Y'] - offset[1]
+        on = (x >= 0) & (x < first_sub.shape[1]) & (y >= 0) & (y <
+                first_sub.shape[0])
+        return ref['ID'][on], x[on], y[on]
+
+    return None
+
 def build_obj_cat(dir_, prefix, name, first, thresh, bw, fw, angle, subpix,
-        rmax):
+        rmax, cat_file=None):
+    '''Build the object catalogue of a run from its first frame. If a field
+    catalogue file is given, the objects and IDs of the field catalogue are
+    reused when the field matches, and otherwise the detected objects are
+    saved as the catalogue, or added to it as a new group. Returns the x and
+    y positions and IDs of the objects.'''
     
     #Get background image  
     bkg = sep.Background(first, bw=bw, bh=bw, fw=fw, fh=fw)
@@ -132,17 +173,43 @@ def build_obj_cat(dir_, prefix, name, first, thresh, bw, fw, angle, subpix,
     #Subtract the background
     first_sub = first - bkg.back() 
 
-    #Extract sources to use as object catalogue
-    objects = sep.extract(first_sub, thresh=thresh, err=bkg.globalrms)
+    #Match to the field catalogue if there is one
+    cat = None
+    matched = None
+    if cat_file is not None:
+        cat = load_catalogue(cat_file)
+        if cat is not None:
+            matched = match_field(first_sub, bkg.globalrms, thresh, cat)
+            if matched is None:
+                print("Field does not match %s, adding new objects." %
+                        cat_file)
+
+    if matched is not None:
+        ids, x_obj, y_obj = matched
+    else:
+        #Extract sources to use as object catalogue
+        objects = sep.extract(first_sub, thresh=thresh, err=bkg.globalrms)
+        x_obj, y_obj = objects['x'], objects['y']
+
+        #New objects get IDs which do not clash with the field catalogue
+        ids = np.arange(len(x_obj))
+        if cat is not None:
+            ids += np.max(cat['ID']) + 1
 
     #Get the half-width radius (hwhm) 
-    hwhm_ref, flags = sep.flux_radius(first_sub, objects['x'],
-            objects['y'], rmax=np.ones(len(objects['x']))*rmax, frac=0.5,
-            subpix=subpix)
+    hwhm_ref, flags = sep.flux_radius(first_sub, x_obj, y_obj,
+            rmax=np.ones(len(x_obj))*rmax, frac=0.5, subpix=subpix)
    
     #Update the object centroid positions using sep winpos algorithm
-    x_ref, y_ref, f_ref = sep.winpos(first_sub, objects['x'], 
-            objects['y'], 2.0*hwhm_ref*0.4246, subpix=subpix)
+    x_ref, y_ref, f_ref = sep.winpos(first_sub, x_obj, y_obj,
+            2.0*hwhm_ref*0.4246, subpix=subpix)
+
+    #Save the objects as the field catalogue, or as a new group of it, so
+    #that their IDs are kept
+    if (cat_file is not None) and (matched is None):
+        flux_ref, fluxerr_ref, flag_ref = sep.sum_circle(first_sub, x_ref,
+                y_ref, 2.0*np.nanmedian(hwhm_ref))
+        save_catalogue(cat_file, ids, x_ref, y_ref, flux_ref, cat)
     '''
     #Or alternatively just use Donuts positions without winpos refinement
     x_ref = objects['x']
@@ -151,63 +218,888 @@ def build_obj_cat(dir_, prefix, name, first, thresh, bw, fw, angle, subpix,
     
     #Save example field image with objects numbered
     star_loc_plot(join(dir_, prefix + name +'_field.png'),
-            first_sub, x_ref, y_ref, angle)
+            first_sub, x_ref, y_ref, angle, ids)
     
-    return x_ref, y_ref
-               
-def run_phot(dir_, pattern, p, name):
+    return x_ref, y_ref, ids
 
-    #Define background box sizes to use
-    bsizes = np.array(p.box_size)
+def sum_radii(data, x, y, radii, err, gain, mask=None):
+    '''Measure the flux of each object in apertures of every radius. Results
+    have shape [radii, objects].'''
 
-    #Define background filter widths to use
-    fsizes = np.array(p.filter_size)
+    #Tile centroid x/y positions and aperture radii per object
+    x_rad = np.tile(x, (len(radii), 1))
+    y_rad = np.tile(y, (len(radii), 1))
+    rad = np.repeat(radii, len(x)).reshape(x_rad.shape)
 
-    #Define aperture radii to use for flux measurements
-    radii = np.array(p.radii)
+    #Measure number of counts in apertures, flattened for sep
+    flux, fluxerr, flag = sep.sum_circle(data, x_rad.ravel(), y_rad.ravel(),
+            rad.ravel(), err=err, mask=mask, gain=gain)
 
-    #Define num apertures and radius to use for bkg residuals
-    bkg_rad = p.bkg_app_rad
-    nbapps = p.num_bkg_apps
+    return (flux.reshape(x_rad.shape), fluxerr.reshape(x_rad.shape),
+            flag.reshape(x_rad.shape))
 
-    #Define source detection threshold
-    thresh = p.source_thresh
-  
-    #Define subpixel sampling factor for flux measurements
-    subpix = p.subpix
+def frame_background(data, bw, fw):
+    '''Estimate the background of the full frame with one set of background
+    parameters. Returns the background and noise maps, the background
+    subtracted frame and a segmentation map masking the objects.'''
+
+    #Get background image and noise map
+    bkg = sep.Background(data, bw=bw, bh=bw, fw=fw, fh=fw)
+    back = bkg.back()
+    rms = bkg.rms()
+
+    #Subtract the background from data
+    data_sub = data - back
+
+    '''Extract objects at minimal detection threshold to properly
+    mask stars for bkg residual measurement'''
+    objects_bkg, segmap_bkg = sep.extract(data_sub, thresh=1.0, err=rms,
+            segmentation_map=True)
+
+    return back, rms, data_sub, segmap_bkg
+
+def phot_frame(data, x, y, bapp_x, bapp_y, bw, fw, radii, bkg_rad, rmax,
+        subpix, gain, bkg=None):
+    '''Measure all objects on the full frame using one set of background
+    parameters, reusing the background from frame_background if given.'''
+
+    if bkg is None:
+        bkg = frame_background(data, bw, fw)
+    back, rms, data_sub, segmap_bkg = bkg
+
+    #Measure background flux residuals
+    bflux, bfluxerr, bflag = sep.sum_circle(data_sub, bapp_x, bapp_y,
+            bkg_rad, err=rms, mask=segmap_bkg, gain=gain)
+
+    #Get object half width radii (hwhm)
+    hwhm, flags = sep.flux_radius(data_sub, x, y,
+            rmax=np.ones(len(x))*rmax, frac=0.5, subpix=subpix)
+
+    #Update target aperture positions using winpos algorithm
+    x_pos, y_pos, f = sep.winpos(data_sub, x, y, 2.0*hwhm*0.4246,
+            subpix=subpix)
+
+    #Measure number of counts in target apertures
+    flux, fluxerr, flag = sum_radii(data_sub, x_pos, y_pos, radii, rms, gain)
+
+    #Measure num counts subtracted as bkg in same apertures
+    bflux_app, bfluxerr_app, bflag_app = sum_radii(back, x_pos, y_pos, radii,
+            rms, gain)
+
+    return (bflux, hwhm, x_pos, y_pos, flux, fluxerr, flag, bflux_app,
+            bfluxerr_app)
+
+def cut_stamps(data, x, y, size):
+    '''Cut a square postage stamp of side size around each object. Pixels
+    falling outside the frame are zeroed and masked.'''
+
+    #Lower corner of each stamp in frame pixel coordinates
+    half = size // 2
+    x0 = np.round(np.where(np.isfinite(x), x, -size)).astype(int) - half
+    y0 = np.round(np.where(np.isfinite(y), y, -size)).astype(int) - half
+
+    stamps = np.zeros((len(x), size, size))
+    masks = np.ones((len(x), size, size), dtype=bool)
+
+    for k in range(len(x)):
+
+        #Overlap of the stamp with the frame
+        xa, xb = max(x0[k], 0), min(x0[k] + size, data.shape[1])
+        ya, yb = max(y0[k], 0), min(y0[k] + size, data.shape[0])
+
+        if (xa < xb) and (ya < yb):
+            stamps[k, ya-y0[k]:yb-y0[k], xa-x0[k]:xb-x0[k]] = data[ya:yb, xa:xb]
+            masks[k, ya-y0[k]:yb-y0[k], xa-x0[k]:xb-x0[k]] = False
+
+    return stamps, masks, x0, y0
+
+def phot_stamps(stamps, x, y, bapp_k, bapp_x, bapp_y, bw, fw, radii, bkg_rad,
+        rmax, subpix, gain):
+    '''Measure all objects on their postage stamps using one set of
+    background parameters. The background mesh is evaluated locally on each
+    stamp, the box size being no larger than the stamp. Returns the same
+    quantities as phot_frame, with positions in frame coordinates.'''
+
+    stamp_data, stamp_mask, x0, y0 = stamps
+    nobj = len(x)
+
+    #Initialise results, objects without usable stamps stay as nan
+    bflux = np.full(len(bapp_k), np.nan)
+    hwhm = np.full(nobj, np.nan)
+    x_pos = np.full(nobj, np.nan)
+    y_pos = np.full(nobj, np.nan)
+    flux = np.full((len(radii), nobj), np.nan)
+    fluxerr = np.full((len(radii), nobj), np.nan)
+    flag = np.zeros((len(radii), nobj))
+    bflux_app = np.full((len(radii), nobj), np.nan)
+    bfluxerr_app = np.full((len(radii), nobj), np.nan)
+
+    for k in range(nobj):
+
+        data = stamp_data[k]
+        mask = stamp_mask[k]
+        if mask.all(): continue
+
+        #Get local background image and noise map
+        bkg = sep.Background(data, mask=mask, bw=bw, bh=bw, fw=fw, fh=fw)
+        back = bkg.back()
+        rms = bkg.rms()
+
+        #Subtract the background from stamp
+        data_sub = data - back
+
+        #Object position in stamp coordinates
+        xl = np.array([x[k] - x0[k]])
+        yl = np.array([y[k] - y0[k]])
+
+        #Measure background flux residuals in apertures on this stamp
+        sel = (bapp_k == k)
+        if np.any(sel):
+            objects_bkg, segmap_bkg = sep.extract(data_sub, thresh=1.0,
+                    err=rms, mask=mask, segmentation_map=True)
+            bflux[sel], bfluxerr, bflag = sep.sum_circle(data_sub,
+                    bapp_x[sel], bapp_y[sel], bkg_rad, err=rms,
+                    mask=(segmap_bkg > 0) | mask, gain=gain)
+
+        #Get object half width radius (hwhm) and refine position
+        hwhm_k, flags = sep.flux_radius(data_sub, xl, yl,
+                rmax=np.array([rmax]), frac=0.5, subpix=subpix, mask=mask)
+        xw, yw, f = sep.winpos(data_sub, xl, yl, 2.0*hwhm_k*0.4246,
+                subpix=subpix, mask=mask)
+
+        #Measure counts in target and background apertures
+        flux_k, fluxerr_k, flag_k = sum_radii(data_sub, xw, yw, radii, rms,
+                gain, mask=mask)
+        bflux_app_k, bfluxerr_app_k, bflag_app_k = sum_radii(back, xw, yw,
+                radii, rms, gain, mask=mask)
+
+        #Store results with positions back in frame coordinates
+        hwhm[k] = hwhm_k[0]
+        x_pos[k] = xw[0] + x0[k]
+        y_pos[k] = yw[0] + y0[k]
+        flux[:, k] = flux_k[:, 0]
+        fluxerr[:, k] = fluxerr_k[:, 0]
+        flag[:, k] = flag_k[:, 0]
+        bflux_app[:, k] = bflux_app_k[:, 0]
+        bfluxerr_app[:, k] = bfluxerr_app_k[:, 0]
+
+    return (bflux, hwhm, x_pos, y_pos, flux, fluxerr, flag, bflux_app,
+            bfluxerr_app)
+
+def welford_update(n, mean, m2, x):
+    '''Add the finite values of x to running counts, means and sums of
+    squared deviations of the same shape, in place.'''
+    ok = np.isfinite(x)
+    n += ok
+    delta = np.where(ok, x - mean, 0.)
+    mean += np.where(ok, delta / np.maximum(n, 1), 0.)
+    m2 += np.where(ok, delta * (x - mean), 0.)
+
+def flux_stats(n, mean, m2):
+    #Stack of count, mean and standard deviation, NaN for too few frames
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.where(n > 1, np.sqrt(m2 / (n - 1)), np.nan)
+    return np.array([n, np.where(n > 0, mean, np.nan), std])
+
+def select_bkg_params(bkg_flux, keep):
+    '''Select the bkg param combinations with the lowest background residual
+    flux summed over apertures and frames, as used by plot.py to choose the
+    background subtraction. As in plot.py, combinations measured on fewer
+    frames than the others, such as frames left as NaN, are ranked last.
+    Returns a boolean mask over combinations.'''
+
+    resid = np.nansum(bkg_flux, axis=(0, 2))
+    nmeasured = np.sum(np.any(np.isfinite(bkg_flux), axis=0), axis=1)
+    resid[nmeasured < np.max(nmeasured)] = np.inf
+    selected = np.zeros(resid.shape[0], dtype=bool)
+    selected[np.argsort(resid, kind='stable')[:keep]] = True
+    return selected
+
+class ReducedFrames(object):
+    '''Reduced frames stored as individual FITS files.'''
+
+    def __init__(self, f_list):
+        self.f_list = f_list
+
+    def __len__(self):
+        return len(self.f_list)
+
+    def read(self, idx, out=None):
+        #Load tabular data and header of frame idx, tile compressed frames
+        #are stored in the first extension
+        with fitsio.FITS(self.f_list[idx]) as f:
+            hdu = f[0] if f[0].has_data() else f[1]
+            return read_hdu(hdu, out), hdu.read_header()
+
+    def donuts_input(self, idx, data, header):
+        #Donuts reads the frame straight from its file
+        return self.f_list[idx]
+
+    def donuts_ext(self):
+        #Extension of the Donuts input holding the image
+        with fitsio.FITS(self.f_list[0]) as f:
+            return 0 if f[0].has_data() else 1
+
+    def timing(self, idx, jd_key, exp_key):
+        #Mid-exposure JD and exposure time of frame idx, from its header
+        with fitsio.FITS(self.f_list[idx]) as f:
+            hdu = f[0] if f[0].has_data() else f[1]
+            header = hdu.read_header()
+        return header[jd_key], header[exp_key]
+
+    def close(self):
+        pass
+
+#Keywords changing the results of a run, which a checkpoint must match
+CHECKPOINT_KEYS = ["RADII", "SUBPIX", "RMAX", "BOX_SIZE", "FILTER_SIZE",
+        "SOURCE_THRESH", "BKG_APP_RAD", "NUM_BKG_APPS", "PHOT_MODE",
+        "STAMP_SIZE", "BKG_SEARCH", "BKG_SEARCH_FRAMES", "BKG_SEARCH_KEEP",
+        "BKG_SEARCH_RETEST", "TRACKER", "TRACKER_STARS", "TRACKER_WINDOW",
+        "TRACKER_MAX_RESID", "COADD", "COADD_WINDOW", "FRAME_GATE",
+        "GATE_STARS", "GATE_WINDOW", "GATE_SKY_MAX", "GATE_FLUX_MIN",
+        "GATE_SATURATION", "FIELD_CAT_DIR"]
+
+#Max shift of an object [pix] from its position in a checkpoint to resume
+CHECKPOINT_POS_TOL = 0.5
+
+def checkpoint_key(p, labels):
+    '''Hash of the params changing the results of a run, including the
+    overrides of the parameter sets labels.'''
+    values = [(key, getattr(p, key.lower())) for key in CHECKPOINT_KEYS]
+    values += [(label, sorted((p.param_sets or {}).get(label, {}).items()))
+            for label in labels]
+    return sha1(repr(values).encode()).hexdigest()
+
+def checkpoint_part(path, n):
+    #File of part n of a checkpoint, part 0 being the checkpoint file itself
+    return path if n == 0 else path.replace('.npz', '_%04d.npz' % n)
+
+def save_checkpoint(path, n, state):
+    '''Save part n of the checkpoint of an unfinished run. Each part is a new
+    file, only renamed into place once it is complete.'''
+    part = checkpoint_part(path, n)
+    with open(part + '.tmp', 'wb') as f:
+        np.savez(f, **state)
+    rename(part + '.tmp', part)
+
+def remove_checkpoint(path):
+    #Remove a checkpoint with all of its parts
+    for part in [path] + glob(path.replace('.npz', '_[0-9]*.npz*')):
+        if exists(part):
+            remove(part)
+
+def load_checkpoint(path, nraw, nframes, key, sets):
+    '''Load the run information of a checkpoint if one exists and was made
+    for the same frames, params and objects of each set, adding the files
+    of its parts in order under 'parts'. Otherwise any checkpoint is removed
+    and None returned.'''
+    if not exists(path):
+        return None
+    with np.load(path) as f:
+        state = dict((name, f[name]) for name in f.files)
+    parts = []
+    while exists(checkpoint_part(path, len(parts) + 1)):
+        parts.append(checkpoint_part(path, len(parts) + 1))
+
+    match = ((len(parts) > 0) and (int(state['nraw']) == nraw) and
+            (int(state['nframes']) == nframes) and (str(state['key']) == key))
+    for k, pset in enumerate(sets):
+        prefix = 'set%d_' % k
+        match = match and np.array_equal(state[prefix + 'obj_id'],
+                pset.obj_id) and np.all(np.hypot(state[prefix + 'x_ref'] -
+                    pset.x_ref, state[prefix + 'y_ref'] - pset.y_ref) <
+                    CHECKPOINT_POS_TOL)
+    if not match:
+        print("Checkpoint %s does not match this run so ignoring it." % path)
+        remove_checkpoint(path)
+        return None
+
+    state['parts'] = parts
+    return state
+
+def replay_checkpoint(state, sets, frame_hdus):
+    '''Restore the sets and frame dependent arrays from a checkpoint loaded
+    by load_checkpoint, replaying the frames of each part in turn. Returns
+    the progress of the run as saved in the last part, with the tracked
+    shifts of all parts and the part files.'''
+    for k, pset in enumerate(sets):
+        pset.restore_fixed(dict((key, state['set%d_%s' % (k, key)]) for key in
+            pset._fixed))
+    past = []
+    for part in state['parts']:
+        with np.load(part) as f:
+            frames = f['frames']
+            for extname, data in frame_hdus:
+                data[frames] = f[extname]
+            for k, pset in enumerate(sets):
+                pset.restore(dict((key, f['set%d_%s' % (k, key)]) for key in
+                    pset._frames + pset._running), frames)
+            past += [tuple(r) for r in f['tracker_past']]
+            progress = dict((key, f[key]) for key in ['step', 'sample_sky',
+                'n_fallback'])
+    progress['tracker_past'] = past
+    progress['parts'] = state['parts']
+    return progress
+
+#Keywords of a parameter set changing its object catalogue and its bkg
+#apertures, a set shares those of an earlier set with the same values
+CAT_KEYS = ["SOURCE_THRESH", "SUBPIX", "RMAX"]
+BAPP_KEYS = ["NUM_BKG_APPS", "BKG_APP_RAD"]
+
+def set_params(p, overrides):
+    '''Copy of the parameters with the overrides of an extra parameter set
+    applied, keyed as in params.py.'''
+    q = copy(p)
+    for key, value in overrides.items():
+        setattr(q, key.lower(), value)
+    return q
+
+def shared_objects(p, sets):
+    '''Objects and bkg apertures of an earlier set to give a new set with
+    params p, as for PhotSet. The catalogue of the first set with the same
+    detection params is shared, with its bkg apertures if these params also
+    match, otherwise bapp_x, bapp_y and bapp_k are None. Returns None if no
+    set matches.'''
+    for pset in sets:
+        if pset.cat_params == [getattr(p, key.lower()) for key in CAT_KEYS]:
+            bapps = (pset.bapp_x, pset.bapp_y, pset.bapp_k) if (
+                    pset.bapp_params == [getattr(p, key.lower()) for key in
+                        BAPP_KEYS]) else (None, None, None)
+            return (pset.x_ref, pset.y_ref, pset.obj_id) + bapps
+    return None
+
+def phot_output(out_dir, prefix, name, label):
+    #Photometry file name, extra parameter sets are labelled
+    if label == '':
+        return join(out_dir, prefix + name + '_phot.fits')
+    return join(out_dir, prefix + name + '_phot_%s.fits' % label)
+
+class PhotSet(object):
+    '''One set of photometry parameters measured during a run, holding its
+    object catalogue, background apertures and results. A set can be given
+    its objects and background apertures as (x_ref, y_ref, obj_id, bapp_x,
+    bapp_y, bapp_k), new background apertures being drawn if these are None,
+    and restored from a checkpoint. In stamp mode bapp_k is the object whose
+    stamp holds each background aperture, or -1 for apertures not measured.'''
+
+    #Arrays making up the state of a set, those fixed for the run, those
+    #with a last axis of frames and the running statistics and choices
+    _fixed = ['x_ref', 'y_ref', 'obj_id', 'bapp_x', 'bapp_y', 'bapp_k']
+    _frames = ['flux_store', 'fluxerr_store', 'flag_store',
+            'bkg_app_flux_store', 'bkg_app_fluxerr_store', 'bkg_flux_store',
+            'pos_store_x', 'pos_store_y', 'pos_store_donuts_x',
+            'pos_store_donuts_y', 'fwhm_store']
+    _running = ['stat_n', 'stat_mean', 'stat_m2', 'resid_sum', 'resid_n',
+            'active', 'sky_ref']
+
+    def __init__(self, p, label, out_dir, name, first, hdr, nframes,
+            objects=None):
+
+        self.label = label
+        self.output_name = phot_output(out_dir, p.phot_prefix, name, label)
+        self.hdr = hdr
+
+        #Define background box sizes to use
+        bsizes = np.array(p.box_size)
+
+        #Define background filter widths to use
+        fsizes = np.array(p.filter_size)
+
+        #Define aperture radii to use for flux measurements
+        self.radii = np.array(p.radii)
+
+        #Define num apertures and radius to use for bkg residuals
+        self.bkg_rad = p.bkg_app_rad
+        nbapps = p.num_bkg_apps
+
+        #Define subpixel sampling factor for flux measurements
+        self.subpix = p.subpix
+
+        #Define maximum radius to analyse half width radius of object flux
+        self.rmax = p.rmax
+
+        #Params deciding whether other sets can share the catalogue and bkg
+        #apertures of this set
+        self.cat_params = [getattr(p, key.lower()) for key in CAT_KEYS]
+        self.bapp_params = [getattr(p, key.lower()) for key in BAPP_KEYS]
+
+        #List bkg param combinations and those measured on every frame
+        ncombos = len(bsizes)*len(fsizes)
+        self.combos = [(i, j) for i in bsizes for j in fsizes]
+        self.active = np.ones(ncombos, dtype=bool)
+        self.sky_ref = np.nan
+
+        #Start with new or given objects
+        if objects is None:
+            objects = (None, None, None, None, None, None)
+        (self.x_ref, self.y_ref, self.obj_id, self.bapp_x, self.bapp_y,
+                self.bapp_k) = objects
+
+        if self.x_ref is None:
+            #Get object catalogue x and y positions and IDs
+            field_name = name if label == '' else name + '_' + label
+            cat_file = None
+            if p.field_cat_dir is not None:
+                cat_file = join(p.field_cat_dir, p.phot_prefix + field_name
+                        + '_cat.fits')
+            self.x_ref, self.y_ref, self.obj_id = build_obj_cat(out_dir,
+                    p.phot_prefix, field_name, first, p.source_thresh, 32, 3,
+                    p.field_angle, self.subpix, self.rmax, cat_file)
+
+        if self.bapp_x is None:
+            #Define aperture positions for background flux measurement
+            lim_x = first.shape[0]
+            lim_y = first.shape[1]
+            self.bapp_x = [uniform(0.05*lim_x, 0.95*lim_x) for n in
+                    range(nbapps)]
+            self.bapp_y = [uniform(0.05*lim_y, 0.95*lim_y) for n in
+                    range(nbapps)]
+
+            '''In stamp mode the background apertures are instead shared out
+            between the object stamps, with positions in stamp coordinates'''
+            if p.phot_mode == "stamp":
+                self.bapp_x = np.array([uniform(self.bkg_rad,
+                    p.stamp_size - self.bkg_rad) for n in range(nbapps)])
+                self.bapp_y = np.array([uniform(self.bkg_rad,
+                    p.stamp_size - self.bkg_rad) for n in range(nbapps)])
+
+            #Object stamp holding each bkg aperture in stamp mode
+            self.bapp_k = np.arange(nbapps) % len(self.x_ref)
+
+        #Initialise variables to store data
+        nobj = len(self.x_ref)
+        self.flux_store = np.full([self.radii.shape[0], nobj, ncombos,
+            nframes], np.nan)
+        self.fluxerr_store = np.full([self.radii.shape[0], nobj, ncombos,
+            nframes], np.nan)
+        self.flag_store = np.full([self.radii.shape[0], nobj, ncombos,
+            nframes], np.nan)
+        self.bkg_app_flux_store = np.full([self.radii.shape[0], nobj,
+            ncombos, nframes], np.nan)
+        self.bkg_app_fluxerr_store = np.full([self.radii.shape[0], nobj,
+            ncombos, nframes], np.nan)
+        self.bkg_flux_store = np.full([len(self.bapp_x), ncombos, nframes],
+                np.nan)
+        self.pos_store_x = np.full([nobj, nframes], np.nan)
+        self.pos_store_y = np.full([nobj, nframes], np.nan)
+        self.pos_store_donuts_x = np.full([nobj, nframes], np.nan)
+        self.pos_store_donuts_y = np.full([nobj, nframes], np.nan)
+        self.fwhm_store = np.full([ncombos, nframes], np.nan)
+
+        #Running flux statistics of each object and summed bkg residuals
+        self.stat_n = np.zeros([self.radii.shape[0], nobj, ncombos])
+        self.stat_mean = np.zeros([self.radii.shape[0], nobj, ncombos])
+        self.stat_m2 = np.zeros([self.radii.shape[0], nobj, ncombos])
+        self.resid_sum = np.zeros(ncombos)
+        self.resid_n = np.zeros(ncombos)
+
+        #Create variable to log bkg param combinations iterating through 
+        dt = np.dtype([('bkg_parameter_combo', 'S10')])
+        self.bkg_params = np.empty(ncombos, dtype=dt)
+        counter = 0
+        for i in bsizes:
+            for j in fsizes:
+                self.bkg_params[counter] = str(i)+','+str(j)
+                counter += 1
+
+    def fixed_state(self):
+        #Arrays fixed for the run to save in a checkpoint
+        return dict((key, np.asarray(getattr(self, key))) for key in
+                self._fixed)
+
+    def state(self, frames):
+        #Arrays to save in a checkpoint part, the frame dependent arrays
+        #only for the given frames
+        state = dict((key, np.asarray(getattr(self, key))) for key in
+                self._running)
+        for key in self._frames:
+            state[key] = getattr(self, key)[..., frames]
+        return state
+
+    def restore_fixed(self, state):
+        #Restore the arrays fixed for the run from a checkpoint
+        for key in self._fixed:
+            setattr(self, key, state[key])
+
+    def restore(self, state, frames):
+        #Restore the given frames and the running arrays from a checkpoint
+        for key in self._running:
+            setattr(self, key, state[key])
+        for key in self._frames:
+            getattr(self, key)[..., frames] = state[key]
 
-    #Define maximum radius to analyse half width radius of object flux
-    rmax = p.rmax
+    def combo_names(self, selected):
+        #Readable list of the selected bkg param combinations and the set
+        names = ', '.join(self.bkg_params['bkg_parameter_combo'][
+            selected].astype(str))
+        if self.label != '':
+            names += ' (set %s)' % self.label
+        return names
 
-    #Define rotation angle for field image
-    field_angle = p.field_angle
+    def measure(self, gi, bkg_count, data, x, y, stamps, bkg, gain, exp,
+            binfactor, platescale):
+        '''Measure frame gi with bkg param combination bkg_count, on the
+        full frame or on the postage stamps if these are given.'''
 
-    #Define output directory and file name 
-    if p.out_dir is "":
+        ii, jj = self.combos[bkg_count]
+
+        #Measure objects and bkg residuals with these bkg params
+        if stamps is not None:
+            result = phot_stamps(stamps, x, y, self.bapp_k, self.bapp_x,
+                    self.bapp_y, ii, jj, self.radii, self.bkg_rad, self.rmax,
+                    self.subpix, gain)
+        else:
+            result = phot_frame(data, x, y, self.bapp_x, self.bapp_y, ii, jj,
+                    self.radii, self.bkg_rad, self.rmax, self.subpix, gain,
+                    bkg=bkg)
+        (bflux, hwhm, x_pos, y_pos, flux, fluxerr, flag, bflux_app,
+                bfluxerr_app) = result
+
+        #Store background flux residuals
+        self.bkg_flux_store[:, bkg_count, gi] = bflux/exp
+
+        #Store the fwhm result in arcsec, taking mean over all objects
+        self.fwhm_store[bkg_count, gi] = (
+                2.0 * np.nanmean(hwhm) * binfactor * platescale)
+
+        #Store the object centroid positions 
+        self.pos_store_x[:, gi] = x_pos
+        self.pos_store_y[:, gi] = y_pos
+        self.pos_store_donuts_x[:, gi] = x
+        self.pos_store_donuts_y[:, gi] = y
+
+        #Store flux, flux err and flags for target apertures
+        self.flux_store[:, :, bkg_count, gi] = flux/exp
+        self.fluxerr_store[:, :, bkg_count, gi] = fluxerr/exp
+        self.flag_store[:, :, bkg_count, gi] = flag
+
+        #Store flux, flux err and flags for bkg in same apertures
+        self.bkg_app_flux_store[:, :, bkg_count, gi] = bflux_app/exp
+        self.bkg_app_fluxerr_store[:, :, bkg_count, gi] = bfluxerr_app/exp
+
+        #Update the running statistics used to select apertures and bkg
+        #params without reading back the full arrays
+        welford_update(self.stat_n[:, :, bkg_count],
+                self.stat_mean[:, :, bkg_count],
+                self.stat_m2[:, :, bkg_count], flux/exp)
+        self.resid_sum[bkg_count] += np.nansum(bflux/exp)
+        self.resid_n[bkg_count] += np.any(np.isfinite(bflux))
+
+    def write(self, frame_hdus):
+        '''Save each data array as a HDU in FITS file, with the frame
+        dependent arrays shared by all parameter sets given as a list of
+        (extname, array).'''
+
+        hdr = self.hdr
+        header_4D_flux = append_header(hdr, ['apertures', 'objects',
+            'bkgrnd params', 'frames'])
+        header_3D_flux = append_header(hdr, ['bkgrnd apertures',
+            'bkgrnd params', 'frames'])
+        header_2D_pos = append_header(hdr, ['objects', 'frames'])
+        header_2D_fwhm = append_header(hdr, ['bkgrnd params', 'frames'])
+        header_stats = append_header(hdr, ['count, mean, std', 'apertures',
+            'objects', 'bkgrnd params'])
+        header_sums = append_header(hdr, ['summed flux, frames',
+            'bkgrnd params'])
+        header_1D_frames = append_header(hdr, ['frames'])
+        header_bkg_params = append_header(hdr,
+                ['box size (pix), filter width (box)'])
+
+        with fitsio.FITS(self.output_name, "rw", clobber=True) as g:
+            g.write(self.flux_store, header=header_4D_flux,
+                    extname="OBJ_FLUX")
+            g.write(self.fluxerr_store, header=header_4D_flux,
+                    extname="OBJ_FLUX_ERR")
+            g.write(self.flag_store, header=header_4D_flux,
+                    extname="OBJ_FLUX_FLAGS")
+            g.write(self.bkg_app_flux_store, header=header_4D_flux,
+                    extname="OBJ_BKG_APP_FLUX")
+            g.write(self.bkg_app_fluxerr_store, header=header_4D_flux,
+                    extname="OBJ_BKG_APP_FLUX_ERR")
+            g.write(self.bkg_flux_store, header=header_3D_flux,
+                    extname="RESIDUAL_BKG_FLUX")
+            g.write(self.pos_store_x, header=header_2D_pos,
+                    extname="OBJ_CCD_X")
+            g.write(self.pos_store_y, header=header_2D_pos,
+                    extname="OBJ_CCD_Y")
+            g.write(self.pos_store_donuts_x, header=header_2D_pos,
+                    extname="OBJ_CCD_X_UNREFINED")
+            g.write(self.pos_store_donuts_y, header=header_2D_pos,
+                    extname="OBJ_CCD_Y_UNREFINED")
+            g.write(self.fwhm_store, header=header_2D_fwhm,
+                    extname="MEAN_OBJ_FWHM")
+            g.write(self.obj_id, header=append_header(hdr, ['objects']),
+                    extname="OBJ_ID")
+            g.write(np.asarray(self.bapp_x), header=append_header(hdr,
+                ['bkgrnd apertures']), extname="BKG_APP_X")
+            g.write(np.asarray(self.bapp_y), header=append_header(hdr,
+                ['bkgrnd apertures']), extname="BKG_APP_Y")
+            g.write(np.asarray(self.bapp_k), header=append_header(hdr,
+                ['bkgrnd apertures']), extname="BKG_APP_K")
+            #Raw flux statistics, used to pick the aperture for choosing
+            #comparisons. plot.py ranks differential flux against the
+            #comparisons chosen at plot time, which is not known here
+            g.write(flux_stats(self.stat_n, self.stat_mean, self.stat_m2),
+                    header=header_stats, extname="OBJ_FLUX_STATS")
+            g.write(np.array([self.resid_sum, self.resid_n]),
+                    header=header_sums, extname="RESIDUAL_BKG_SUMS")
+            for extname, data in frame_hdus:
+                g.write(data, header=header_1D_frames, extname=extname)
+            g.write(self.radii, header=hdr, extname="VARIABLES_APERTURE_RADII")
+            g.write(self.bkg_params, header=header_bkg_params,
+                    extname="VARIABLES_BKG_PARAMS")
+
+def rephot_objects(path, p, first):
+    '''Objects and background apertures of an existing photometry file to
+    re-measure, as (x_ref, y_ref, obj_id, bapp_x, bapp_y, bapp_k), with the
+    index of the objects in the file and its frame dependent arrays. In
+    stamp mode only the bkg apertures on the stamps of the re-measured
+    objects are measured, the others having a bapp_k of -1.'''
+
+    with fitsio.FITS(path) as f:
+        frame_hdus = dict((extname, f[extname].read()) for extname in ["JD",
+            "HJD_utc", "BJD_tdb", "FRAME_SHIFT_X", "FRAME_SHIFT_Y",
+            "EXPOSURE_TIME", "AIRMASS", "FRAME_GATE_FLAGS"] if extname in f)
+        x_pos = f["OBJ_CCD_X_UNREFINED"].read()
+        y_pos = f["OBJ_CCD_Y_UNREFINED"].read()
+        obj_id = (f["OBJ_ID"].read() if "OBJ_ID" in f else
+                np.arange(x_pos.shape[0]))
+        target = f[0].read_header()["TARGET"]
+
+        #Background apertures of the earlier run, or new ones of the same
+        #number in files made before their positions were saved
+        if "BKG_APP_X" in f:
+            bapp_x = f["BKG_APP_X"].read()
+            bapp_y = f["BKG_APP_Y"].read()
+        else:
+            nbapps = f["RESIDUAL_BKG_FLUX"].read_header()["NAXIS3"]
+            lo, hi = (p.bkg_app_rad, p.stamp_size - p.bkg_app_rad) if (
+                    p.phot_mode == "stamp") else (0.05, 0.95)
+            scale = [1., 1.] if p.phot_mode == "stamp" else first.shape
+            bapp_x = np.array([uniform(lo*scale[0], hi*scale[0]) for n in
+                range(nbapps)])
+            bapp_y = np.array([uniform(lo*scale[1], hi*scale[1]) for n in
+                range(nbapps)])
+
+        #Object stamp holding each bkg aperture, as given out to all objects
+        #of the file in files made before it was saved
+        bapp_k = (f["BKG_APP_K"].read() if "BKG_APP_K" in f else
+                np.arange(len(bapp_x)) % x_pos.shape[0])
+
+    #Reference positions are the tracked positions moved back by the shifts
+    x_ref = np.nanmedian(x_pos + frame_hdus["FRAME_SHIFT_X"], axis=1)
+    y_ref = np.nanmedian(y_pos + frame_hdus["FRAME_SHIFT_Y"], axis=1)
+
+    #Target and comparison objects unless others are chosen
+    ids = p.rephot_objects
+    if ids is None:
+        o_num, c_num = p.object_nums(target)
+        ids = [o_num] + c_num
+    missing = [n for n in ids if n not in obj_id]
+    assert (len(missing) == 0), "Objects %s not in %s" % (missing, path)
+    index = np.array([np.where(obj_id == n)[0][0] for n in ids])
+
+    #Stamps holding the bkg apertures among the re-measured objects, all
+    #apertures being measured on the full frame
+    if p.phot_mode == "stamp":
+        bapp_k = np.array([np.where(index == k)[0][0] if k in index else -1
+            for k in bapp_k])
+    else:
+        bapp_k = np.zeros(len(bapp_x), dtype=int)
+
+    return ((x_ref[index], y_ref[index], obj_id[index], bapp_x, bapp_y,
+        bapp_k), index, frame_hdus)
+
+def merge_phot(path, pset, index, measured, frame_hdus):
+    '''Merge the results of a set measured on objects index and frames
+    measured into an existing photometry file. Aperture radii and bkg params
+    which are new to the file are added, filled with NaN where they were
+    not measured.'''
+
+    with fitsio.FITS(path) as f:
+        hdus = [(hdu.get_extname(), hdu.read(), hdu.read_header()) for hdu in
+                f if hdu.has_data()]
+    old = dict((extname, data) for extname, data, h in hdus)
+
+    #Union of the radii and of the bkg params, existing ones first
+    radii = np.union1d(old["VARIABLES_APERTURE_RADII"], pset.radii)
+    r_old = np.searchsorted(radii, old["VARIABLES_APERTURE_RADII"])
+    r_new = np.searchsorted(radii, pset.radii)
+    names = list(old["VARIABLES_BKG_PARAMS"]["bkg_parameter_combo"].astype(
+        str))
+    names += [c for c in pset.bkg_params["bkg_parameter_combo"].astype(str)
+            if c not in names]
+    c_old = np.arange(len(old["VARIABLES_BKG_PARAMS"]))
+    c_new = np.array([names.index(c) for c in
+        pset.bkg_params["bkg_parameter_combo"].astype(str)])
+    nobj, nframes = old["OBJ_ID"].shape[0], len(old["JD"])
+    objs, frames_ = np.arange(nobj), np.arange(nframes)
+    measured = np.asarray(measured)
+    new = dict(frame_hdus)
+
+    #Flux arrays [apertures, objects, bkg params, frames], only replacing
+    #values which were measured, as bkg params left out by an adaptive
+    #search and gated frames are NaN
+    ok = np.isfinite(pset.flux_store[:, :, :, measured])
+    for extname, store in [("OBJ_FLUX", pset.flux_store),
+            ("OBJ_FLUX_ERR", pset.fluxerr_store),
+            ("OBJ_FLUX_FLAGS", pset.flag_store),
+            ("OBJ_BKG_APP_FLUX", pset.bkg_app_flux_store),
+            ("OBJ_BKG_APP_FLUX_ERR", pset.bkg_app_fluxerr_store)]:
+        data = np.full([len(radii), nobj, len(names), nframes], np.nan)
+        data[np.ix_(r_old, objs, c_old, frames_)] = old[extname]
+        sel = np.ix_(r_new, index, c_new, measured)
+        data[sel] = np.where(ok, store[:, :, :, measured], data[sel])
+        new[extname] = data
+
+    #Residual bkg flux [bkg apertures, bkg params, frames], of the apertures
+    #which were measured
+    data = np.full([old["RESIDUAL_BKG_FLUX"].shape[0], len(names), nframes],
+            np.nan)
+    data[:, :len(c_old), :] = old["RESIDUAL_BKG_FLUX"]
+    bapps = np.where(pset.bapp_k >= 0)[0]
+    sel = np.ix_(bapps, c_new, measured)
+    bkg = pset.bkg_flux_store[np.ix_(bapps, np.arange(len(c_new)), measured)]
+    data[sel] = np.where(np.isfinite(bkg), bkg, data[sel])
+    new["RESIDUAL_BKG_FLUX"] = data
+
+    #Mean FWHM of all objects is kept, only filling in new bkg params
+    data = np.full([len(names), nframes], np.nan)
+    data[:len(c_old), :] = old["MEAN_OBJ_FWHM"]
+    fwhm = data[np.ix_(c_new, measured)]
+    data[np.ix_(c_new, measured)] = np.where(np.isnan(fwhm),
+            pset.fwhm_store[:, measured], fwhm)
+    new["MEAN_OBJ_FWHM"] = data
+
+    #Object positions [objects, frames]
+    for extname, store in [("OBJ_CCD_X", pset.pos_store_x),
+            ("OBJ_CCD_Y", pset.pos_store_y),
+            ("OBJ_CCD_X_UNREFINED", pset.pos_store_donuts_x),
+            ("OBJ_CCD_Y_UNREFINED", pset.pos_store_donuts_y)]:
+        data = old[extname].copy()
+        sel = np.ix_(index, measured)
+        data[sel] = np.where(np.isfinite(store[:, measured]), store[:,
+            measured], data[sel])
+        new[extname] = data
+
+    #Summaries are recomputed from the merged arrays
+    flux = new["OBJ_FLUX"]
+    n = np.sum(np.isfinite(flux), axis=-1)
+    mean = np.nansum(flux, axis=-1) / np.maximum(n, 1)
+    m2 = np.nansum((flux - mean[..., None])**2, axis=-1)
+    new["OBJ_FLUX_STATS"] = flux_stats(n, mean, m2)
+    bkg = new["RESIDUAL_BKG_FLUX"]
+    new["RESIDUAL_BKG_SUMS"] = np.array([np.nansum(bkg, axis=(0, 2)),
+        np.sum(np.any(np.isfinite(bkg), axis=0), axis=1)])
+
+    new["VARIABLES_APERTURE_RADII"] = radii
+    bkg_params = np.empty(len(names), dtype=pset.bkg_params.dtype)
+    bkg_params["bkg_parameter_combo"] = names
+    new["VARIABLES_BKG_PARAMS"] = bkg_params
+
+    #HDUs missing from files made by older versions are added after the
+    #HDU they follow, with the general header of the file
+    base = [r for r in hdus[0][2].records() if not
+            r['name'].startswith('VARAXIS')]
+    new["BKG_APP_X"] = np.asarray(pset.bapp_x)
+    new["BKG_APP_Y"] = np.asarray(pset.bapp_y)
+    new["BKG_APP_K"] = old.get("BKG_APP_K", np.arange(len(pset.bapp_x)) %
+            nobj)
+    added = [("BKG_APP_X", "OBJ_ID", ['bkgrnd apertures']),
+            ("BKG_APP_Y", "BKG_APP_X", ['bkgrnd apertures']),
+            ("BKG_APP_K", "BKG_APP_Y", ['bkgrnd apertures']),
+            ("OBJ_FLUX_STATS", "BKG_APP_K", ['count, mean, std', 'apertures',
+                'objects', 'bkgrnd params']),
+            ("RESIDUAL_BKG_SUMS", "OBJ_FLUX_STATS", ['summed flux, frames',
+                'bkgrnd params'])]
+    added += [(extname, prev, ['frames']) for (prev, d0), (extname, d1) in
+            zip(frame_hdus[:-1], frame_hdus[1:])]
+    for extname, after, vars_ in added:
+        extnames = [e for e, data, h in hdus]
+        if extname not in extnames:
+            hdus.insert(extnames.index(after) + 1, (extname, new[extname],
+                append_header(base, vars_)))
+
+    #Write all HDUs in their order, any others are copied through
+    with fitsio.FITS(path + '.tmp', "rw", clobber=True) as g:
+        for extname, data, h in hdus:
+            g.write(new.get(extname, data), header=h, extname=extname)
+    rename(path + '.tmp', path)
+
+def run_phot(dir_, pattern, p, name, frames=None, rephot=False):
+
+    #Define adaptive background parameter search options
+    bkg_adaptive = (p.bkg_search == "adaptive")
+    bkg_nsample = p.bkg_search_frames
+    bkg_keep = p.bkg_search_keep
+    bkg_retest = p.bkg_search_retest
+
+    #Define whether to measure on postage stamps and the stamp size
+    stamp_mode = (p.phot_mode == "stamp")
+    stamp_size = p.stamp_size
+
+    #Define number of frames or time window (s) to co-add before photometry
+    coadd_num = p.coadd
+    coadd_window = p.coadd_window
+
+    #Define number of frames between checkpoints of the run
+    checkpoint_every = p.checkpoint_every
+
+    #Define parameter sets to measure, the first being the default set,
+    #which is the only set re-measured in rephot mode
+    psets = [('', p)] + [(label, set_params(p, p.param_sets[label])) for
+            label in sorted(p.param_sets or {})]
+    if rephot:
+        psets = psets[:1]
+        checkpoint_every = None
+
+    #Define output directory 
+    if p.out_dir == "":
         p.out_dir = dir_
     out_dir = join(p.out_dir, p.phot_dir)
-    output_name = join(out_dir, p.phot_prefix + name +'_phot.fits')
 
     '''END OF DEFINITIONS'''
 
-    #Check if the photometry file exists and if so skip
-    if exists(output_name): 
-        print("%s already exists so skipping." % output_name)
+    #In rephot mode the photometry file to merge into must exist
+    if rephot and not exists(phot_output(out_dir, p.phot_prefix, name, '')):
+        print("No photometry for %s to re-measure so skipping." % name)
+        return None
+
+    #Check if the photometry files exist and if so skip them
+    for label, q in ([] if rephot else list(psets)):
+        output_name = phot_output(out_dir, p.phot_prefix, name, label)
+        if exists(output_name): 
+            print("%s already exists so skipping." % output_name)
+            psets.remove((label, q))
+    if len(psets) == 0:
         return None 
 
     #Try creating directory to hold photometry files
     if not exists(out_dir): makedirs(out_dir)
 
-    #Get science images
-    file_dir_ = join(dir_, p.red_dir, name, "")
-    f_list = get_all_files(file_dir_, extension=pattern+"*.fits")
-    assert (len(f_list) > 0), "No photometry files found!"
-    print("%d frames" %len(f_list))
+    #Get science images, unless frames are passed in directly
+    if frames is None:
+        file_dir_ = join(dir_, p.red_dir, name, "")
+        frames = ReducedFrames(get_all_files(file_dir_,
+            extension=pattern+"*.fits"))
+    assert (len(frames) > 0), "No photometry files found!"
+    print("%d frames" % len(frames))
+
+    #Group frames to co-add, each group gives one photometry frame
+    timing = None
+    if coadd_window is not None:
+        timing = np.array([frames.timing(k, p.jd, p.exposure) for k in
+            range(len(frames))])
+        groups = coadd_groups(len(frames), jd=timing[:, 0],
+                exp=timing[:, 1], window=coadd_window)
+    else:
+        groups = coadd_groups(len(frames), num=coadd_num)
+    nframes = len(groups)
+    if nframes < len(frames):
+        print("%d frames after co-adding" % nframes)
 
     #Load first image
-    with fitsio.FITS(f_list[0]) as fi:
-        first = fi[0][:, :]
-        firsthdr = fi[0].read_header()
+    first, firsthdr = frames.read(0)
 
     #Try and map parameters to header keywords otherwise set the keyword
     keylist = {'dateobs', 'observer', 'analyser', 'observatory', 'telescope',
@@ -219,73 +1111,128 @@ def run_phot(dir_, pattern, p, name):
     #Get output file general header
     hdr = makeheader(m)
 
-    #Get object catalogue x and y positions
-    x_ref, y_ref = build_obj_cat(out_dir, p.phot_prefix, name, first, 
-            thresh, 32, 3, field_angle, subpix, rmax)
+    #Re-measure chosen objects of an existing file with the same frames
+    objects = None
+    if rephot:
+        objects, obj_index, saved_frames = rephot_objects(phot_output(
+            out_dir, p.phot_prefix, name, ''), p, first)
+        if len(saved_frames["JD"]) != nframes:
+            print("Photometry for %s has %d frames, not %d, so skipping." % (
+                name, len(saved_frames["JD"]), nframes))
+            return None
 
-    #Define aperture positions for background flux measurement
-    lim_x = first.shape[0]
-    lim_y = first.shape[1]
-    bapp_x = [uniform(0.05*lim_x, 0.95*lim_x) for n in range(nbapps)]
-    bapp_y = [uniform(0.05*lim_y, 0.95*lim_y) for n in range(nbapps)]
-    
-    #Initialise variables to store data
-    struct_4D_flux = ['apertures', 'objects', 'bkgrnd params', 'frames']
-    header_4D_flux = append_header(hdr, struct_4D_flux)
-    flux_store = np.empty([radii.shape[0], len(x_ref),
-        len(bsizes)*len(fsizes), len(f_list)])
-    fluxerr_store = np.empty([radii.shape[0], len(x_ref),
-        len(bsizes)*len(fsizes), len(f_list)])
-    flag_store = np.empty([radii.shape[0], len(x_ref),
-        len(bsizes)*len(fsizes), len(f_list)])
-    bkg_app_flux_store = np.empty([radii.shape[0], len(x_ref),
-        len(bsizes)*len(fsizes), len(f_list)])
-    bkg_app_fluxerr_store = np.empty([radii.shape[0], len(x_ref),
-        len(bsizes)*len(fsizes), len(f_list)])
-    
-    struct_3D_flux = ['bkgrnd apertures', 'bkgrnd params', 'frames']
-    header_3D_flux = append_header(hdr, struct_3D_flux)
-    bkg_flux_store = np.empty([len(bapp_x), len(bsizes)*len(fsizes),
-        len(f_list)])
-    
-    struct_2D_pos = ['objects', 'frames']
-    header_2D_pos = append_header(hdr, struct_2D_pos)
-    pos_store_x = np.empty([len(x_ref), len(f_list)])
-    pos_store_y = np.empty([len(y_ref), len(f_list)])
-    pos_store_donuts_x = np.empty([len(x_ref), len(f_list)])
-    pos_store_donuts_y = np.empty([len(y_ref), len(f_list)])
-    
-    struct_2D_fwhm = ['bkgrnd params', 'frames']
-    header_2D_fwhm = append_header(hdr, struct_2D_fwhm)
-    fwhm_store = np.empty([len(bsizes)*len(fsizes), len(f_list)])
-    
-    struct_1D_frames = ['frames']
-    header_1D_frames = append_header(hdr, struct_1D_frames)
-    jd_store = np.empty([len(f_list)])
-    hjd_store = np.empty([len(f_list)])
-    bjd_store = np.empty([len(f_list)])
-    frame_shift_x_store = np.empty([len(f_list)])
-    frame_shift_y_store = np.empty([len(f_list)])
-    exp_store = np.empty([len(f_list)])
-    airmass_store = np.empty([len(f_list)])
-
-    #Create variable to log bkg param combinations iterating through 
-    dt = np.dtype([('bkg_parameter_combo', 'S10')])
-    bkg_params = np.empty(bsizes.shape[0]*fsizes.shape[0], dtype=dt)
-    struct_bkg_params = ['box size (pix), filter width (box)']
-    header_bkg_params = append_header(hdr, struct_bkg_params)
-    counter = 0
-    for i in bsizes:
-        for j in fsizes:
-            bkg_params[counter] = str(i)+','+str(j)
-            counter += 1
-
-    #Create Donuts object using first image as reference
-    d = Donuts(
-        refimage=f_list[0], image_ext=0,
-        overscan_width=0, prescan_width=0,
-        border=0, normalise=False,
-        subtract_bkg=False)
+    #Build object catalogue, apertures and result arrays of each set, sharing
+    #those of an earlier set unless the set changes them
+    sets = []
+    for label, q in psets:
+        shared = objects
+        if shared is None:
+            shared = shared_objects(q, sets)
+        sets.append(PhotSet(q, label, out_dir, name, first, hdr, nframes,
+            shared))
+
+    #Continue from the checkpoint of an interrupted run if there is one made
+    #with the same params and objects
+    checkpoint = join(out_dir, p.phot_prefix + name + '_checkpoint.npz')
+    run_key = checkpoint_key(p, [label for label, q in psets])
+    state = None
+    if not rephot:
+        state = load_checkpoint(checkpoint, len(frames), nframes, run_key,
+                sets)
+
+    #Initialise variables to store frame dependent data
+    jd_store = np.empty([nframes])
+    hjd_store = np.empty([nframes])
+    bjd_store = np.empty([nframes])
+    frame_shift_x_store = np.empty([nframes])
+    frame_shift_y_store = np.empty([nframes])
+    exp_store = np.empty([nframes])
+    airmass_store = np.empty([nframes])
+    gate_store = np.zeros([nframes], dtype=np.int32)
+    frame_hdus = [("JD", jd_store), ("HJD_utc", hjd_store),
+            ("BJD_tdb", bjd_store), ("FRAME_SHIFT_X", frame_shift_x_store),
+            ("FRAME_SHIFT_Y", frame_shift_y_store),
+            ("EXPOSURE_TIME", exp_store), ("AIRMASS", airmass_store),
+            ("FRAME_GATE_FLAGS", gate_store)]
+    if state is not None:
+        state = replay_checkpoint(state, sets, frame_hdus)
+        print("Resuming from checkpoint after %d frames." % state['step'])
+    if rephot:
+        for extname, data in frame_hdus:
+            if extname in saved_frames:
+                data[:] = saved_frames[extname]
+
+    #Background estimates are shared by all sets using the same params
+    all_combos = []
+    for pset in sets:
+        all_combos += [c for c in pset.combos if c not in all_combos]
+
+    #In rephot mode only the frames in the chosen time range are measured
+    todo = np.arange(nframes)
+    if rephot:
+        lo, hi = p.rephot_time_range
+        keep = np.ones(nframes, dtype=bool)
+        if lo is not None: keep &= (jd_store >= lo)
+        if hi is not None: keep &= (jd_store <= hi)
+        todo = todo[keep]
+        print("Re-measuring %d objects on %d frames." % (len(obj_index),
+            len(todo)))
+
+    '''In adaptive mode the full grid is first measured on a sample of frames
+    spread through those measured, then the remaining frames are measured
+    using only the best combinations'''
+    sample = np.array([], dtype=int)
+    if (bkg_adaptive and len(todo) and any(bkg_keep < len(pset.combos) for
+            pset in sets)):
+        sample = todo[np.unique(np.linspace(0, len(todo)-1,
+            min(bkg_nsample, len(todo))).astype(int))]
+    order = np.concatenate([sample, np.setdiff1d(todo, sample)]).astype(int)
+    sample_sky = []
+
+    #Skip the frames already measured before the checkpoint, later parts
+    #of the checkpoint only holding the frames measured after it
+    step = 0
+    part = 0
+    if state is not None:
+        step = int(state['step'])
+        sample_sky = list(state['sample_sky'])
+        part = len(state['parts'])
+    saved_step = step
+
+    #Frames are read group by group
+    group_of = np.empty(len(frames), dtype=int)
+    for gi, members in enumerate(groups):
+        group_of[members] = gi
+    read_order = [k for gi in order[step:] for k in groups[gi]]
+
+    #Create Donuts object using first image as reference, in centroid
+    #tracking mode it is only created if a fallback is needed
+    d = None
+    if (p.tracker == "donuts") and not rephot:
+        d = Donuts(
+            refimage=frames.donuts_input(0, first, firsthdr),
+            image_ext=frames.donuts_ext(),
+            overscan_width=0, prescan_width=0,
+            border=0, normalise=False,
+            subtract_bkg=False)
+
+    #Create centroid tracker using catalogue objects on the first image
+    tracker = None
+    n_fallback = 0
+    if (p.tracker == "centroid") and not rephot:
+        tracker = CentroidTracker(first, sets[0].x_ref, sets[0].y_ref,
+                p.tracker_stars, p.tracker_window, p.tracker_max_resid)
+        if state is not None:
+            tracker.past = state['tracker_past']
+            n_fallback = int(state['n_fallback'])
+    saved_past = 0 if tracker is None else len(tracker.past)
+
+    #Create frame quality gate using bright objects on the first image
+    gate = None
+    if p.frame_gate:
+        gate = FrameGate(first, firsthdr[p.exposure], sets[0].x_ref,
+                sets[0].y_ref, p.gate_stars, p.gate_window, p.gate_sky_max,
+                p.gate_flux_min, p.gate_saturation)
     
     print("Starting photometry for %s." % name)
 
@@ -293,188 +1240,252 @@ def run_phot(dir_, pattern, p, name):
     meter_width=48
     start_time = time_()
 
-    #Iterate through each reduced science image
-    for count, file_  in enumerate(f_list, 1): 
-               
-        #Store frame offset wrt reference image
-        if count != 1:
-            #Calculate offset from reference image
-            shift_result = d.measure_shift(file_)
-            frame_shift_x_store[count-1] = (shift_result.x).value
-            frame_shift_y_store[count-1] = (shift_result.y).value
+    #Iterate through each reduced science image, read ahead in the background
+    prefetcher = Prefetcher(frames, read_order, p.prefetch_depth,
+            p.prefetch_threads, p.prefetch_reuse)
+    stack = None
+    for idx, data, header in prefetcher: 
+
+        #Set frame dependent variables
+        exp = header[p.exposure] # existence compulsory
+        jd = header[p.jd] # existence compulsory
+        binfactor = 1.0
+
+        try:
+            binfactor = float(m.hbin)
+        except:
+            try:
+                binfactor = float(m.vbin)
+            except:
+                pass
+
+        #Missing HJD, BJD and airmass are computed after the loop
+        try:
+            hjd = header[p.hjd]
+        except KeyError:
+            hjd = np.nan
+        try:
+            bjd = header[p.bjd]
+        except KeyError:
+            bjd = np.nan
+        try:
+            airmass = header[p.airmass]
+        except KeyError:
+            airmass = np.nan
+
+        #Calculate frame offset wrt reference image, reusing the shift of
+        #a frame measured by itself in the earlier run in rephot mode
+        if rephot and (len(groups[group_of[idx]]) == 1):
+            shift_result = (frame_shift_x_store[group_of[idx]],
+                    frame_shift_y_store[group_of[idx]])
+        elif idx != 0:
+            #Predict and centroid the tracked objects if tracking, which is
+            #only done in frame order, the sample frames of an adaptive bkg
+            #search being spread through the run
+            shift_result = None
+            tracked = (tracker is not None) and (step >= len(sample))
+            if tracked:
+                shift_result = tracker.measure(data, idx)
+
+            #Otherwise calculate offset from reference image with Donuts
+            if shift_result is None:
+                if d is None:
+                    d = Donuts(
+                        refimage=frames.donuts_input(0, first, firsthdr),
+                        image_ext=frames.donuts_ext(),
+                        overscan_width=0, prescan_width=0,
+                        border=0, normalise=False,
+                        subtract_bkg=False)
+                donuts_result = d.measure_shift(
+                        frames.donuts_input(idx, data, header))
+                shift_result = ((donuts_result.x).value,
+                        (donuts_result.y).value)
+                if tracked: n_fallback += 1
         else:
             #Frame is the reference image so no offset by definition
-            frame_shift_x_store[count-1] = 0
-            frame_shift_y_store[count-1] = 0
+            shift_result = (0, 0)
 
-        #Create image handle
-        with fitsio.FITS(file_) as f:
-            
-            #Load tabular data from image
-            data = f[0][:, :]
-            header = f[0].read_header()
+        #Record the shift to predict the position in later frames
+        if (tracker is not None) and ((step >= len(sample)) or (idx == 0)):
+            tracker.update(idx, shift_result[0], shift_result[1])
 
-            #Set frame dependent variables
-            exp = header[p.exposure] # existence compulsory
-            jd = header[p.jd] # existence compulsory
-            binfactor = 1.0
+        #Add the frame to its group, moving on until the group is complete
+        if stack is None:
+            stack = CoAdd(len(groups[group_of[idx]]))
+        stack.add(data, shift_result[0], shift_result[1], exp, jd, hjd, bjd,
+                airmass)
+        if not stack.complete():
+            continue
+        data, shift_result, (exp, jd, hjd, bjd, airmass) = stack.result()
+        stack = None
+        step += 1
+        count = group_of[idx] + 1
 
-            try:
-                binfactor = float(m.hbin)
-            except:
-                try:
-                    binfactor = float(m.vbin)
-                except:
-                    pass
-            #Store frame dependent variables
-            exp_store[count-1] = exp
-            jd_store[count-1] = jd
-            try:
-                hjd_store[count-1] = header[p.hjd]
-            except:
-                if all(v is not None for v in [m.lon, m.lat, m.alt]):
-                    hjd_store[count-1] = convert_jd_hjd(
-                            jd, m.ra, m.dec, coord.EarthLocation.from_geodetic(
-                                m.lon, m.lat, m.alt)) 
-                else:
-                    hjd_store[count-1] = np.nan
-            try:
-                bjd_store[count-1] = header[p.bjd]
-            except:
-                if all(v is not None for v in [m.lon, m.lat, m.alt]):
-                    bjd_store[count-1] = convert_jd_bjd(
-                            jd, m.ra, m.dec, coord.EarthLocation.from_geodetic(
-                                m.lon, m.lat, m.alt)) 
-                else:
-                    bjd_store[count-1] = np.nan
-            try:
-                airmass_store[count-1] = header[p.airmass]
-            except:
-                airmass_store[count-1] = np.nan
-
-        #Initialise count of number of bkg params gone through
-        bkg_count = 0
-
-        #Iterate through background box sizes
-        for ii in bsizes:
-            #iterate through filter widths
-            for jj in fsizes:
-
-                #Get background image  
-                bkg = sep.Background(data, bw=ii, bh=ii, fw=jj, fh=jj)
-
-                #Subtract the background from data
-                data_sub = data - bkg.back()
-
-                '''Extract objects at minimal detection threshold to properly
-                mask stars for bkg residual measurement'''
-                objects_bkg, segmap_bkg = sep.extract(data_sub, thresh=1.0, 
-                        err=bkg.rms(), segmentation_map=True)
-
-                #Measure background flux residuals
-                bflux, bfluxerr, bflag = sep.sum_circle(data_sub, bapp_x, bapp_y,
-                            bkg_rad, err=bkg.rms(), mask=segmap_bkg,
-                            gain=1/m.preamp)
-                
-                #Store background flux residuals
-                bkg_flux_store[:, bkg_count, count-1] = bflux/exp
-                
-                '''Adjust target aperture centroid positions using Donuts output to
-                allow for drift of frame compared to reference image'''
-                x = x_ref - frame_shift_x_store[count-1]
-                y = y_ref - frame_shift_y_store[count-1]
-                    
-                #Get object half width radii (hwhm)
-                hwhm, flags = sep.flux_radius(data_sub, x, y,
-                        rmax=np.ones(len(x))*rmax, frac=0.5, subpix=subpix)
-
-                #Store the fwhm result in arcsec, taking mean over all objects
-                fwhm_store[bkg_count, count-1] = (
-                        2.0 * np.nanmean(hwhm) * binfactor * m.platescale)
-                
-                #Update target aperture positions using winpos algorithm
-                x_pos,y_pos,f = sep.winpos(data_sub, x, y,
-                        2.0*hwhm*0.4246, subpix=subpix)
-                '''
-                #Or alternatively trust Donuts positions without winpos
-                #refinement
-                x_pos = x
-                y_pos = y
-                '''
-                
-                #Store the object centroid positions 
-                pos_store_x[:, count-1] = x_pos
-                pos_store_y[:, count-1] = y_pos
-                pos_store_donuts_x[:, count-1] = x
-                pos_store_donuts_y[:, count-1] = y
-
-                #Tile centroid x/y positions per aperture radii used
-                x_rad = np.tile(x_pos, len(radii))
-                y_rad = np.tile(y_pos, len(radii))
-                x_rad = x_rad.reshape((len(radii), len(x_pos)))
-                y_rad = y_rad.reshape((len(radii), len(y_pos)))
-
-                #Tile list of aperture radii per object in catalogue and transpose
-                rad = [] 
-                for z  in range(0, len(x_ref)):
-                    rad.append(radii)
-                rad = np.asarray(rad).transpose()
-                
-                #Measure number of counts in target aperture
-                flux, fluxerr, flag = sep.sum_circle(data_sub, x_rad, y_rad,
-                    rad, err=bkg.rms(), gain=1/m.preamp)
-                
-                #Measure num counts subtracted as bkg in same aperture
-                bflux_app, bfluxerr_app, bflag_app = sep.sum_circle(
-                        bkg.back(), x_rad, y_rad, rad, err=bkg.rms(),
-                        gain=1/m.preamp)
-
-                #Store flux, flux err and flags for target apertures
-                flux_store[:, :, bkg_count, count-1] = flux/exp
-                fluxerr_store[:, :, bkg_count, count-1] = fluxerr/exp
-                flag_store[:, :, bkg_count, count-1] = flag
-
-                #Store flux, flux err and flags for bkg in same apertures
-                bkg_app_flux_store[:, :, bkg_count, count-1] = bflux_app/exp
-                bkg_app_fluxerr_store[:, :, bkg_count, count-1] = bfluxerr_app/exp
-                
-                #Increment count of bkg_params gone through
-                bkg_count += 1
+        #Store frame dependent variables
+        exp_store[count-1] = exp
+        jd_store[count-1] = jd
+        hjd_store[count-1] = hjd
+        bjd_store[count-1] = bjd
+        airmass_store[count-1] = airmass
+
+        #Store frame offset wrt reference image
+        frame_shift_x_store[count-1] = shift_result[0]
+        frame_shift_y_store[count-1] = shift_result[1]
+
+
+        #Screen the frame, skipping the photometry of a failed frame so that
+        #its results are left as NaN
+        if gate is not None:
+            gate_store[count-1] = gate.check(data, shift_result[0],
+                    shift_result[1], exp, len(groups[group_of[idx]]))
+        gated = (gate_store[count-1] != 0)
+
+        #Decide which bkg params each set measures, re-testing the full grid
+        #if the sky level has changed since the last test
+        if bkg_retest is not None:
+            sky = sky_level(data)
+        if step <= len(sample):
+            sample_sky.append(sky if (bkg_retest is not None) and not gated
+                    else np.nan)
+        measure = []
+        for pset in sets:
+            if gated:
+                measure.append(np.zeros(len(pset.combos), dtype=bool))
+            elif step <= len(sample):
+                measure.append(np.ones(len(pset.combos), dtype=bool))
+            elif len(sample) and (bkg_retest is not None) and (
+                    abs(sky - pset.sky_ref) > bkg_retest * abs(pset.sky_ref)):
+                measure.append(np.ones(len(pset.combos), dtype=bool))
+                pset.sky_ref = sky
+            else:
+                measure.append(pset.active)
+
+        '''Adjust target aperture centroid positions using Donuts output to
+        allow for drift of frame compared to reference image, and cut the
+        postage stamps once per set, shared by all bkg params'''
+        pos = []
+        stamps = []
+        for pset in sets:
+            x = pset.x_ref - frame_shift_x_store[count-1]
+            y = pset.y_ref - frame_shift_y_store[count-1]
+            pos.append((x, y))
+            stamps.append(cut_stamps(data, x, y, stamp_size) if stamp_mode
+                    and not gated else None)
+
+        #Iterate through background box size and filter width combinations,
+        #estimating the background once for all sets which measure it
+        for ii, jj in all_combos:
+
+            bkg = None
+            for pset, (x, y), stamps_s, measure_s in zip(sets, pos, stamps,
+                    measure):
+
+                if (ii, jj) not in pset.combos: continue
+                bkg_count = pset.combos.index((ii, jj))
+                if not measure_s[bkg_count]: continue
+
+                if (not stamp_mode) and (bkg is None):
+                    bkg = frame_background(data, ii, jj)
+
+                pset.measure(count-1, bkg_count, data, x, y, stamps_s, bkg,
+                        1/m.preamp, exp, binfactor, m.platescale)
+
+        for pset, measure_s in zip(sets, measure):
+
+            #Keep the best bkg params once the sample frames are measured
+            if len(sample) and (step == len(sample)):
+                pset.active = select_bkg_params(pset.bkg_flux_store[:, :, sample],
+                        bkg_keep)
+                if np.any(np.isfinite(sample_sky)):
+                    pset.sky_ref = np.nanmedian(sample_sky)
+                print("\nBkg params kept after sampling %d frames: %s" % (
+                    len(sample), pset.combo_names(pset.active)))
+
+            #Switch to the best bkg params after a re-test of the full grid,
+            #keeping no more than bkg_keep of them
+            elif (not gated) and (measure_s is not pset.active) and np.any(
+                    ~pset.active):
+                best = select_bkg_params(
+                        pset.bkg_flux_store[:, :, count-1:count], bkg_keep)
+                if np.any(best != pset.active):
+                    pset.active = best
+                    print("\nSky level changed, bkg params now measured: %s"
+                            % pset.combo_names(pset.active))
+
+        #Save a checkpoint of the run every checkpoint_every frames, the run
+        #information once and then only the frames measured since the last
+        #save, so that each frame is written once
+        if checkpoint_every and (step % checkpoint_every == 0) and (
+                step < nframes):
+            if part == 0:
+                saved = {'nraw':len(frames), 'nframes':nframes,
+                        'key':run_key}
+                for k, pset in enumerate(sets):
+                    for key, data in pset.fixed_state().items():
+                        saved['set%d_%s' % (k, key)] = data
+                save_checkpoint(checkpoint, 0, saved)
+            done = order[saved_step:step]
+            saved = {'frames':done, 'step':step,
+                    'sample_sky':np.array(sample_sky),
+                    'n_fallback':n_fallback,
+                    'tracker_past':np.array([] if tracker is None else
+                        tracker.past[saved_past:]).reshape(-1, 3)}
+            for extname, data in frame_hdus:
+                saved[extname] = data[done]
+            for k, pset in enumerate(sets):
+                for key, data in pset.state(done).items():
+                    saved['set%d_%s' % (k, key)] = data
+            part += 1
+            save_checkpoint(checkpoint, part, saved)
+            saved_step = step
+            saved_past = 0 if tracker is None else len(tracker.past)
     
         #Show progress meter for number of frames processed
-        n_steps = len(f_list)
-        nn = int((meter_width+1) * float(count) / n_steps)
-        delta_t = time_()-start_time # time to do float(count) / n_steps % of caluculation
-        time_incr = delta_t/(float(count+1) / n_steps) # seconds per increment
-        time_left = time_incr*(1- float(count) / n_steps)
+        n_steps = len(order)
+        nn = int((meter_width+1) * float(step) / n_steps)
+        delta_t = time_()-start_time # time to do float(step) / n_steps % of caluculation
+        time_incr = delta_t/(float(step+1) / n_steps) # seconds per increment
+        time_left = time_incr*(1- float(step) / n_steps)
         mins, s = divmod(time_left, 60)
         h, mins = divmod(mins, 60)
         sys.stdout.write("\r[{0}{1}] {2:5.1f}% - {3:02}h:{4:02}m:{05:.2f}s".
              format('#' * nn, ' ' * (meter_width - nn),
-                 100*float(count)/n_steps,h,mins,s))
+                 100*float(step)/n_steps,h,mins,s))
   
-    #Save each data array as a HDU in FITS file
-    with fitsio.FITS(output_name, "rw", clobber=True) as g:
-        g.write(flux_store, header=header_4D_flux, extname="OBJ_FLUX")
-        g.write(fluxerr_store, header=header_4D_flux, extname="OBJ_FLUX_ERR")
-        g.write(flag_store, header=header_4D_flux, extname="OBJ_FLUX_FLAGS")
-        g.write(bkg_app_flux_store, header=header_4D_flux, extname="OBJ_BKG_APP_FLUX")
-        g.write(bkg_app_fluxerr_store, header=header_4D_flux,
-                extname="OBJ_BKG_APP_FLUX_ERR")
-        g.write(bkg_flux_store, header=header_3D_flux, extname="RESIDUAL_BKG_FLUX")
-        g.write(pos_store_x, header=header_2D_pos, extname="OBJ_CCD_X")
-        g.write(pos_store_y, header=header_2D_pos, extname="OBJ_CCD_Y")
-        g.write(pos_store_donuts_x, header=header_2D_pos, extname="OBJ_CCD_X_UNREFINED")
-        g.write(pos_store_donuts_y, header=header_2D_pos, extname="OBJ_CCD_Y_UNREFINED")
-        g.write(fwhm_store, header=header_2D_fwhm, extname="MEAN_OBJ_FWHM")
-        g.write(jd_store, header=header_1D_frames, extname="JD")
-        g.write(hjd_store, header=header_1D_frames, extname="HJD_utc")
-        g.write(bjd_store, header=header_1D_frames, extname="BJD_tdb")
-        g.write(frame_shift_x_store, header=header_1D_frames, extname="FRAME_SHIFT_X")
-        g.write(frame_shift_y_store, header=header_1D_frames, extname="FRAME_SHIFT_Y")
-        g.write(exp_store, header=header_1D_frames, extname="EXPOSURE_TIME")
-        g.write(airmass_store, header=header_1D_frames, extname="AIRMASS")
-        g.write(radii, header=hdr, extname="VARIABLES_APERTURE_RADII")
-        g.write(bkg_params, header=header_bkg_params, extname="VARIABLES_BKG_PARAMS")
+    #Compute missing HJD, BJD and airmass in one go from the ephemeris
+    missing = np.isnan(hjd_store) | np.isnan(bjd_store) | np.isnan(
+            airmass_store)
+    if np.any(missing) and all(v is not None for v in [m.lon, m.lat, m.alt]):
+        ephem = Ephemeris(m.ra, m.dec, coord.EarthLocation.from_geodetic(
+            m.lon, m.lat, m.alt), p.ephem_step, join(p.out_dir,
+                p.ephem_dir))
+        hjd, bjd, airmass = ephem.evaluate(jd_store[missing])
+        hjd_store[missing] = np.where(np.isnan(hjd_store[missing]), hjd,
+                hjd_store[missing])
+        bjd_store[missing] = np.where(np.isnan(bjd_store[missing]), bjd,
+                bjd_store[missing])
+        airmass_store[missing] = np.where(np.isnan(airmass_store[missing]),
+                airmass, airmass_store[missing])
+
+    #Save the results of each set with the shared frame dependent arrays,
+    #or merge the re-measured objects and frames into the existing file
+    if rephot:
+        merge_phot(sets[0].output_name, sets[0], obj_index, order, frame_hdus)
+    else:
+        for pset in sets:
+            pset.write(frame_hdus)
+
+    #The run is complete so the checkpoint is no longer needed
+    remove_checkpoint(checkpoint)
+
+    frames.close()
+
+    if tracker is not None:
+        print("\nDonuts fallback used for %d of %d frames." % (n_fallback,
+            len(frames)))
+
+    if gate is not None:
+        print("\nFrame gate skipped %d of %d frames." % (np.sum(
+            gate_store[order] != 0), len(order)))
 
     print("\nCompleted photometry for %s." % name)
@@ -0,0 +1,87 @@
+'''
+Lazy reading of SAFPhot photometry files.
+
+The flux arrays of a photometry file have shape [apertures, objects, bkg
+params, frames] and can be many GB for long runs on rich fields, while the
+light curves only need a few objects and, once the aperture and bkg params
+are chosen, a single slice of them. PhotFile exposes the image HDUs as
+LazyHDU objects which are indexed like numpy arrays but only read the
+requested part from disk. Integers, slices and lists of indices are
+supported on every axis, lists being read one index at a time.
+
+'''
+
+import numpy as np
+
+from fitsio import FITS
+
+class LazyHDU(object):
+    '''Image HDU read on demand when indexed.'''
+
+    def __init__(self, hdu):
+
+        self.hdu = hdu
+        self.shape = tuple(hdu.get_dims())
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self):
+        return self.hdu.read()
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        #Read a list of indices one index at a time along its axis
+        for axis, k in enumerate(key):
+            if isinstance(k, (list, np.ndarray)):
+                parts = [self[key[:axis] + (slice(n, n+1),) + key[axis+1:]]
+                        for n in np.asarray(k, dtype=int)]
+                drop = sum(1 for kk in key[:axis] if isinstance(kk,
+                    (int, np.integer)))
+                return np.concatenate(parts, axis=axis - drop)
+
+        #Integers are read as length one slices and the axis dropped
+        slices = []
+        squeeze = []
+        for axis, k in enumerate(key):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) % self.shape[axis]
+                slices.append(slice(k, k+1))
+                squeeze.append(axis)
+            else:
+                slices.append(slice(*k.indices(self.shape[axis])))
+        data = self.hdu[tuple(slices)]
+        return data.reshape([n for axis, n in enumerate(data.shape) if axis
+            not in squeeze])
+
+class PhotFile(object):
+    '''Photometry file with image HDUs read lazily. Tables and small HDUs
+    are read in full with read.'''
+
+    def __init__(self, path):
+
+        self.fits = FITS(path)
+        self.header = self.fits[0].read_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, extname):
+        return extname in self.fits
+
+    def __getitem__(self, extname):
+        return LazyHDU(self.fits[extname])
+
+    def read(self, extname):
+        return self.fits[extname].read()
+
+    def close(self):
+        self.fits.close()
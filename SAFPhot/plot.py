@@ -5,8 +5,14 @@ Script to perform differential photometry on SAFPhot output data. Utilises
 parameters define in params.py
 
 Mandatory: 
-        - Input directory: path to photometry folder containing photometry FITS
-        and field image PNG
+        - Input directory: path to one or more run directories, whose
+        photometry folders contain the photometry FITS and field image PNG
+
+The plotting can also be imported and used as a module. plot_photometry
+plots a single photometry file and plot_targets plots many, in a pool of
+worker processes if requested, so that every target of a night is plotted
+from one Python process without repeated start up. All state of a plot is
+held in a PlotContext rather than in globals.
 '''
 
 import numpy as np
@@ -15,17 +21,23 @@ import warnings; warnings.simplefilter('ignore')
 import sys
 import argparse
 import params # SAFPhot script
-
-from os.path import join, dirname
+from ensemble import CompEnsemble, object_flux, relative_flux # SAFPhot script
+from photfile import PhotFile # SAFPhot script
+from binning import bin_series # SAFPhot script
+from detrend import Detrender # SAFPhot script
+from compselect import select_comparisons # SAFPhot script
+from lcexport import LightCurveSet, check_format # SAFPhot script
+
+from os.path import join, dirname, isfile
 from astropy.table import Table
 from astropy.time import Time
-from fitsio import FITS
 from glob import glob
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.colors import LogNorm
 from copy import copy
 from matplotlib.image import imread
 from shutil import copyfile
-from scipy.stats import mode
+from multiprocessing import Pool
 #from scipy.stats import pearsonr
 
 warnings.simplefilter('ignore')
@@ -35,171 +47,199 @@ def get_sn_max(sn_max):
     sn_max_b = sn_max[1][0]
     return sn_max_a, sn_max_b
 
-def bin_to_size(data, num_points_bin, block_exposure_times, 
-        block_index_boundaries, mask):
-    '''Convenience function to bin everything to a fixed num of points per
-    bin. Data is clipped to the nearest bin (i.e. data % num_points_bin are
-    discarded from the end of the time series).'''
-    
-    #Initialise storeage for blocks
-    data_rack = []
-
-    #Iterate over blocks
-    for j, value in enumerate(block_index_boundaries):
-        if j < len(block_index_boundaries) -1:
-            #Get block
-            data_block = data[value:block_index_boundaries[j+1]]
-            mask_block = mask[value:block_index_boundaries[j+1]]
-            
-            #Clean out nans from block
-            data_block = data_block[mask_block]
-
-            #Calculate number of points per bin for block
-            npb = int(num_points_bin / block_exposure_times[j])
-
-            #bin block
-            num_bins = int(len(data_block) / npb)
-            data_block = rebin(data_block[0:num_bins*npb], num_bins)
-
-            #Store block in rack
-            data_rack.append(data_block)
-
-    #Flatten rack
-    rebinned_data = np.hstack(data_rack)
-    return rebinned_data
-
-def rebin(a, *args):
-    '''From the scipy cookbook on rebinning arrays
-    rebin ndarray data into a smaller ndarray of the same rank whose dimensions
-    are factors of the original dimensions. eg. An array with 6 columns and 4 
-    rows can be reduced to have 6,3,2 or 1 columns and 4,2 or 1 rows.
-    example usages:
-    a=rand(6,4); b=rebin(a,3,2)
-    a=rand(6); b=rebin(a,2)'''
-    shape = a.shape
-    lenShape = len(shape)
-    factor = np.asarray(shape)/np.asarray(args)
-    factor = factor.astype(int)
-    evList = ['a.reshape('] + \
-             ['args[%d],factor[%d],'%(i,i) for i in range(lenShape)] + \
-             [')'] + ['.sum(%d)'%(i+1) for i in range(lenShape)] + \
-             ['/factor[%d]'%i for i in range(lenShape)]
-    return eval(''.join(evList))
-
-def air_corr(flux, xjd, xjd_oot_l=99, xjd_oot_u=99):
-    '''Function to remove a 2-D polynomial fit using the out of transit
-    region.'''
-    
-    #Copy data to prevent overwriting input arrays
-    flux_r = np.copy(flux)
-    xjd_r = np.copy(xjd)
-
-    #Divide out residual airmass using out of transit region
-    oot = (((xjd_r < xjd_oot_l) | (xjd_r > xjd_oot_u)) & (np.isfinite(flux_r)) &
-        (np.isfinite(xjd_r)))
-    poly1 = np.poly1d(np.polyfit(xjd_r[oot], flux_r[oot], 2))
-    p1 = poly1(xjd_r)
-    flux_r /= p1
-    return flux_r
-
-def add_plot(x_in, y_in, bintime=0, ylabel=None, xoffset=0, s=10,
-        c='b', alpha=1.0, xlim=[None, None], ylim=[None, None],
-        xlabel=None, plot_oot_l=False, plot_oot_u=False,
-        plot_oot_l_p=False, plot_oot_u_p=False,
-        plot_rms=False, rms_mask=None, inc=False, hold=False):
-   
-    #Retrieve global variables
-    global npp; global n_plotted; global n_plot_tot
-    global fig; global figs; global ax; global axf; global used_axes
-    
-    #Check whether new plot page is required
-    if (npp == 0) and (hold is False):
-
-        #Initialise variables
-        used_axes = []
-        
-        #Define figure and axes
-        fig, ax = plt.subplots(
-                nrows, ncols, figsize=figsize, dpi=dpi, sharex=True)
-        axf = ax.flat
-        fig.suptitle(target_name+', '+observat+' '
-                +telescop+', '+filtera+', '+filterb+', '+str(dateobs))
-
-    #Copy data
-    x = np.copy(x_in) - xoffset
-    y = np.copy(y_in)
-
-    #Clip outliers
-    if xlim[0] is not None:
-        x[x < xlim[0]] = np.nan
-    if xlim[1] is not None:
-        x[x > xlim[1]] = np.nan
-    if ylim[0] is not None:
-        y[y < ylim[0]] = np.nan
-    if ylim[1] is not None:
-        y[y > ylim[1]] = np.nan
-    
-    #RMS
-    if rms_mask is not None:
-        mask = rms_mask
-    else:
-        mask = np.ones(x.shape[0], dtype=bool)
-    rms = (np.nanstd(y[mask], ddof=1) / np.nanmedian(y[mask]))
-    
-    #Data label
-    bin_unit = "s"
-    if bintime > 60:
-        bintime /= 60
-        bin_unit = "min"
-    datalabel = 'RMS: %7.4f; %d %s' %(rms,bintime,bin_unit)
-
-    #Plot
-    axf[npp].scatter(x, y, label=datalabel, s=s, c=c, alpha=alpha)
-
-    #Axes labels
-    cond_1 = (xlabel is not None) and (npp >= (nrows*ncols)-ncols)
-    cond_2 = (xlabel is not None) and (n_plot_tot-n_plotted <= ncols)
-    if any([cond_1, cond_2]) :
-        plt.setp(axf[npp].get_xticklabels(), visible=True)
-        axf[npp].set_xlabel(xlabel + " (-%d)" %xoffset)
-    if ylabel is not None:
-        axf[npp].set_ylabel(ylabel)
-
-    #Legend
-    if plot_rms is True:
-        axf[npp].legend()
-
-    #X lines
-    if (xjd_oot_l_p is not None) and (plot_oot_l_p is True):
-        axf[npp].axvline(x=xjd_oot_l_p - xoffset, c='g', linestyle="--")
-    if (xjd_oot_u_p is not None) and (plot_oot_u_p is True):
-        axf[npp].axvline(x=xjd_oot_u_p - xoffset, c='g', linestyle="--")
-    if (xjd_oot_l is not None) and (plot_oot_l is True):
-        axf[npp].axvline(x=xjd_oot_l - xoffset, c='g')
-    if (xjd_oot_u is not None) and (plot_oot_u is True):
-        axf[npp].axvline(x=xjd_oot_u - xoffset, c='g')
-    
-    #Increment plot counter
-    if inc is True:
-        used_axes.append(axf[npp])
-        npp += 1
-        n_plotted += 1
-
-    #If page finished
-    if (n_plot_tot - n_plotted == 0) or (npp >= (nrows*ncols)):
-   
-        #Remove empty axes:
-        for ii in axf:
-            if ii not in used_axes:
-                ii.remove()
-
-        #Save figure
-        fig.tight_layout(rect=[0, 0.03, 1, 0.95])
-        figs.append(fig)
-    
-        #Reset plot counter
-        if npp >= (nrows*ncols):
-            npp = 0
+def mode_exposure(exp):
+    #Most common exposure time, the smallest if several are as common
+    values, counts = np.unique(exp, return_counts=True)
+    return values[np.argmax(counts)]
+
+#File name endings of the columnar light curve formats
+LC_SUFFIX = {"table": "_lc.fits", "arrow": "_lc.arrow"}
+
+#Colour maps used for density plots of points of each colour
+DENSITY_CMAPS = {'b': 'Blues', 'r': 'Reds', 'g': 'Greens'}
+
+class PlotContext(object):
+    '''Pages of plot panels for one target, with the plot settings of params
+    p and the header information info of the target. n_plot_tot is the
+    number of panels to plot and oot the actual ingress and egress. If
+    pdf_file is given each page is written to it once finished and freed,
+    otherwise the pages are kept in figs.'''
+
+    def __init__(self, p, info, n_plot_tot, oot=(None, None), pdf_file=None):
+
+        self.nrows, self.ncols = p.nrows, p.ncols
+        self.figsize, self.dpi = p.figsize, p.dpi
+        self.density_points = p.plot_density_points
+        self.info = info
+        self.oot_p = (p.predicted_ingress, p.predicted_egress)
+        self.oot = oot
+        self.title = ', '.join([info['TARGET'], info['OBSERVAT'] + ' ' +
+            info['TELESCOP'], info['FILTERA'], info['FILTERB'],
+            info['DATE-OBS']])
+
+        #Page state
+        self.n_plot_tot = n_plot_tot
+        self.n_plotted = 0
+        self.npp = 0
+        self.figs = []
+        self.fig = None
+        self.axf = None
+        self.used_axes = []
+        self.pdf = PdfPages(pdf_file) if pdf_file is not None else None
+        self.pages = 0
+
+    def add_plot(self, x_in, y_in, bintime=0, ylabel=None, xoffset=0, s=10,
+            c='b', alpha=1.0, xlim=[None, None], ylim=[None, None],
+            xlabel=None, plot_oot_l=False, plot_oot_u=False,
+            plot_oot_l_p=False, plot_oot_u_p=False,
+            plot_rms=False, rms_mask=None, inc=False, hold=False,
+            density_bins=(200, 100)):
+
+        nrows, ncols = self.nrows, self.ncols
+
+        #Check whether new plot page is required
+        if (self.npp == 0) and (hold is False):
+
+            #Initialise variables
+            self.used_axes = []
+
+            #Define figure and axes
+            self.fig, ax = plt.subplots(nrows, ncols, figsize=self.figsize,
+                    dpi=self.dpi, sharex=True)
+            self.axf = ax.flat
+            self.fig.suptitle(self.title)
+        axis = self.axf[self.npp]
+
+        #Copy data
+        x = np.copy(x_in) - xoffset
+        y = np.copy(y_in)
+
+        #Clip outliers
+        if xlim[0] is not None:
+            x[x < xlim[0]] = np.nan
+        if xlim[1] is not None:
+            x[x > xlim[1]] = np.nan
+        if ylim[0] is not None:
+            y[y < ylim[0]] = np.nan
+        if ylim[1] is not None:
+            y[y > ylim[1]] = np.nan
+
+        #RMS
+        if rms_mask is not None:
+            mask = rms_mask
+        else:
+            mask = np.ones(x.shape[0], dtype=bool)
+        rms = (np.nanstd(y[mask], ddof=1) / np.nanmedian(y[mask]))
+
+        #Data label
+        bin_unit = "s"
+        if bintime > 60:
+            bintime /= 60
+            bin_unit = "min"
+        datalabel = 'RMS: %7.4f; %d %s' %(rms,bintime,bin_unit)
+
+        #Plot, the points being rasterised and very dense series drawn as
+        #an image of the number of points in each bin
+        finite = np.isfinite(x) & np.isfinite(y)
+        if (self.density_points is not None) and (np.sum(finite) >
+                self.density_points):
+            counts, xedges, yedges = np.histogram2d(x[finite], y[finite],
+                    bins=density_bins)
+            counts[counts == 0] = np.nan
+            axis.imshow(counts.T, extent=(xedges[0], xedges[-1], yedges[0],
+                yedges[-1]), origin='lower', aspect='auto',
+                interpolation='nearest', cmap=DENSITY_CMAPS.get(c, 'Greys'),
+                norm=LogNorm(vmin=1, vmax=max(np.nanmax(counts), 2)))
+            axis.plot([], [], 's', c=c, label=datalabel)
+        else:
+            axis.scatter(x, y, label=datalabel, s=s, c=c, alpha=alpha,
+                    rasterized=True)
+
+        #Axes labels
+        cond_1 = (xlabel is not None) and (self.npp >= (nrows*ncols)-ncols)
+        cond_2 = (xlabel is not None) and (self.n_plot_tot-self.n_plotted <=
+                ncols)
+        if any([cond_1, cond_2]) :
+            plt.setp(axis.get_xticklabels(), visible=True)
+            axis.set_xlabel(xlabel + " (-%d)" %xoffset)
+        if ylabel is not None:
+            axis.set_ylabel(ylabel)
+
+        #Legend
+        if plot_rms is True:
+            axis.legend()
+
+        #X lines
+        oot_l_p, oot_u_p = self.oot_p
+        oot_l, oot_u = self.oot
+        if (oot_l_p is not None) and (plot_oot_l_p is True):
+            axis.axvline(x=oot_l_p - xoffset, c='g', linestyle="--")
+        if (oot_u_p is not None) and (plot_oot_u_p is True):
+            axis.axvline(x=oot_u_p - xoffset, c='g', linestyle="--")
+        if (oot_l is not None) and (plot_oot_l is True):
+            axis.axvline(x=oot_l - xoffset, c='g')
+        if (oot_u is not None) and (plot_oot_u is True):
+            axis.axvline(x=oot_u - xoffset, c='g')
+
+        #Increment plot counter
+        if inc is True:
+            self.used_axes.append(axis)
+            self.npp += 1
+            self.n_plotted += 1
+
+        #If page finished
+        if (self.n_plot_tot - self.n_plotted == 0) or (self.npp >=
+                (nrows*ncols)):
+
+            #Remove empty axes:
+            for ii in self.axf:
+                if ii not in self.used_axes:
+                    ii.remove()
+
+            #Save figure
+            self.fig.tight_layout(rect=[0, 0.03, 1, 0.95])
+            self._add_page(self.fig)
+
+            #Reset plot counter
+            if self.npp >= (nrows*ncols):
+                self.npp = 0
+
+    def plot_field_image(self, field_file, o_num, c_num):
+        field_image = plt.imread(field_file)[:,:,:]
+        fig = plt.figure(figsize=self.figsize, dpi=self.dpi)
+        dmean = np.mean(field_image)
+        dstd = np.std(field_image)
+        plt.imshow(field_image, vmin=dmean-1*dstd, vmax=dmean+2*dstd,
+            cmap=plt.get_cmap('gray'))
+        plt.axis('off')
+        fig.suptitle(self.info['TARGET']+', '+self.info['OBSERVAT']+' '
+                +self.info['TELESCOP']+', '+self.info['FILTERA']+', '
+                +self.info['DATE-OBS'] + '\n\ntarget: %d;  ' %o_num
+                +'comparisons: %s' %[x for x in c_num])
+        self._add_page(fig)
+
+    def _add_page(self, fig):
+        #Write a finished page to the PDF and free it, or keep it
+        self.pages += 1
+        if self.pdf is not None:
+            self.pdf.savefig(fig)
+            plt.close(fig)
+        else:
+            self.figs.append(fig)
+
+    def save(self, pdf_file):
+        #Save the pages kept to pdf_file and free the figures
+        with PdfPages(pdf_file) as pdf:
+            for fig in self.figs:
+                pdf.savefig(fig)
+                plt.close(fig)
+        self.figs = []
+
+    def close(self):
+        #Finish the PDF pages were written to
+        if self.pdf is not None:
+            self.pdf.close()
+            self.pdf = None
 
 def write_table_header(table, dic):
     for key in dic.keys():
@@ -207,123 +247,64 @@ def write_table_header(table, dic):
     return table
 
 def update_table(table_in, dic):
-    table_out = copy(table_in)
+    table_out = table_in.copy()
     for key in dic.keys():
-        table_in[key] = dic[key]
+        table_out[key] = dic[key]
     return table_out
 
 def save_data_fits(table, file_name, comp_name):
 
     #Save data as FITS
-    fits_name = join(dir_, file_name + '_%s.fits' % comp_name) 
+    fits_name = file_name + '_%s.fits' % comp_name
     table.write(fits_name, overwrite=True)
 
-def differential_photometry(i_flux, i_err, obj_index, comp_index,
-        norm_mask=None):
-
-    #Copy data to prevent overwriting of input arrays
-    in_flux = np.copy(i_flux)
-    in_err = np.copy(i_err)
-
-    #If no norm_mask, set to array of ones
-    if norm_mask is None:
-        norm_mask = np.ones(in_flux.shape[-1], dtype=bool)
-
-    #create variables to store the comparison star flux and flux err
-    comp_flux = np.zeros((in_flux.shape[0], in_flux.shape[2], in_flux.shape[3]))
-    comp_flux_err = np.zeros((in_err.shape[0], in_err.shape[2], in_err.shape[3]))
-
-    #Make 0s nans so as not to bias calculations
-    in_flux[in_flux == 0] = np.nan
-    in_err[in_err == 0] = np.nan
-   
-    #Get object flux and error
-    obj_flux = in_flux[:, obj_index, :, :]
-    obj_flux_err = in_err[:, obj_index, :, :]
-    '''obj_norm = (np.nanmedian((obj_flux[:, :, norm_mask]), 
-                axis=2).reshape((in_flux.shape[0], in_flux.shape[2], 1)))'''
-    
-    #Get comparison flux and error
-    comp_flux_raw = in_flux[:, comp_index, :, :]
-    comp_flux_err_raw = in_err[:, comp_index, :, :]
-    weight_vals = np.nanmean(1.0 / (comp_flux_err_raw / comp_flux_raw)**2,
-        axis=-1).reshape((comp_flux_raw.shape[0],
-        comp_flux_raw.shape[1], comp_flux_raw.shape[2], 1))
-    weights = np.concatenate([weight_vals] * comp_flux_raw.shape[-1],
-            axis=-1)
-    nan_mask = np.logical_or(np.isnan(comp_flux_raw),
-        np.isnan(comp_flux_err_raw))
-    comp_flux = np.ma.masked_array(comp_flux_raw, mask=nan_mask)
-    comp_flux_err = np.ma.masked_array(comp_flux_err_raw, mask=nan_mask)
-    comp_flux = np.ma.average(comp_flux, weights=weights, axis=1)
-    comp_flux_err = np.sqrt(1.0/np.sum(1.0/(comp_flux_err**2.0), axis=1))
-    '''comp_norm = (np.nanmedian(comp_flux[:, :, norm_mask], 
-            axis=2).reshape((comp_flux.shape[0], comp_flux.shape[1], 1)))'''
-
-    #Get differential flux and error, normalised by median OOT region
-    diff_flux = obj_flux / comp_flux
-    diff_flux_err = diff_flux * np.sqrt((obj_flux_err/obj_flux)**2.0 +
-                (comp_flux_err/comp_flux)**2.0)
-    diff_norm = (np.nanmedian(diff_flux[:, :, norm_mask], 
-            axis=2).reshape((diff_flux.shape[0], diff_flux.shape[1], 1)))
-    diff_flux /= diff_norm
-    diff_flux_err /= diff_norm 
-
-    return diff_flux, diff_flux_err, obj_flux, comp_flux 
-    
-def plot_field_image(dir_, field_file, o_num, c_num):
-    field_image = plt.imread(join(dir_,field_file))[:,:,:]
-    fig = plt.figure(figsize=figsize, dpi=dpi)
-    dmean = np.mean(field_image)
-    dstd = np.std(field_image)
-    plt.imshow(field_image, vmin=dmean-1*dstd, vmax=dmean+2*dstd,
-        cmap=plt.get_cmap('gray'))
-    plt.axis('off')
-    fig.suptitle(target_name+', '+observat+' '
-            +telescop+', '+filtera+', '+str(dateobs) + '\n\ntarget: %d;  '
-            %o_num +'comparisons: %s' %[x for x in c_num])
-    figs.append(fig)
+def find_targets(dir_, p):
+    '''Photometry files in the photometry directory dir_, each with its
+    field image, as a list of (photometry file, field image) pairs.'''
+
+    targets = []
+    infile_list = sorted(glob(join(dir_, p.phot_file_in)))
+    assert len(infile_list) != 0, "No photometry input file detected in %s" \
+            % dir_
+
+    #Object numbers differ between fields, so with several targets they
+    #must be given for each target
+    if len(infile_list) > 1:
+        assert type(p.target_object_num) == dict, \
+                "TARGET_OBJECT_NUM must be a dict by target with %d files in" \
+                " %s" % (len(infile_list), dir_)
+        assert (type(p.comparison_object_nums) == dict) or (
+                p.auto_comparisons is not None), \
+                "COMPARISON_OBJECT_NUMS must be a dict by target or " \
+                "AUTO_COMPARISONS set with %d files in %s" % (
+                        len(infile_list), dir_)
+    for infile_ in infile_list:
+
+        #Field image of the same name, or the only one in the directory
+        field_file = infile_.replace("_phot.fits", "_field.png")
+        if not isfile(field_file):
+            field_image_list = glob(join(dir_, p.field_image_in))
+            assert len(field_image_list) == 1, \
+                    "No single field image input file for %s" % infile_
+            field_file = field_image_list[0]
+        targets.append((infile_, field_file))
+
+    return targets
+
+def plot_photometry(infile_, field_file, p):
+    '''Plot the light curves of the photometry file infile_ with params p,
+    writing the comparison FITS tables and the plot PDF next to it. Returns
+    the name of the PDF.'''
 
+    '''===== START OF INPUT PARAMETERS ======'''
 
-if __name__ == "__main__":
-
-    #Parse arguments from command line
-    parser = argparse.ArgumentParser(
-        description='Plotting script for photometry produced by SAFPhot')
-    parser.add_argument('dir_in', metavar='dir_in', help='Input directory',
-            type=str, action='store')
-    args = parser.parse_args()
-
-    #Load the list of parameters 
-    p = params.get_params()
+    #Check the light curve format can be written before plotting
+    check_format(p.lc_format)
 
-    '''===== START OF INPUT PARAMETERS ======'''
-    
-    #Specify input-output directory
-    dir_ = join(args.dir_in, p.phot_dir)
-    
-    #Specify input photometry file name
-    infile_list = glob(join(dir_, p.phot_file_in))
-    assert len(infile_list) != 0, "No photometry input file detected"
-    assert len(infile_list) < 2, "Too many photometry input files detected: %d" \
-            %(len(infile_list))
-    infile_ = infile_list[0]
-    
-    #Specify input field image file name
-    field_image_list = glob(join(dir_, p.field_image_in))
-    assert len(field_image_list) != 0, "No field image input file detected"
-    assert len(field_image_list) < 2, "Too many field image input files detected: %d" \
-            %(len(field_image_list))
-    field_file = field_image_list[0]
-   
     #Define output FITS and PDF names
     outfile_pdf = infile_.replace(".fits", "_plot.pdf")
     outfile_fits = infile_.replace("_phot.fits", "_comp")
 
-    #Define target and comparison object numbers (indicies) from field plot
-    o_num = p.target_object_num           # As integer
-    c_num = p.comparison_object_nums      # As list
-
     #Define normalised flux and time axis limits for plotting
     norm_flux_limits = p.norm_flux_limits
     time_axis_limits = p.time_axis_limits
@@ -335,50 +316,41 @@ if __name__ == "__main__":
     binning = p.binning
    
     #Ingress and egress times [None, value]
-    global xjd_oot_l_p; xjd_oot_l_p = p.predicted_ingress   # predicted ingress
-    global xjd_oot_u_p; xjd_oot_u_p = p.predicted_egress    # predicted egress
-    global xjd_oot_l; xjd_oot_l = p.actual_ingress          # actual ingress
-    global xjd_oot_u; xjd_oot_u = p.actual_egress           # actual egress
-    
-    #Define max number of plot panel rows and columns per page and other vars
-    global ncols; ncols = p.ncols
-    global nrows; nrows = p.nrows
-    global figsize; figsize = p.figsize
-    global dpi; dpi = p.dpi
+    xjd_oot_l = p.actual_ingress          # actual ingress
+    xjd_oot_u = p.actual_egress           # actual egress
 
     '''===== END OF INPUT PARAMETERS ====='''
 
-    
-    #Load data from photometry file
-    with FITS(glob(join(dir_, infile_))[0]) as f:
-        hdr = copy(f[0].read_header())
-        flux = f['OBJ_FLUX'][:,:,:,:]
-        fluxerr = f['OBJ_FLUX_ERR'][:,:,:,:]
-        obj_bkg_app_flux = f['OBJ_BKG_APP_FLUX'][:,:,:,:]
-        bkg_flux = f['RESIDUAL_BKG_FLUX'][:,:,:]
-        ccdx = f['OBJ_CCD_X'][:,:]
-        ccdy = f['OBJ_CCD_Y'][:,:]
-        fwhm = f['MEAN_OBJ_FWHM'][:,:]
-        jd = f['JD'][:]
-        hjd = f['HJD_utc'][:]
-        bjd = f['BJD_tdb'][:]
-        exp = f['EXPOSURE_TIME'][:]
-        airmass = f['AIRMASS'][:]
-        apps = f['VARIABLES_APERTURE_RADII'][:]
-        bkgs = np.char.strip(np.asarray(f['VARIABLES_BKG_PARAMS'][:],
-            dtype='S10'))
+    #Open photometry file, the large arrays are only read in the parts
+    #needed for the target and comparisons
+    f = PhotFile(infile_)
+    hdr = copy(f.header)
+    obj_id = (f.read('OBJ_ID') if 'OBJ_ID' in f else
+            np.arange(f['OBJ_FLUX'].shape[1]))
+    fwhm = f.read('MEAN_OBJ_FWHM')
+    jd = f.read('JD')
+    hjd = f.read('HJD_utc')
+    bjd = f.read('BJD_tdb')
+    exp = f.read('EXPOSURE_TIME')
+    airmass = f.read('AIRMASS')
+    apps = f.read('VARIABLES_APERTURE_RADII')
+    bkgs = np.char.strip(np.asarray(f.read('VARIABLES_BKG_PARAMS'),
+        dtype='S10')).astype(str)
 
     #Get key header information
-    global target_name; target_name = hdr['TARGET']
-    global dateobs; dateobs = Time(
+    target_name = hdr['TARGET']
+
+    #Define target and comparison object numbers (indicies) from field plot
+    o_num, c_num = p.object_nums(target_name)
+    dateobs = Time(
             hdr['DATE-OBS'].strip(),format='isot',scale='utc',out_subfmt='date_hm')
-    global observat; observat = hdr['OBSERVAT'].strip()
-    global telescop; telescop = hdr['TELESCOP'].strip()
-    global instrumt; instrumt = hdr['INSTRUMT'].strip()
-    global observer; observer = hdr['OBSERVER'].strip()
-    global analyser; analyser = hdr['ANALYSER'].strip()
-    global filtera; filtera, _, _ = hdr['FILTERA'].strip().partition(' - ')
-    global filterb; filterb, _, _ = hdr['FILTERB'].strip().partition(' - ')
+    observat = hdr['OBSERVAT'].strip()
+    telescop = hdr['TELESCOP'].strip()
+    instrumt = hdr['INSTRUMT'].strip()
+    observer = hdr['OBSERVER'].strip()
+    analyser = hdr['ANALYSER'].strip()
+    filtera, _, _ = hdr['FILTERA'].strip().partition(' - ')
+    filterb, _, _ = hdr['FILTERB'].strip().partition(' - ')
     
     #Screen print
     print("\nPlotting photometry for: %s %s %s %s %s" %(target_name, observat,
@@ -400,8 +372,9 @@ if __name__ == "__main__":
     elif plot_time_format == "BJD": xjd = bjd
     else: xjd = jd
     
-    #Get xjd offset time 
+    #Get xjd offset time and the most common exposure time
     xjd_off = np.floor(np.nanmin(xjd))
+    exp_mode = mode_exposure(exp)
 
     #Get normalisation mask
     if xjd_oot_l is None: xjd_oot_l = np.nanmin(xjd)
@@ -412,32 +385,84 @@ if __name__ == "__main__":
     else:
         norm_mask = np.ones(xjd.shape[0], dtype=bool)
 
-    #Identify blocks of frames with different exposure times
-    block_ind_bound = np.array([0])
-    block_ind_bound = np.append(block_ind_bound, np.where(exp[:-1] != exp[1:])[0] +1)
-    block_exp_t = exp[block_ind_bound]
-    block_ind_bound = np.append(block_ind_bound, exp.shape[0]).tolist()
-
     #Find background subtraction parameters with lowest residuals
     '''
     print ("Bkg subtraction residual flux for each parameter combination "\
         "summed across frames:")
     print np.nansum(bkg_flux, axis=(0,2))
     '''
-    lowest_bkg = np.where(np.nansum(bkg_flux, axis=(0,2)) == np.nanmin(
-        np.nansum(bkg_flux, axis=(0,2))))[0][0]
- 
+    if 'RESIDUAL_BKG_SUMS' in f:
+        #Summed residuals and frames measured kept by run_phot
+        bkg_resid, bkg_nframes = f.read('RESIDUAL_BKG_SUMS')
+    else:
+        bkg_flux = f['RESIDUAL_BKG_FLUX']
+        bkg_resid = np.zeros(bkg_flux.shape[1])
+        bkg_nframes = np.zeros(bkg_flux.shape[1], dtype=int)
+        for k in range(0, bkg_flux.shape[2], 1000):
+            chunk = bkg_flux[:, :, k:k+1000]
+            bkg_resid += np.nansum(chunk, axis=(0,2))
+            bkg_nframes += np.sum(np.any(np.isfinite(chunk), axis=0), axis=1)
+
+    #Only consider parameters measured on as many frames as any other, as
+    #the adaptive background search leaves some combinations unmeasured
+    bkg_resid[bkg_nframes < np.max(bkg_nframes)] = np.nan
+    lowest_bkg = np.where(bkg_resid == np.nanmin(bkg_resid))[0][0]
+
+    #Choose the comparisons automatically, as catalogue IDs, if requested
+    if p.auto_comparisons is not None:
+        assert o_num in obj_id, "Target number not found in photometry file"
+        c_num = [int(obj_id[c]) for c in select_comparisons(f,
+            int(np.where(obj_id == o_num)[0][0]), lowest_bkg, norm_mask,
+            p.auto_comparisons)]
+        assert len(c_num) != 0, "No comparison objects could be selected"
+        print("Comparisons selected automatically: %s" % c_num)
+
+    #Object numbers are the IDs of the field catalogue, convert them to
+    #indices of the photometry arrays
+    assert np.all(np.isin([o_num] + list(c_num), obj_id)), \
+            "Object numbers not found in photometry file"
+    o_num = int(np.where(obj_id == o_num)[0][0])
+    c_num = [int(np.where(obj_id == c)[0][0]) for c in c_num]
+
+    #Read the target and comparison rows only, which are then numbered
+    #from 0 for the target, the fluxes being read by the comparison
+    #ensemble a chunk at a time
+    rows = [o_num] + c_num
+    flux = f['OBJ_FLUX']
+    fluxerr = f['OBJ_FLUX_ERR']
+    ccdx = f['OBJ_CCD_X'][rows]
+    ccdy = f['OBJ_CCD_Y'][rows]
+    obj_bkg_app_flux = f['OBJ_BKG_APP_FLUX']
+    obj_id = obj_id[rows]
+    o_num, c_num = 0, list(range(1, len(rows)))
+
+    #Set up detrending of the target light curves, fitted out of transit
+    detrender = None
+    if p.detrend is not None:
+        systematics = {'AIRMASS': airmass, 'FWHM': fwhm,
+                'CCD_X': ccdx[o_num], 'CCD_Y': ccdy[o_num],
+                'BKG': obj_bkg_app_flux[0, rows[o_num]]}
+        detrender = Detrender(xjd, [systematics[key] for key in p.detrend],
+                fit_mask=norm_mask, order=p.detrend_order)
+        header_dic['DETREND'] = ','.join(p.detrend)
+
     #Initialise first page of output pdf
-    global npp; npp = 0
-    global figs; figs = []
-    global n_plot_tot; n_plot_tot = 6 + 2*len(c_num)
-    global n_plotted; n_plotted = 0
+    ctx = PlotContext(p, header_dic, 6 + 2*len(c_num),
+            oot=(xjd_oot_l, xjd_oot_u), pdf_file=outfile_pdf)
 
 
+    #Form the comparison sums once, the ensemble, single comparisons and
+    #each comparison against the others all follow from them
+    ens = CompEnsemble(flux, fluxerr, [rows[c] for c in c_num])
+    obj_flux, obj_flux_err = object_flux(flux, fluxerr, rows[o_num])
+
     '''TARGET VS MEAN/ENSAMBLE COMPARISON'''
     #Perform differential photometry using comparison ensemble
-    diff_flux, diff_flux_err, obj_flux, comp_flux = differential_photometry(flux, 
-                                                fluxerr, o_num, c_num, norm_mask)
+    comp_flux, comp_flux_err = ens.ensemble()
+    diff_flux, diff_flux_err = relative_flux(obj_flux, obj_flux_err,
+            comp_flux, comp_flux_err, norm_mask)
+    if detrender is not None:
+        diff_flux, diff_flux_err = detrender.apply(diff_flux, diff_flux_err)
 
     #Pick the best signal to noise (from oot region if specified)
     signal = np.nanmean(diff_flux[:,:,norm_mask], axis=2)
@@ -461,7 +486,7 @@ if __name__ == "__main__":
     #Get base data table for FITS output
     base_table = Table([jd, hjd, bjd, diff_flux[sn_max_bkg_a,sn_max_bkg_b,:], 
         diff_flux_err[sn_max_bkg_a,sn_max_bkg_b,:], 
-        obj_bkg_app_flux[sn_max_bkg_a,o_num,sn_max_bkg_b], 
+        obj_bkg_app_flux[sn_max_bkg_a,rows[o_num],sn_max_bkg_b], 
         ccdx[o_num, :], ccdy[o_num, :], 
         fwhm[sn_max_bkg_b,:], exp, airmass], 
         names=('JD_UTC', 'HJD_UTC', 'BJD_TDB', 'RELATIVE_FLUX', 'FLUX_ERROR',
@@ -472,26 +497,23 @@ if __name__ == "__main__":
     base_table = write_table_header(base_table, header_dic)
     
     #Plot differential photometry using comparison ensemble
-    add_plot(xjd, diff_flux[sn_max_bkg_a,sn_max_bkg_b,:],
-        ylabel='Rel. flux (ensemble)', bintime=(mode(exp)[0][0]),
+    ctx.add_plot(xjd, diff_flux[sn_max_bkg_a,sn_max_bkg_b,:],
+        ylabel='Rel. flux (ensemble)', bintime=exp_mode,
         xoffset=xjd_off, xlabel=plot_time_format,
         plot_oot_l=True, plot_oot_u=True, plot_oot_l_p=True, plot_oot_u_p=True,
         plot_rms=True, rms_mask=norm_mask,
         xlim=time_axis_limits, ylim=norm_flux_limits, alpha=0.5, inc=False)
     
-    #Bin data
+    #Bin data in time windows, leaving out frames without a finite flux
     finite_mask = np.isfinite(diff_flux[sn_max_bkg_a, sn_max_bkg_b, :])
-    flux_bin = bin_to_size(diff_flux[sn_max_bkg_a, sn_max_bkg_b, :], binning, 
-            block_exp_t, block_ind_bound, finite_mask)
-    xjd_bin = bin_to_size(xjd, binning, block_exp_t, block_ind_bound,
-            finite_mask)
-    fwhm_bin = bin_to_size(fwhm[sn_max_bkg_b,:], binning, block_exp_t, block_ind_bound,
-            finite_mask)
-    norm_mask_bin = bin_to_size(norm_mask, binning, block_exp_t, block_ind_bound,
-            finite_mask).astype(bool)
+    binned, counts = bin_series(xjd, [xjd, diff_flux[sn_max_bkg_a,
+        sn_max_bkg_b, :], fwhm[sn_max_bkg_b,:], norm_mask], binning,
+        mask=finite_mask)
+    xjd_bin, flux_bin, fwhm_bin, norm_mask_bin = binned[:, counts[0] > 0]
+    norm_mask_bin = norm_mask_bin > 0
 
     #plot Binned differential photometry using comparison ensemble
-    add_plot(xjd_bin, flux_bin, bintime=binning, xoffset=xjd_off,
+    ctx.add_plot(xjd_bin, flux_bin, bintime=binning, xoffset=xjd_off,
         plot_rms=True, rms_mask=norm_mask_bin, xlim=time_axis_limits,
         ylim=norm_flux_limits, c='r', inc=True, hold=True)
     
@@ -499,35 +521,40 @@ if __name__ == "__main__":
     params_to_update = {
         'RELATIVE_FLUX': diff_flux[sn_max_bkg_a,sn_max_bkg_b,:],
         'FLUX_ERROR': diff_flux_err[sn_max_bkg_a,sn_max_bkg_b,:],
-        'BACKGROUND_FLUX': obj_bkg_app_flux[sn_max_bkg_a,o_num,sn_max_bkg_b,:]}
+        'BACKGROUND_FLUX': obj_bkg_app_flux[sn_max_bkg_a,rows[o_num],sn_max_bkg_b,:]}
     updated_table = update_table(base_table, params_to_update)
     updated_table.meta['APPRADUS'] = apps[sn_max_bkg_a]
     updated_table.meta['BKGPARAM'] = bkgs[sn_max_bkg_b]
-    save_data_fits(updated_table, outfile_fits, 'ensemble')
+    if p.lc_format == "fits":
+        save_data_fits(updated_table, outfile_fits, 'ensemble')
+
+    #Collect the light curves for the columnar export
+    lcs = LightCurveSet(updated_table)
+    lcs.add('ensemble', updated_table)
 
 
     ''''PLOT SYSTEMATIC INDICATORS'''
     '''
     corr_store = []
     for i in range(diff_flux[sn_max_bkg_a,sn_max_bkg_b, :].shape[0]):
-        yy =pearsonr(np.roll(obj_bkg_app_flux[sn_max_bkg_a,o_num,sn_max_bkg_b],
+        yy =pearsonr(np.roll(obj_bkg_app_flux[sn_max_bkg_a,rows[o_num],sn_max_bkg_b],
             i), diff_flux[sn_max_bkg_a,sn_max_bkg_b])[0]
         corr_store.append(yy)
-    add_plot(xjd, np.asarray(corr_store),
+    ctx.add_plot(xjd, np.asarray(corr_store),
             ylabel='Background flux', xoffset=xjd_off, xlabel=plot_time_format, inc=True)
     ''' 
-    add_plot(xjd, obj_bkg_app_flux[sn_max_bkg_a,o_num,sn_max_bkg_b,:], 
+    ctx.add_plot(xjd, obj_bkg_app_flux[sn_max_bkg_a,rows[o_num],sn_max_bkg_b,:], 
             ylabel='Background flux', xoffset=xjd_off, xlabel=plot_time_format,
             xlim=time_axis_limits, inc=True)
-    add_plot(xjd, ccdx[o_num,:], ylabel='CCD_X', xoffset=xjd_off,
+    ctx.add_plot(xjd, ccdx[o_num,:], ylabel='CCD_X', xoffset=xjd_off,
             xlabel=plot_time_format, xlim=time_axis_limits, inc=True)
-    add_plot(xjd, fwhm[sn_max_bkg_b,:], xoffset=xjd_off,
+    ctx.add_plot(xjd, fwhm[sn_max_bkg_b,:], xoffset=xjd_off,
             xlabel=plot_time_format, xlim=time_axis_limits, inc=False)
-    add_plot(xjd_bin, fwhm_bin, ylabel='FWHM (arcsec)', xoffset=xjd_off,
+    ctx.add_plot(xjd_bin, fwhm_bin, ylabel='FWHM (arcsec)', xoffset=xjd_off,
             xlabel=plot_time_format, xlim=time_axis_limits, inc=True, hold=True, c='r')
-    add_plot(xjd, ccdy[o_num,:], ylabel='CCD_Y', xoffset=xjd_off,
+    ctx.add_plot(xjd, ccdy[o_num,:], ylabel='CCD_Y', xoffset=xjd_off,
             xlabel=plot_time_format, xlim=time_axis_limits, inc=True)
-    add_plot(xjd, airmass, ylabel='Airmass', xoffset=xjd_off,
+    ctx.add_plot(xjd, airmass, ylabel='Airmass', xoffset=xjd_off,
             xlabel=plot_time_format, xlim=time_axis_limits, inc=True)
     
 
@@ -536,8 +563,12 @@ if __name__ == "__main__":
         
         '''TARGET VS INDIVIDUAL COMPARISONS'''
         #Get differential flux of object with comparison star
-        diff_flux, diff_flux_err, obj_flux, comp_flux = differential_photometry(
-                flux, fluxerr, o_num, [cindex], norm_mask)
+        comp_flux, comp_flux_err = ens.single(rows[cindex])
+        diff_flux, diff_flux_err = relative_flux(obj_flux, obj_flux_err,
+                comp_flux, comp_flux_err, norm_mask)
+        if detrender is not None:
+            diff_flux, diff_flux_err = detrender.apply(diff_flux,
+                    diff_flux_err)
         signal = np.nanmean(diff_flux[:,:,norm_mask], axis=2)
         noise = np.nanstd(diff_flux[:,:,norm_mask], axis=2, ddof=1)
         sn_max = np.where(signal/noise == np.nanmax(signal/noise))
@@ -547,8 +578,8 @@ if __name__ == "__main__":
         sn_max_bkg_a, sn_max_bkg_b = get_sn_max(sn_max_bkg)
     
         #Plot differential photometry using individual comparisons
-        add_plot(xjd, diff_flux[sn_max_bkg_a,sn_max_bkg_b,:],
-            ylabel='Rel. flux (comp. %d)' %cindex, bintime=(mode(exp)[0][0]),
+        ctx.add_plot(xjd, diff_flux[sn_max_bkg_a,sn_max_bkg_b,:],
+            ylabel='Rel. flux (comp. %d)' %obj_id[cindex], bintime=exp_mode,
             xoffset=xjd_off, xlabel=plot_time_format,
             plot_oot_l=p.plot_actual_ingress,
             plot_oot_u=p.plot_actual_egress, plot_oot_l_p=True,
@@ -557,14 +588,12 @@ if __name__ == "__main__":
         
         #Bin data
         finite_mask = np.isfinite(diff_flux[sn_max_bkg_a, sn_max_bkg_b, :])
-        flux_bin = bin_to_size(diff_flux[sn_max_bkg_a, sn_max_bkg_b, :], binning, 
-                block_exp_t, block_ind_bound, finite_mask)
-        xjd_bin = bin_to_size(xjd, binning, block_exp_t, block_ind_bound,
-                finite_mask)
-        norm_mask_bin = bin_to_size(norm_mask, binning, block_exp_t, block_ind_bound,
-                finite_mask).astype(bool)
+        binned, counts = bin_series(xjd, [xjd, diff_flux[sn_max_bkg_a,
+            sn_max_bkg_b, :], norm_mask], binning, mask=finite_mask)
+        xjd_bin, flux_bin, norm_mask_bin = binned[:, counts[0] > 0]
+        norm_mask_bin = norm_mask_bin > 0
         #Plot binned photometry using individual comparisons
-        add_plot(xjd_bin, flux_bin, bintime=binning, xoffset=xjd_off,
+        ctx.add_plot(xjd_bin, flux_bin, bintime=binning, xoffset=xjd_off,
             plot_rms=True, rms_mask=norm_mask_bin, xlim=time_axis_limits, 
             ylim=norm_flux_limits, c='r', inc=True, hold=True)
         
@@ -572,21 +601,22 @@ if __name__ == "__main__":
         params_to_update = {
             'RELATIVE_FLUX':diff_flux[sn_max_bkg_a,sn_max_bkg_b,:],
             'FLUX_ERROR':diff_flux_err[sn_max_bkg_a,sn_max_bkg_b,:],
-            'BACKGROUND_FLUX':obj_bkg_app_flux[sn_max_bkg_a,o_num,sn_max_bkg_b,:]}
+            'BACKGROUND_FLUX':obj_bkg_app_flux[sn_max_bkg_a,rows[o_num],sn_max_bkg_b,:]}
+        updated_table = update_table(base_table, params_to_update)
         updated_table.meta['APPRADUS'] = apps[sn_max_bkg_a]
         updated_table.meta['BKGPARAM'] = bkgs[sn_max_bkg_b]
-        updated_table = update_table(base_table, params_to_update)
-        save_data_fits(updated_table, outfile_fits, cindex)
+        if p.lc_format == "fits":
+            save_data_fits(updated_table, outfile_fits, obj_id[cindex])
+        lcs.add(obj_id[cindex], updated_table)
         
 
         '''RESIDUALS: EACH COMPARISON VS MEAN OF OTHER COMPARISONS'''
         #Get diff flux of comparison with mean of other comparisons
         if (len(c_num) > 1):
-            comp_mask = np.not_equal(c_num, [cindex]*len(c_num))
-            other_comps = np.asarray(c_num)[comp_mask]
-            (diff_flux_other, diff_flux_other_err, obj_flux_other,
-                comp_flux_other) = differential_photometry(
-                                flux, fluxerr, cindex, other_comps)
+            cflux, cflux_err = ens.raw(rows[cindex])
+            comp_flux_other, comp_flux_other_err = ens.others(rows[cindex])
+            diff_flux_other, diff_flux_other_err = relative_flux(cflux,
+                    cflux_err, comp_flux_other, comp_flux_other_err)
             
             #Get signal to noise (from oot region if specified)
             signal = np.nanmean(diff_flux_other[:,:,:], axis=2) 
@@ -597,35 +627,81 @@ if __name__ == "__main__":
             
         
             #Plot differential photometry of comparison vs mean of others
-            add_plot(xjd, diff_flux_other[sn_max_bkg_a,sn_max_bkg_b,:],
-                ylabel='Resid. (comp. %d)' %cindex, bintime=(mode(exp)[0][0]),
+            ctx.add_plot(xjd, diff_flux_other[sn_max_bkg_a,sn_max_bkg_b,:],
+                ylabel='Resid. (comp. %d)' %obj_id[cindex], bintime=exp_mode,
                 xoffset=xjd_off, xlabel=plot_time_format,
                 plot_rms=True, xlim=time_axis_limits,
                 ylim=norm_flux_limits, alpha=0.5, inc=False)
             
             #Bin data
             finite_mask = np.isfinite(diff_flux_other[sn_max_bkg_a, sn_max_bkg_b, :])
-            flux_bin = bin_to_size(diff_flux_other[sn_max_bkg_a, sn_max_bkg_b, :], 
-                    binning, block_exp_t, block_ind_bound, finite_mask)
-            xjd_bin = bin_to_size(xjd, binning, block_exp_t, block_ind_bound,
-                    finite_mask)
+            binned, counts = bin_series(xjd, [xjd, diff_flux_other[
+                sn_max_bkg_a, sn_max_bkg_b, :]], binning, mask=finite_mask)
+            xjd_bin, flux_bin = binned[:, counts[0] > 0]
             
             #Plot binned diff. photometry of comparison vs mean of others
-            add_plot(xjd_bin, flux_bin, bintime=binning, xoffset=xjd_off,
+            ctx.add_plot(xjd_bin, flux_bin, bintime=binning, xoffset=xjd_off,
                 plot_rms=True, xlim=time_axis_limits, ylim=norm_flux_limits,
                 c='r', inc=True, hold=True)
     
+    f.close()
+
+    #Write all light curves to one columnar file
+    if p.lc_format != "fits":
+        lcs.write(infile_.replace("_phot.fits", LC_SUFFIX[p.lc_format]),
+                p.lc_format)
+
     #Load field image and save as figure
-    plot_field_image(dir_, field_file, o_num, c_num)
-
-    #Save figures to output pdf
-    with PdfPages(join(dir_, outfile_pdf)) as pdf:
-        for fig in figs:
-            plt.figure(fig.number)
-            #plt.show()
-            pdf.savefig()
-            
-    #Copy params script to dir_
-    copyfile(join(dirname(__file__), 'params.py'), join(dir_, 'params.py'))
+    ctx.plot_field_image(field_file, obj_id[o_num], obj_id[c_num])
+
+    #Finish output pdf, the pages having been written as they were done
+    ctx.close()
+
+    #Copy params script to the photometry directory
+    copyfile(join(dirname(__file__), 'params.py'), join(dirname(infile_),
+        'params.py'))
+
+    return outfile_pdf
+
+
+def _plot_target(args):
+    #Plot one (photometry file, field image, params) in a worker process
+    return plot_photometry(*args)
+
+def plot_targets(targets, p, processes=1):
+    '''Plot each (photometry file, field image) pair of targets with params
+    p, using a pool of processes worker processes if more than one. Returns
+    the names of the PDFs.'''
+
+    jobs = [(infile_, field_file, p) for infile_, field_file in targets]
+    if (processes > 1) and (len(jobs) > 1):
+        pool = Pool(min(processes, len(jobs)))
+        try:
+            return pool.map(_plot_target, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [_plot_target(job) for job in jobs]
+
+
+if __name__ == "__main__":
+
+    #Parse arguments from command line
+    parser = argparse.ArgumentParser(
+        description='Plotting script for photometry produced by SAFPhot')
+    parser.add_argument('dir_in', metavar='dir_in', nargs='+',
+            help='Input directories', type=str, action='store')
+    parser.add_argument('-n', '--processes', help='Number of worker '
+            'processes to plot targets with', type=int, default=1)
+    args = parser.parse_args()
+
+    #Load the list of parameters 
+    p = params.get_params()
+
+    #Plot every photometry file of the input directories
+    targets = []
+    for dir_in in args.dir_in:
+        targets += find_targets(join(dir_in, p.phot_dir), p)
+    plot_targets(targets, p, args.processes)
 
     print("Plotting complete")
@@ -0,0 +1,132 @@
+'''
+Background read-ahead of frames for SAFPhot.
+
+Frame loops in SAFPhot read a frame, process it and then read the next one,
+so the disk is idle while the CPU works and vice versa. The Prefetcher reads
+frames of a frame source ahead of use in reader threads, up to a fixed
+depth, so that reading overlaps with processing. Memory is capped at
+depth + 1 frames. If buffer reuse is enabled the arrays of consumed frames
+are handed back to the readers to be filled again, in which case a frame
+must not be kept by the caller after the next frame has been requested.
+
+More than one reader thread reads several files at once through cfitsio,
+which is only safe if cfitsio was built reentrant (--enable-reentrant), even
+with a separate handle for each file. Otherwise a single reader is used.
+
+fitsio has no public call to read an image into a given array, so frames
+are read into reused buffers through its internal read_image on fitsio
+versions where it is known to exist, and are read and copied otherwise.
+
+'''
+
+import threading
+import numpy as np
+import fitsio
+
+#Whether cfitsio may be used by several threads at once
+REENTRANT = getattr(fitsio, 'cfitsio_is_reentrant', lambda: False)()
+
+#Major versions of fitsio with the internal read_image(ext, array)
+READ_INTO_VERSIONS = ('1',)
+
+class Prefetcher(object):
+
+    def __init__(self, frames, order, depth=4, nthreads=1, reuse=True):
+
+        self.frames = frames
+        self.order = list(order)
+        self.depth = depth
+        self.nthreads = max(nthreads, 1)
+        if (self.nthreads > 1) and not REENTRANT:
+            print("cfitsio is not reentrant, reading frames in one thread.")
+            self.nthreads = 1
+        self.reuse = reuse
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+
+        #Without read-ahead simply read the frames in turn
+        if self.depth < 1:
+            for idx in self.order:
+                data, header = self.frames.read(idx)
+                yield idx, data, header
+            return
+
+        #Frames in flight, including the one being processed
+        self._slots = threading.Semaphore(self.depth + 1)
+        self._lock = threading.Condition()
+        self._next = 0
+        self._results = {}
+        self._buffers = []
+        self._error = None
+        self._stop = False
+
+        threads = [threading.Thread(target=self._reader) for n in
+                range(self.nthreads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            for pos, idx in enumerate(self.order):
+
+                #Wait for the reader threads to deliver this frame
+                with self._lock:
+                    while (pos not in self._results) and (self._error is None):
+                        self._lock.wait()
+                    if self._error is not None:
+                        raise self._error
+                    data, header = self._results.pop(pos)
+
+                yield idx, data, header
+
+                #Hand the buffer back and free the slot for the next frame
+                with self._lock:
+                    if self.reuse:
+                        self._buffers.append(data)
+                self._slots.release()
+        finally:
+            with self._lock:
+                self._stop = True
+            for n in range(self.nthreads):
+                self._slots.release()
+
+    def _reader(self):
+
+        while True:
+
+            #Claim a free slot and then the next frame in order
+            self._slots.acquire()
+            with self._lock:
+                if self._stop or (self._next >= len(self.order)):
+                    return
+                pos = self._next
+                self._next += 1
+                out = self._buffers.pop() if self._buffers else None
+
+            try:
+                data, header = self.frames.read(self.order[pos], out=out)
+            except Exception as e:
+                with self._lock:
+                    self._error = e
+                    self._lock.notify_all()
+                return
+
+            with self._lock:
+                self._results[pos] = (data, header)
+                self._lock.notify_all()
+
+def read_hdu(hdu, out=None):
+    '''Read the image of a fitsio HDU into the reusable buffer out if it has
+    the right shape, otherwise into a new array. On known fitsio versions
+    the image is decompressed and converted straight into out.'''
+    if (out is None) or (tuple(out.shape) != tuple(hdu.get_dims())) or (
+            not out.flags.c_contiguous):
+        return hdu.read()
+    if fitsio.__version__.split('.')[0] in READ_INTO_VERSIONS:
+        hdu._FITS.read_image(hdu._ext + 1, out)
+    else:
+        out[...] = hdu.read()
+    return out
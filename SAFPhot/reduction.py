@@ -33,6 +33,14 @@ def stack_fits(flat_list):
 
     return np.concatenate(stack, axis=0) 
 
+def write_calframe(file_, data, params):
+    #Write a calibration frame, tile compressed if requested. Master frames
+    #are applied to every science frame so they are always stored losslessly
+    if params.compress is None:
+        fitsio.write(file_, data)
+    else:
+        fitsio.write(file_, data, compress='gzip', qlevel=None)
+
 def create_calframes(files, params, verbose=False):
     '''Main function creating calibration frames'''
 
@@ -57,7 +65,7 @@ def create_calframes(files, params, verbose=False):
         bias_frames = stack_fits(files.bias)
         calframes["bias"] = np.mean(bias_frames, axis=0)
         
-        fitsio.write(join(outdir, "bias.fits"), calframes["bias"])
+        write_calframe(bias_, calframes["bias"], params)
         del bias_frames
         
 
@@ -86,7 +94,7 @@ def create_calframes(files, params, verbose=False):
             master_flat = np.mean(flat_stack, axis=0) - calframes["bias"]
             master_flat /= np.median(master_flat)
 
-            fitsio.write(flat_, master_flat)
+            write_calframe(flat_, master_flat, params)
             calframes[flt] = master_flat
 
         if verbose: print("Flat calibration frame is %s" % flat_)
@@ -10,7 +10,8 @@ scripts are as follows:
 
 Mandatory:
     - Input directory: folder containing the calibration and science frames
-    - Mode: mode the pipeline should run in
+    - Mode: mode the pipeline should run in, rephot re-measures chosen
+      objects and frames of existing photometry
 
 Optional:
     - Pattern: prefix pattern for input FITS files, used to select certain
@@ -36,7 +37,8 @@ if __name__ == '__main__':
     parser.add_argument('dir_in', metavar='dir_in', help='Input directory',
             type=str, action='store')
     parser.add_argument('mode', metavar='mode', 
-            help='Mode: [reduction, photometry, both]', type=str, action='store')   
+            help='Mode: [reduction, photometry, both, rephot]', type=str,
+            action='store')   
     parser.add_argument('--p', help='prefix search pattern for input FITS file name',
             type=str, dest='pattern')
     args = parser.parse_args()
@@ -61,10 +63,26 @@ if __name__ == '__main__':
         #Create the calibration master files (returns dict of frames)
         calframes = red.create_calframes(files, par, verbose=True)
 
-        #Unpack + reduce the files
-        up.unpack_reduce(files, calframes, par, verbose=True)
+        if (args.mode == 'both') and par.fused:
 
-    if args.mode in ('both', 'photometry'):
+            #Reduce frames in memory and pass them straight to photometry
+            for item, cubes, filt in up.group_targets(files, par):
+
+                outdir = None
+                if par.write_reduced:
+                    outdir = join(par.out_dir, par.red_dir, item)
+
+                print("Processing frames for photometry on %s" % item) 
+                frames = up.RawFrames(cubes, calframes, filt, par, outdir)
+                ph.run_phot(args.dir_in, pattern, par, item, frames=frames)
+
+        else:
+
+            #Unpack + reduce the files
+            up.unpack_reduce(files, calframes, par, verbose=True)
+
+    if (args.mode == 'photometry') or ((args.mode == 'both') and not
+            par.fused):
  
         #run photometry
         dir_ = join(args.dir_in, par.red_dir)
@@ -76,6 +94,33 @@ if __name__ == '__main__':
                 print("Processing frames for photometry on %s" % item) 
                 ph.run_phot(args.dir_in, pattern, par, item)
 
-    if args.mode not in ('both', 'reduction', 'photometry'):
+    if (args.mode == 'rephot') and par.fused:
+
+        #Reduced frames may not have been written in a fused run, so the raw
+        #frames are reduced again in memory with the existing master frames
+        files = ps.fits_sort(par, args.dir_in, pattern, verbose=True)
+        calframes = red.create_calframes(files, par, verbose=True)
+
+        for item, cubes, filt in up.group_targets(files, par):
+
+            print("Re-measuring photometry on %s" % item)
+            frames = up.RawFrames(cubes, calframes, filt, par)
+            ph.run_phot(args.dir_in, pattern, par, item, frames=frames,
+                    rephot=True)
+
+    elif args.mode == 'rephot':
+
+        #Re-measure chosen objects and frames, merging into the photometry
+        dir_ = join(args.dir_in, par.red_dir)
+
+        for root, dirs, files in walk(dir_):
+
+            for item in dirs:
+
+                print("Re-measuring photometry on %s" % item)
+                ph.run_phot(args.dir_in, pattern, par, item, rephot=True)
+
+    if args.mode not in ('both', 'reduction', 'photometry', 'rephot'):
 
-        print('Please specify SAFPhot run mode: [reduction, photometry, both]')
+        print('Please specify SAFPhot run mode: [reduction, photometry, both, '
+                'rephot]')
@@ -0,0 +1,123 @@
+'''
+Centroid based frame registration for SAFPhot.
+
+A cheaper alternative to Donuts for bright, well-separated fields. The
+position of a handful of bright reference objects is predicted from the
+shifts of the previous frames and refined with a small windowed centroid, so
+the cost per frame depends on the number of tracked objects rather than the
+sensor size. If the centroids of the tracked objects disagree by more than
+the allowed residual the measurement is rejected and the caller is expected
+to fall back to Donuts.
+
+'''
+
+import numpy as np
+
+def window_centroid(data, x, y, hw):
+    '''Intensity weighted centroid of each object in a (2*hw+1) pixel square
+    window around (x, y), after removing the median of the window. Returns
+    x, y and the summed flux, with nan for windows off the frame.'''
+
+    xc = np.full(len(x), np.nan)
+    yc = np.full(len(x), np.nan)
+    fc = np.full(len(x), np.nan)
+
+    for k in range(len(x)):
+
+        if not (np.isfinite(x[k]) and np.isfinite(y[k])): continue
+
+        #Window limits, skipping windows which are not fully on the frame
+        xa, ya = int(round(x[k])) - hw, int(round(y[k])) - hw
+        xb, yb = xa + 2*hw + 1, ya + 2*hw + 1
+        if (xa < 0) or (ya < 0) or (xb > data.shape[1]) or (yb > data.shape[0]):
+            continue
+
+        #Subtract the local sky and ignore negative pixels
+        win = data[ya:yb, xa:xb].astype(float)
+        win = win - np.median(win)
+        win[win < 0] = 0
+        total = np.sum(win)
+        if total <= 0: continue
+
+        xc[k] = xa + np.sum(win.sum(axis=0) * np.arange(win.shape[1])) / total
+        yc[k] = ya + np.sum(win.sum(axis=1) * np.arange(win.shape[0])) / total
+        fc[k] = total
+
+    return xc, yc, fc
+
+class CentroidTracker(object):
+
+    def __init__(self, ref, x_ref, y_ref, nstars=8, hw=6, max_resid=0.5,
+            history=5):
+
+        self.hw = hw
+        self.max_resid = max_resid
+        self.history = history
+
+        #Shifts of previously registered frames as (frame index, x, y)
+        self.past = []
+
+        #Measure the catalogue objects on the reference frame
+        x0, y0, f0 = window_centroid(ref, x_ref, y_ref, hw)
+
+        #Only track objects without a neighbour inside two windows
+        isolated = np.ones(len(x_ref), dtype=bool)
+        if len(x_ref) > 1:
+            dist = np.hypot(x_ref[:, None] - x_ref[None, :],
+                    y_ref[:, None] - y_ref[None, :])
+            np.fill_diagonal(dist, np.inf)
+            isolated = np.min(dist, axis=1) > 2*(2*hw + 1)
+
+        #Keep the brightest usable objects
+        usable = np.where(isolated & np.isfinite(f0))[0]
+        keep = usable[np.argsort(f0[usable])[::-1][:nstars]]
+        self.x_ref = x0[keep]
+        self.y_ref = y0[keep]
+
+    def predict(self, index):
+        '''Predict the shift of a frame from a linear fit to the most recent
+        registered frames.'''
+
+        if len(self.past) == 0:
+            return 0.0, 0.0
+
+        recent = np.array(self.past[-self.history:])
+        if len(np.unique(recent[:, 0])) < 2:
+            return recent[-1, 1], recent[-1, 2]
+
+        px = np.polyfit(recent[:, 0], recent[:, 1], 1)
+        py = np.polyfit(recent[:, 0], recent[:, 2], 1)
+        return np.polyval(px, index), np.polyval(py, index)
+
+    def measure(self, data, index):
+        '''Measure the shift of a frame with respect to the reference frame,
+        using the same sign convention as Donuts (reference minus frame).
+        Returns None if the shift could not be measured reliably.'''
+
+        if len(self.x_ref) < 3:
+            return None
+
+        #Predicted positions, refined twice to recentre the windows
+        sx, sy = self.predict(index)
+        x, y = self.x_ref - sx, self.y_ref - sy
+        for i in range(2):
+            x, y, f = window_centroid(data, x, y, self.hw)
+
+        #Shift of each tracked object and scatter about the median
+        dx = self.x_ref - x
+        dy = self.y_ref - y
+        good = np.isfinite(dx) & np.isfinite(dy)
+        if np.sum(good) < 3:
+            return None
+
+        shift_x = np.median(dx[good])
+        shift_y = np.median(dy[good])
+        resid = np.median(np.hypot(dx[good] - shift_x, dy[good] - shift_y))
+        if resid > self.max_resid:
+            return None
+
+        return shift_x, shift_y
+
+    def update(self, index, shift_x, shift_y):
+        #Record the shift of a registered frame for future predictions
+        self.past.append((index, shift_x, shift_y))
@@ -1,3 +1,6 @@
+import threading
+import numpy as np
+
 from os.path import join, exists, basename
 from os import makedirs
 from astropy.time import Time, TimeDelta
@@ -5,6 +8,13 @@ from astropy import coordinates as coord, units as u
 from astropy.io import fits
 from copy import copy
 from glob import glob
+from io import BytesIO
+from prefetch import Prefetcher # SAFPhot script
+from ephemeris import Ephemeris # SAFPhot script
+
+#Tile compression algorithms, as named by astropy
+COMPRESSION_TYPES = {"RICE":"RICE_1", "HCOMPRESS":"HCOMPRESS_1",
+        "GZIP":"GZIP_1"}
 
 class Mapper():
     def __init__(self, hdr, p, keylist):
@@ -20,22 +30,6 @@ class Mapper():
                 pass
  
 
-def get_airmass(jd, ra, dec, loc):
-    
-    #Get time in correct format
-    time = Time(jd, format='jd', scale='utc', location=loc)
-    
-    #Get object sky coords in correct format
-    coords = coord.SkyCoord(ra, dec, unit=(u.hourangle, u.deg), frame='icrs')
-    
-    #Convert coords to AltAz
-    altaz = coords.transform_to(coord.AltAz(obstime=time,location=loc))
-
-    #Get airmass
-    airmass = altaz.secz.value
-
-    return airmass
-
 def correct_time(header, frame_num, m, deadtime=0.00676):
     '''Function to correct time of each frame to mid-exposure time'''
 
@@ -47,7 +41,7 @@ def correct_time(header, frame_num, m, deadtime=0.00676):
         + ((m.exposure + deadtime) * 0.5)), format='sec')
     return t + dt
 
-def convert_jd_hjd(jd, ra, dec, loc):
+def convert_jd_bjd(jd, ra, dec, loc):
    
     #Get RA and DEC
     ra = ra.replace(" ", ":")
@@ -61,100 +55,242 @@ def convert_jd_hjd(jd, ra, dec, loc):
     times = Time(jd, format='jd', scale='utc', location=loc)
 
     #Define light travel time
-    ltt_helio = times.light_travel_time(coords, 'heliocentric')
+    ltt_bary = times.light_travel_time(coords)
 
-    #Correct JD to HJD
-    hjd = times.utc + ltt_helio
-    return hjd.jd
+    #Correct JD to BJD
+    bjd = times.tdb + ltt_bary
+    return bjd.jd
 
-def convert_jd_bjd(jd, ra, dec, loc):
+def target_dir(master_outdir, target):
+    #Create name of directory within reduction subfolder for a target
+    outdir = join(master_outdir, target)
+    outdir = outdir.replace(' - ', '_')
+    outdir = outdir.replace(' ', '_')
+    outdir = outdir.replace('(', '').replace(')','')
+    outdir = outdir.replace('\'', '_prime')
+    return outdir
+
+def open_cube(file_, params):
+    '''Open a raw data cube and map the header keywords needed to time
+    stamp its frames. The start time is the GPS start time (DATEOBS
+    keyword) where the cube has one, and otherwise the time the first frame
+    was written (FRAME) less one exposure. Earlier versions always used the
+    latter, so the times of cubes with a GPS start time differ from theirs.'''
+
+    #Open master files
+    f = fits.open(file_) 
+    prihdr = copy(f[0].header) 
    
-    #Get RA and DEC
-    ra = ra.replace(" ", ":")
-    dec = dec.replace(" ", ":")
+    #Try and map parameters to header keywords otherwise set the keyword
+    keylist = {'ra', 'dec', 'dateobs', 'exposure'}
+    m = Mapper(prihdr, params, keylist)
 
-    #Get object sky coords in correct format
-    coords = coord.SkyCoord(ra, dec,
-                unit=(u.hourangle, u.deg), frame='icrs')
+    #If GPSSTART time is missing, calculate it from time file was written
+    if (params.dateobs not in prihdr) or (m.dateobs in ('', 'NA')):
+        frame_time = Time([prihdr['FRAME']], format='isot', scale='utc',
+                precision=7)
+        dt_exp = TimeDelta(val=m.exposure, format='sec')
+        cal_gps_time = (frame_time - dt_exp).isot[0]
+        m.dateobs = cal_gps_time
+        prihdr[params.dateobs] = cal_gps_time
 
-    #Define JD as time object
-    times = Time(jd, format='jd', scale='utc', location=loc)
+    return f, prihdr, m
 
-    #Define light travel time
-    ltt_bary = times.light_travel_time(coords)
+def cube_times(prihdr, m, nframes, ephem):
+    '''JD, HJD, BJD and airmass of every frame of a raw data cube, computed
+    for the whole cube at once.'''
 
-    #Correct JD to BJD
-    bjd = times.tdb + ltt_bary
-    return bjd.jd
+    jd = correct_time(prihdr, np.arange(nframes), m).jd
+    hjd, bjd, airmass = ephem.evaluate(jd)
+    return jd, hjd, bjd, airmass
+
+def reduce_frame(raw, prihdr, calframes, filt, times, out=None):
+    '''Reduce a frame of a raw data cube and create its header from the
+    frame's JD, HJD, BJD and airmass. The reduced frame is written into out
+    if a buffer of the right shape is given.'''
+
+    #Reduce data
+    if (out is None) or (out.shape != raw.shape):
+        red_data = ( raw - calframes['bias'] ) / calframes[filt]
+    else:
+        red_data = np.subtract(raw, calframes['bias'], out=out)
+        np.divide(red_data, calframes[filt], out=red_data)
+
+    #Create new header
+    temp_header = copy(prihdr)
+    jd, hjd, bjd, airmass = times
+    temp_header['JD'] = jd
+    temp_header['HJD'] = hjd
+    temp_header['BJD'] = bjd
+    temp_header['AIRMASS'] = airmass
+
+    return red_data, temp_header
+
+def group_targets(files, params):
+    '''Group the raw science cubes by the reduction sub-directory of their
+    target. Returns a list of (sub-directory name, cube files, filter).'''
+
+    master_outdir = join(params.out_dir , params.red_dir) 
+    groups = {}
+
+    for file_, target, filt in zip(files.target, files.target_name,
+            files.target_filter):
+        name = basename(target_dir(master_outdir, target))
+        groups.setdefault(name, ([], filt))[0].append(file_)
+
+    return [(name, sorted(groups[name][0]), groups[name][1]) for name in
+            sorted(groups)]
+
+def write_frame(path, data, header, params):
+    '''Write a reduced frame as its own FITS file, tile compressed in the
+    first extension if requested. Integer valued data are stored losslessly
+    as integers, other data are quantised with COMPRESS_QLEVEL.'''
+
+    if params.compress is None:
+        hdu = fits.PrimaryHDU(data, header=header)
+        hdu.writeto(path)
+        return
+
+    if np.array_equal(data, np.round(data)) and (np.max(np.abs(data)) <
+            2**31):
+        data = data.astype(np.int32)
+
+    hdu = fits.CompImageHDU(data, header=header,
+            compression_type=COMPRESSION_TYPES[params.compress],
+            quantize_level=params.compress_qlevel)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path)
+
+def fits_buffer(data, header):
+    '''Write a frame to an in-memory FITS file, which can be opened in place
+    of a file name.'''
+    buf = BytesIO()
+    fits.PrimaryHDU(data, header=header).writeto(buf)
+    buf.seek(0)
+    return buf
+
+class RawFrames(object):
+    '''Frames of one or more raw data cubes of a target, reduced in memory
+    as they are read so photometry can run without the reduction directory.
+    If outdir is given the reduced frames are also written there.'''
+
+    def __init__(self, cube_files, calframes, filt, params, outdir=None):
+
+        self.calframes = calframes
+        self.filt = filt
+        self.params = params
+        self.outdir = outdir
+
+        #Retrieve Earth coords of telescope, use SALT
+        self.loc = coord.EarthLocation.of_site('SALT')
+
+        #Lock shared by threads reading from the open cubes
+        self.lock = threading.Lock()
+
+        #Ephemeris of each target, cached in the ephemeris directory
+        self.ephem = {}
+        ephem_dir = join(params.out_dir, params.ephem_dir)
+
+        #Open the cubes, index frames as (cube number, frame number) and
+        #time stamp all frames of each cube at once
+        self.cubes = []
+        self.index = []
+        self.times = []
+        for n, file_ in enumerate(cube_files):
+            f, prihdr, m = open_cube(file_, params)
+            self.cubes.append((file_, f, prihdr, m))
+            self.index += [(n, count) for count in range(f[0].shape[0])]
+            if (m.ra, m.dec) not in self.ephem:
+                self.ephem[(m.ra, m.dec)] = Ephemeris(m.ra, m.dec, self.loc,
+                        params.ephem_step, ephem_dir)
+            self.times.append(cube_times(prihdr, m, f[0].shape[0],
+                self.ephem[(m.ra, m.dec)]))
+
+        if (outdir is not None) and not exists(outdir):
+            makedirs(outdir)
+
+    def __len__(self):
+        return len(self.index)
+
+    def name(self, idx):
+        #File name of reduced frame idx
+        n, count = self.index[idx]
+        return basename(self.cubes[n][0]).replace('.fits',
+                '.%04d.fits' % (count+1))
+
+    def read(self, idx, out=None):
+        #Reduce frame idx, writing it to outdir if requested
+        n, count = self.index[idx]
+        file_, f, prihdr, m = self.cubes[n]
+
+        #Read only this frame from the cube, one reader at a time
+        with self.lock:
+            raw = f[0].section[count, :, :]
+
+        times = [t[count] for t in self.times[n]]
+        red_data, temp_header = reduce_frame(raw, prihdr, self.calframes,
+                self.filt, times, out=out)
+
+        if self.outdir is not None:
+            fname = self.name(idx)
+            if not exists(join(self.outdir, fname)):
+                write_frame(join(self.outdir, fname), red_data, temp_header,
+                        self.params)
+
+        return red_data, temp_header
+
+    def donuts_input(self, idx, data, header):
+        #Donuts reads the frame from an in-memory FITS file
+        return fits_buffer(data, header)
+
+    def donuts_ext(self):
+        #Extension of the Donuts input holding the image
+        return 0
+
+    def timing(self, idx, jd_key, exp_key):
+        #Mid-exposure JD and exposure time of frame idx, without reducing it
+        n, count = self.index[idx]
+        file_, f, prihdr, m = self.cubes[n]
+        return self.times[n][0][count], prihdr[exp_key]
+
+    def close(self):
+        for file_, f, prihdr, m in self.cubes:
+            f.close()
 
 def unpack_reduce(files, calframes, params, verbose=True):
 
     #prepare for unpacking process
     master_outdir = join(params.out_dir , params.red_dir) 
 
-    #Retrieve Earth coords of telescope, use SALT
-    loc = coord.EarthLocation.of_site('SALT')
-
     for file_, target, filt in zip(files.target, files.target_name,
             files.target_filter):    
 
         if verbose: print("Unpacking %s: %s " % (target, file_))
 
         #Create directory within reduction subfolder
-        outdir = join(master_outdir, target)
-        outdir = outdir.replace(' - ', '_')
-        outdir = outdir.replace(' ', '_')
-        outdir = outdir.replace('(', '').replace(')','')
-        outdir = outdir.replace('\'', '_prime')
+        outdir = target_dir(master_outdir, target)
 
         if not exists(outdir): 
             makedirs(outdir)
             if verbose: print("%s folder created." % outdir)
             
-        #Open master files
-        f = fits.open(file_) 
-        prihdr = copy(f[0].header) 
-       
-        #Try and map parameters to header keywords otherwise set the keyword
-        keylist = {'ra', 'dec', 'dateobs', 'exposure'}
-        m = Mapper(prihdr, params, keylist)
-
-        #If GPSSTART time is missing, calculate it from time file was written
-        if (m.dateobs == '', m.dateobs == 'NA'):
-            frame_time = Time([prihdr['FRAME']], format='isot', scale='utc',
-                    precision=7)
-            dt_exp = TimeDelta(val=m.exposure, format='sec')
-            cal_gps_time = (frame_time - dt_exp).isot[0]
-            m.dateobs = cal_gps_time
-            prihdr['GPSSTART'] = cal_gps_time
-        
-        #Counter to track how many files were skipped
-        count_skip = 0 
-
-        #Iterate through individual HDUs of master file
-        for count in range(0, f[0].data.shape[0]):
-            
-            fname = basename(file_).replace('.fits', '.%04d.fits' % (count+1))
+        #Open master file
+        frames = RawFrames([file_], calframes, filt, params)
 
-            if not exists(join(outdir, fname)): 
+        #Only reduce frames which have not already been written
+        todo = [idx for idx in range(len(frames)) if not
+                exists(join(outdir, frames.name(idx)))]
+        count_skip = len(frames) - len(todo)
 
-                #Reduce data
-                red_data = ( f[0].data[count, :, :] - calframes['bias'] ) / calframes[filt]
-            
-                #Create new header
-                temp_header = copy(prihdr)
-                newtime = correct_time(temp_header, count, m)        
-                temp_header['JD'] = newtime.jd
-                temp_header['HJD'] = convert_jd_hjd(newtime.jd, m.ra, m.dec, loc)
-                temp_header['BJD'] = convert_jd_bjd(newtime.jd, m.ra, m.dec, loc)
-                temp_header['AIRMASS'] = get_airmass(newtime.jd, m.ra, m.dec, loc)
-            
-                #Write HDU as its own FITS
-                hdu = fits.PrimaryHDU(red_data, header=temp_header)
-                hdu.writeto(join(outdir, fname))
-                f.close()
+        #Iterate through individual frames of master file, read ahead
+        for idx, red_data, temp_header in Prefetcher(frames, todo,
+                params.prefetch_depth, params.prefetch_threads,
+                params.prefetch_reuse):
+
+            #Write HDU as its own FITS
+            write_frame(join(outdir, frames.name(idx)), red_data,
+                    temp_header, params)
 
-            else: count_skip += 1
+        frames.close()
 
         if count_skip > 0: print("%i files skipped because they already exist."
                 % count_skip)
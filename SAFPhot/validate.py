@@ -70,6 +70,16 @@ def int_positive(num):
         if num >= 0:
             return True
     else: return False 
+
+def int_positive_or_none(num):
+
+    if num is None:
+        return True
+    return bool(int_positive(num))
+
+def int_nonzero(num):
+
+    return bool(int_positive(num)) and (num >= 1)
     
 def list_int(list_):
 
@@ -80,6 +90,12 @@ def list_int(list_):
         
     return result 
 
+def list_int_or_none(list_):
+
+    if list_ is None:
+        return True
+    return list_int(list_)
+
 def list_float_or_none(list_):
     
     result = True
@@ -104,6 +120,11 @@ def check_string(string):
         return True
     else: return False 
 
+def string_or_none(value):
+    if check_string(value) or value is None:
+        return True
+    else: return False
+
 def string_or_float(value):
 
     if check_string(value) or type(value) == float:
@@ -115,6 +136,46 @@ def string_or_int(value):
         return True
     else: return False
 
+#Keywords which may be changed in extra photometry parameter sets
+SET_KEYS = ["RADII", "SUBPIX", "RMAX", "BOX_SIZE", "FILTER_SIZE",
+        "SOURCE_THRESH", "BKG_APP_RAD", "NUM_BKG_APPS"]
+
+def param_sets(sets):
+    #None, or a dict of labelled dicts of keyword overrides
+    if sets is None: return True
+    if type(sets) != dict: return False
+    for label, overrides in sets.items():
+        if not (check_string(label) and type(overrides) == dict):
+            return False
+        for key, value in overrides.items():
+            if (key not in SET_KEYS) or not Validator._keylist[key](value):
+                return False
+    return True
+
+def one_of(*options):
+    #Build a check that the value is one of the allowed options
+    def check_option(value):
+        return value in options
+    return check_option
+
+def list_of_or_none(*options):
+    #Build a check that the value is None or a list of the allowed options
+    def check_options(value):
+        if value is None:
+            return True
+        return type(value) == list and all(item in options for item in value)
+    return check_options
+
+def per_target(check):
+    #Build a check that the value passes check, or is a dict of such values
+    #by target name
+    def check_targets(value):
+        if type(value) == dict:
+            return all(check_string(name) and bool(check(item)) for name,
+                    item in value.items())
+        return bool(check(value))
+    return check_targets
+
 class Validator(object): 
        
     _keylist = { "PLATESCALE":float_positive,
@@ -127,6 +188,28 @@ class Validator(object):
                 "SOURCE_THRESH":float_or_int_positive,
                 "BKG_APP_RAD":float_or_int_positive,
                 "NUM_BKG_APPS":float_or_int_positive,
+                "PHOT_MODE":one_of("full", "stamp"),
+                "STAMP_SIZE":int_nonzero,
+                "BKG_SEARCH":one_of("full", "adaptive"),
+                "BKG_SEARCH_FRAMES":int_positive,
+                "BKG_SEARCH_KEEP":int_nonzero,
+                "BKG_SEARCH_RETEST":float_positive_or_none,
+                "TRACKER":one_of("donuts", "centroid"),
+                "TRACKER_STARS":int_positive,
+                "TRACKER_WINDOW":int_positive,
+                "TRACKER_MAX_RESID":float_positive,
+                "COADD":int_nonzero,
+                "COADD_WINDOW":float_positive_or_none,
+                "PARAM_SETS":param_sets,
+                "CHECKPOINT_EVERY":int_positive_or_none,
+                "REPHOT_OBJECTS":list_int_or_none,
+                "REPHOT_TIME_RANGE":list_float_or_none,
+                "FRAME_GATE":check_bool,
+                "GATE_STARS":int_positive,
+                "GATE_WINDOW":int_positive,
+                "GATE_SKY_MAX":float_positive_or_none,
+                "GATE_FLUX_MIN":float_positive_or_none,
+                "GATE_SATURATION":float_positive_or_none,
                 "DATEOBS":check_string, 
                 "OBSERVER":check_string,
                 "OBSERVATORY":check_string,
@@ -147,6 +230,7 @@ class Validator(object):
                 "JD":check_string,
                 "HJD":check_string,
                 "BJD":check_string,
+                "EPHEM_STEP":float_positive,
                 "LAT":string_or_float,
                 "LON":string_or_float,
                 "ALT":string_or_float,
@@ -154,18 +238,32 @@ class Validator(object):
                 "OUT_DIR":check_string,
                 "RED_DIR":check_string,
                 "CAL_DIR":check_string,
+                "EPHEM_DIR":check_string,
+                "FIELD_CAT_DIR":string_or_none,
                 "PHOT_DIR":check_string,
                 "PHOT_PREFIX":check_string,
                 "RED_PREFIX":check_string,
+                "FUSED":check_bool,
+                "WRITE_REDUCED":check_bool,
+                "PREFETCH_DEPTH":int_positive,
+                "PREFETCH_THREADS":int_positive,
+                "PREFETCH_REUSE":check_bool,
+                "COMPRESS":one_of(None, "RICE", "HCOMPRESS", "GZIP"),
+                "COMPRESS_QLEVEL":float_positive,
                 "BIASID":check_string,
                 "FLATID":check_string,
                 "OBSTYPE":check_string,
-                "TARGET_OBJECT_NUM":int_positive,
-                "COMPARISON_OBJECT_NUMS":list_int,
+                "TARGET_OBJECT_NUM":per_target(int_positive),
+                "COMPARISON_OBJECT_NUMS":per_target(list_int),
+                "AUTO_COMPARISONS":int_positive_or_none,
                 "NORM_FLUX_LIMITS":list_float_or_none,
                 "TIME_AXIS_LIMITS":list_float_or_none,
                 "PLOT_TIME_FORMAT":check_string,
                 "BINNING":int_positive,
+                "LC_FORMAT":one_of("fits", "table", "arrow"),
+                "DETREND":list_of_or_none("AIRMASS", "FWHM", "CCD_X", "CCD_Y",
+                    "BKG"),
+                "DETREND_ORDER":int_positive,
                 "PREDICTED_INGRESS":float_positive_or_none,
                 "PREDICTED_EGRESS":float_positive_or_none,
                 "ACTUAL_INGRESS":float_positive_or_none,
@@ -176,6 +274,7 @@ class Validator(object):
                 "NROWS":int_positive,
                 "FIGSIZE":tuple_two,
                 "DPI":int_positive,
+                "PLOT_DENSITY_POINTS":int_positive_or_none,
                 "PHOT_FILE_IN":check_string,
                 "FIELD_IMAGE_IN":check_string
                }
@@ -198,6 +297,16 @@ class Validator(object):
                     raise KeyValueError("%s is not a valid value for %s" %
                                             (pardict[key], key))
 
+            #Background boxes larger than the stamps would all be clipped to
+            #the stamp size, measuring the same bkg params more than once
+            if self.phot_mode == "stamp":
+                boxes = list(self.box_size)
+                for overrides in (self.param_sets or {}).values():
+                    boxes += overrides.get("BOX_SIZE", [])
+                if max(boxes) > self.stamp_size:
+                    raise KeyValueError("BOX_SIZE %s is larger than STAMP_SIZE"
+                            " %s" % (max(boxes), self.stamp_size))
+
         else: 
 
             if len(set_pardict) > len(set_keylist):
@@ -207,6 +316,22 @@ class Validator(object):
                 raise KeyMissingError("The following keys are required: %s" % 
                         ', '.join(set_keylist - set_pardict))
 
+    def object_nums(self, target):
+        '''Target and comparison object numbers of the target name, from
+        its entries where TARGET_OBJECT_NUM or COMPARISON_OBJECT_NUMS are
+        dicts by target name. Comparisons may be left out of the dict with
+        AUTO_COMPARISONS.'''
+
+        o_num, c_num = self.target_object_num, self.comparison_object_nums
+        if type(o_num) == dict:
+            assert target in o_num, "No TARGET_OBJECT_NUM for %s" % target
+            o_num = o_num[target]
+        if type(c_num) == dict:
+            assert (target in c_num) or (self.auto_comparisons is not None), \
+                    "No COMPARISON_OBJECT_NUMS for %s" % target
+            c_num = c_num.get(target, [])
+        return o_num, list(c_num)
+
 
 class ValidateFits(object):
 
@@ -1,7 +1,42 @@
 import unittest
-import sys; sys.path.append("..")
+import tempfile
+import shutil
+import random
+import fitsio
+import numpy as np
+import matplotlib; matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import sys; sys.path.append(".."); sys.path.append("../utilities")
+
+from glob import glob
+from os import remove
 
 from validate import Validator, KeyValueError, KeyMissingError, KeyNotKnownError
+from params import get_params
+from tracker import CentroidTracker
+from prefetch import Prefetcher, read_hdu
+import prefetch
+from coadd import CoAdd, coadd_groups
+from ephemeris import Ephemeris
+from unpack import convert_jd_bjd, write_frame, open_cube, correct_time
+from reduction import write_calframe
+from astropy import coordinates as coord
+from astropy.time import Time
+from fieldcat import match_offset, load_catalogue
+from gate import FrameGate, GATE_SKY, GATE_FLUX
+from ensemble import CompEnsemble
+from photfile import PhotFile
+from phot import (welford_update, flux_stats, select_bkg_params, run_phot,
+        ReducedFrames, build_obj_cat, rephot_objects)
+from binning import bin_series
+from detrend import Detrender
+from compselect import select_comparisons
+from plot import (PlotContext, mode_exposure, update_table, find_targets,
+        plot_photometry)
+from lcexport import LightCurveSet, read_lightcurves
+import lcexport
+from astropy.table import Table
+from convert import convert_file
 
 class TestParams(unittest.TestCase): 
 
@@ -21,6 +56,781 @@ class TestParams(unittest.TestCase):
         with self.assertRaises(KeyNotKnownError):
             Validator(d)
 
+    def test_par_option(self):
+        '''Test to check that a value outside of the allowed options for a 
+        keyword raises the correct exception.'''
+        d = dict((k.upper(), v) for k, v in vars(get_params()).items())
+        d["PHOT_MODE"] = "annulus"
+        with self.assertRaises(KeyValueError):
+            Validator(d)
+
+    def test_par_stamp_box(self):
+        '''Test that bkg boxes larger than the stamps are rejected in stamp
+        mode, also in extra parameter sets.'''
+        d = dict((k.upper(), v) for k, v in vars(get_params()).items())
+        d["PHOT_MODE"] = "stamp"
+        d["BOX_SIZE"] = [16, 32]
+        d["STAMP_SIZE"] = 32
+        Validator(d)
+        d["PARAM_SETS"] = {"big":{"BOX_SIZE":[64]}}
+        with self.assertRaises(KeyValueError):
+            Validator(d)
+        d["PARAM_SETS"] = None
+        d["BOX_SIZE"] = [16, 64]
+        with self.assertRaises(KeyValueError):
+            Validator(d)
+
+    def test_par_zero(self):
+        '''Test that counts and sizes which must be at least one are rejected
+        when zero.'''
+        for key in ["COADD", "STAMP_SIZE", "BKG_SEARCH_KEEP"]:
+            d = dict((k.upper(), v) for k, v in vars(get_params()).items())
+            d[key] = 0
+            with self.assertRaises(KeyValueError):
+                Validator(d)
+
+
+class TestTracker(unittest.TestCase):
+
+    def frame(self, xs, ys):
+        yy, xx = np.mgrid[0:200, 0:200]
+        im = np.full((200, 200), 100.0)
+        for x, y in zip(xs, ys):
+            im += 1000.0 * np.exp(-((xx-x)**2 + (yy-y)**2) / 8.0)
+        return im
+
+    def test_tracker_shift(self):
+        '''Test that the centroid tracker recovers a known frame shift with
+        the same sign convention as Donuts.'''
+        xs = np.array([30.0, 80.0, 150.0, 60.0, 170.0])
+        ys = np.array([40.0, 150.0, 60.0, 90.0, 170.0])
+        t = CentroidTracker(self.frame(xs, ys), xs, ys)
+        shift = t.measure(self.frame(xs + 1.5, ys - 2.0), 1)
+        self.assertAlmostEqual(shift[0], -1.5, places=1)
+        self.assertAlmostEqual(shift[1], 2.0, places=1)
+
+
+class CountFrames(object):
+    #Minimal frame source returning frames filled with their index
+    def __len__(self):
+        return 50
+    def read(self, idx, out=None):
+        data = np.empty((4, 4)) if out is None else out
+        data[:] = idx
+        return data, {"IDX": idx}
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_prefetch_order(self):
+        '''Test that frames read ahead by several threads are returned in the
+        requested order, with and without buffer reuse.'''
+        order = list(range(49, -1, -3))
+        for depth, reuse in [(0, True), (1, False), (4, True)]:
+            seen = [(idx, data[0, 0], header["IDX"]) for idx, data, header in
+                    Prefetcher(CountFrames(), order, depth, 3, reuse)]
+            self.assertEqual(seen, [(i, float(i), i) for i in order])
+
+    def test_read_hdu(self):
+        '''Test that plain and tile compressed frames are read into a buffer
+        of the right shape, also on fitsio versions without the internal
+        read, and into a new array otherwise.'''
+        data = np.arange(60, dtype=np.float32).reshape(6, 10)
+        self.addCleanup(setattr, prefetch, 'READ_INTO_VERSIONS',
+                prefetch.READ_INTO_VERSIONS)
+        with tempfile.NamedTemporaryFile(suffix='.fits') as tmp:
+            for compress, ext in [(None, 0), ('GZIP', 1)]:
+                fitsio.write(tmp.name, data, compress=compress, qlevel=None,
+                        clobber=True)
+                with fitsio.FITS(tmp.name) as f:
+                    for versions in [('1',), ()]:
+                        prefetch.READ_INTO_VERSIONS = versions
+                        out = np.zeros((6, 10))
+                        self.assertIs(read_hdu(f[ext], out), out)
+                        np.testing.assert_array_equal(out, data)
+                    new = read_hdu(f[ext], np.zeros((5, 10)))
+                    np.testing.assert_array_equal(new, data)
+
+
+class TestCompress(unittest.TestCase):
+
+    def test_round_trip(self):
+        '''Test that compressed master frames and integer valued reduced
+        frames are read back exactly and that float reduced frames are
+        quantised to well within their noise.'''
+        p = get_params()
+        p.compress = "RICE"
+        rng = np.random.RandomState(5)
+        master = rng.normal(1.0, 0.01, (40, 50))
+        counts = np.round(rng.normal(500, 20, (40, 50)))
+        reduced = counts / master
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        write_calframe(tmp + '/flat.fits', master, p)
+        np.testing.assert_array_equal(fitsio.read(tmp + '/flat.fits'), master)
+        for k, data in enumerate([counts, reduced]):
+            write_frame(tmp + '/frame%d.fits' % k, data, None, p)
+        np.testing.assert_array_equal(fitsio.read(tmp + '/frame0.fits'),
+                counts)
+        resid = fitsio.read(tmp + '/frame1.fits') - reduced
+        self.assertLess(np.max(np.abs(resid)), 20. / p.compress_qlevel)
+
+
+class TestCoAdd(unittest.TestCase):
+
+    def test_coadd_window(self):
+        '''Test that frames are grouped by time window and that a co-added
+        group gets the mid-time of the group and the summed exposure.'''
+        exp = np.full(7, 2.0)
+        jd = 2458000.0 + (1.0 + 2.0*np.arange(7)) / 86400.
+        groups = coadd_groups(7, jd=jd, exp=exp, window=6.0)
+        self.assertEqual(groups, [[0, 1, 2], [3, 4, 5], [6]])
+
+        stack = CoAdd(3)
+        for k in groups[1]:
+            frame = np.zeros((20, 20))
+            frame[10, 10 - k] = 1.0
+            stack.add(frame, float(k), 0.0, exp[k], jd[k], jd[k], jd[k], 1.0)
+        data, shift, times = stack.result()
+        self.assertEqual(data[10, 7], 3.0)
+        self.assertEqual(shift, (3.0, 0.0))
+        self.assertEqual(times[0], 6.0)
+        self.assertAlmostEqual((times[1] - 2458000.0) * 86400., 9.0, places=3)
+
+
+class TestCube(unittest.TestCase):
+
+    def test_start_time(self):
+        '''Test that cubes are timed from their GPS start time, or from the
+        time the first frame was written less one exposure if they have no
+        GPS start time.'''
+        p = get_params()
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        header = {'EXPOSURE':2.0, 'FRAME':'2019-06-19T12:00:02.000',
+                'OBJRA':'10:00:00', 'OBJDEC':'-30:00:00'}
+        for gps, start in [(None, '2019-06-19T12:00:00.000'),
+                ('2019-06-19T11:59:59.500', '2019-06-19T11:59:59.500')]:
+            if gps is not None:
+                header['GPSSTART'] = gps
+            fitsio.write(tmp + '/cube.fits', np.zeros((3, 4, 4)),
+                    header=header, clobber=True)
+            f, prihdr, m = open_cube(tmp + '/cube.fits', p)
+            f.close()
+            self.assertEqual(Time(m.dateobs).isot, start)
+            self.assertEqual(prihdr['GPSSTART'], m.dateobs)
+            jd = correct_time(prihdr, np.arange(3), m).jd
+            self.assertAlmostEqual((jd[0] - Time(start).jd) * 86400., 1.00338,
+                    places=3)
+
+
+class TestEphemeris(unittest.TestCase):
+
+    def test_ephemeris_bjd(self):
+        '''Test that the interpolated BJD agrees with the exact conversion to
+        well below a millisecond.'''
+        loc = coord.EarthLocation.from_geodetic(20.810808, -32.375823, 1798.0)
+        jd = 2458850.3 + np.linspace(0, 0.3, 7)
+        bjd = Ephemeris("05 35 17.3", "-05 23 28", loc).bjd(jd)
+        exact = convert_jd_bjd(jd, "05 35 17.3", "-05 23 28", loc)
+        self.assertLess(np.max(np.abs(bjd - exact)) * 86400., 1e-3)
+
+    def test_ephemeris_airmass(self):
+        '''Test that the interpolated airmass with the default step is within
+        1e-4 of the exact airmass up to an airmass of 3.'''
+        loc = coord.EarthLocation.from_geodetic(20.810808, -32.375823, 1798.0)
+        jd = 2458850.2 + np.linspace(0, 0.6, 300)
+        ephem = Ephemeris("05 35 17.3", "-05 00 00", loc)
+        exact = ephem.exact(jd)[:, 2]
+        low = (exact >= 1) & (exact <= 3)
+        self.assertGreater(np.max(exact[low]), 2.8)
+        error = np.abs(ephem.airmass(jd) - exact)[low]
+        self.assertLess(np.max(error), 1e-4)
+
+
+class TestFieldCat(unittest.TestCase):
+
+    def test_match_offset(self):
+        '''Test that a shifted field is matched to its catalogue when some
+        sources are missing and others are new.'''
+        rng = np.random.RandomState(1)
+        ref = rng.uniform(0, 500, (25, 2))
+        det = np.concatenate([ref[5:] - [12.3, -40.1], rng.uniform(0, 500,
+            (4, 2))])
+        offset = match_offset(det, ref)
+        self.assertAlmostEqual(offset[0], 12.3)
+        self.assertAlmostEqual(offset[1], -40.1)
+        self.assertIsNone(match_offset(rng.uniform(0, 500, (10, 2)), ref,
+            tol=0.5))
+        self.assertIsNone(match_offset(ref[:3] - [12.3, -40.1], ref))
+
+    def test_catalogue_groups(self):
+        '''Test that the objects of a field not matching the catalogue are
+        added as a new group with new IDs and that both groups are matched by
+        later runs.'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        first = fitsio.read(write_run(tmp, 1)[0])
+        other = np.ascontiguousarray(np.rot90(first))
+        cat_file = tmp + '/cat/TEST_cat.fits'
+        ids = [build_obj_cat(tmp, '', 'TEST', frame, 7.0, 32, 3, 0., 5, 6.,
+            cat_file)[2] for frame in [first, other, first, other]]
+        cat = load_catalogue(cat_file)
+        np.testing.assert_array_equal(cat['GROUP'], [0] * 5 + [1] * 5)
+        np.testing.assert_array_equal(ids[0], np.arange(5))
+        np.testing.assert_array_equal(ids[1], np.arange(5, 10))
+        np.testing.assert_array_equal(ids[2], ids[0])
+        np.testing.assert_array_equal(ids[3], ids[1])
+
+
+class TestGate(unittest.TestCase):
+
+    def test_gate_flags(self):
+        '''Test that a shifted good frame passes the frame gate while
+        cloudy and bright sky frames are flagged.'''
+        xs = np.array([30.0, 80.0, 150.0, 60.0, 170.0])
+        ys = np.array([40.0, 150.0, 60.0, 90.0, 170.0])
+        frame = TestTracker().frame
+        gate = FrameGate(frame(xs, ys), 10.0, xs, ys)
+        good = frame(xs + 2.0, ys - 1.0)
+        self.assertEqual(gate.check(good, -2.0, 1.0, 10.0), 0)
+        self.assertEqual(gate.check(good, -2.0, 1.0, 40.0), GATE_FLUX)
+        self.assertEqual(gate.check(good * 4.0, -2.0, 1.0, 10.0), GATE_SKY)
+
+
+class TestEnsemble(unittest.TestCase):
+
+    def test_leave_one_out(self):
+        '''Test that the ensemble leaving out one comparison, found by
+        subtraction, matches the ensemble of the other comparisons.'''
+        rng = np.random.RandomState(2)
+        flux = rng.uniform(100, 1000, (3, 6, 2, 20))
+        err = rng.uniform(1, 10, (3, 6, 2, 20))
+        flux[1, 2, 0, 4] = np.nan
+        ens = CompEnsemble(flux, err, [0, 2, 3, 5])
+        for obj, others in [(2, [0, 3, 5]), (5, [0, 2, 3])]:
+            expect = CompEnsemble(flux, err, others).ensemble()
+            for a, b in zip(ens.others(obj), expect):
+                np.testing.assert_allclose(a, b, rtol=1e-5)
+
+
+class TestStats(unittest.TestCase):
+
+    def test_welford(self):
+        '''Test that running flux statistics built frame by frame, skipping
+        missing values, match the statistics of the whole array.'''
+        rng = np.random.RandomState(3)
+        flux = rng.normal(1000, 30, (4, 5, 50))
+        flux[rng.uniform(size=flux.shape) < 0.2] = np.nan
+        n, mean, m2 = np.zeros((3, 4, 5))
+        for k in range(flux.shape[-1]):
+            welford_update(n, mean, m2, flux[:, :, k])
+        stats = flux_stats(n, mean, m2)
+        np.testing.assert_array_equal(stats[0], np.sum(np.isfinite(flux), -1))
+        np.testing.assert_allclose(stats[1], np.nanmean(flux, -1))
+        np.testing.assert_allclose(stats[2], np.nanstd(flux, -1, ddof=1))
+
+
+class TestBkgSearch(unittest.TestCase):
+
+    def test_select_bkg_params(self):
+        '''Test that the bkg params with the lowest residual flux are kept,
+        that frames missing for every combination are ignored and that
+        combinations missing on other frames are not kept.'''
+        rng = np.random.RandomState(4)
+        bkg_flux = rng.uniform(0, 1, (6, 5, 10)) + np.array([3., 0., 4.,
+            2., 1.])[None, :, None]
+        bkg_flux[:, :, 7] = np.nan
+        np.testing.assert_array_equal(select_bkg_params(bkg_flux, 2),
+                [False, True, False, False, True])
+        bkg_flux[:, 1, 3] = np.nan
+        np.testing.assert_array_equal(select_bkg_params(bkg_flux, 2),
+                [False, False, False, True, True])
+        bkg_flux[:, 4, :] = np.nan
+        np.testing.assert_array_equal(select_bkg_params(bkg_flux, 5),
+                [True] * 5)
+
+
+def write_run(dir_, nframes=8):
+    '''Write reduced frames of a drifting field with bright and faint
+    stars to dir_. Returns the frame files.'''
+    rng = np.random.RandomState(6)
+    stars = [(30., 40., 2e4), (90., 30., 3e4), (60., 80., 1.5e4),
+            (25., 95., 1.5e3), (95., 90., 1.5e3), (70., 50., 8e3)]
+    yy, xx = np.mgrid[0:120, 0:120]
+    files = []
+    for k in range(nframes):
+        im = np.full((120, 120), 100.)
+        for x, y, flux in stars:
+            im += flux / (2*np.pi*1.5**2) * np.exp(-((xx - x - 0.2*k)**2 +
+                (yy - y + 0.1*k)**2) / (2*1.5**2))
+        header = {'OBJECT':'TEST', 'EXPOSURE':2.0, 'JD':2458654.5 + k/43200.,
+                'HJD':2458654.5 + k/43200., 'BJD':2458654.5 + k/43200.,
+                'AIRMASS':1.2, 'OBJRA':'10:00:00', 'OBJDEC':'-30:00:00',
+                'OBJEPOCH':'2000', 'OBJEQUIN':'2000', 'HBIN':1, 'VBIN':1,
+                'PREAMP':2.4, 'GPSSTART':'2019-06-19T12:00:00.0',
+                'OBSERVER':'X', 'TELESCOP':'1.0m', 'INSTRUME':'SHOC',
+                'FILTERA':'V', 'FILTERB':'Empty'}
+        files.append('%s/TEST.%04d.fits' % (dir_, k + 1))
+        fitsio.write(files[-1], rng.poisson(im).astype(float),
+                header=header, clobber=True)
+    return files
+
+def run_params(dir_):
+    #Small photometry parameters for runs on write_run frames
+    p = get_params()
+    p.out_dir = dir_
+    p.radii = [2.0, 3.0, 4.0]
+    p.box_size = [16, 32]
+    p.filter_size = [1, 3]
+    p.num_bkg_apps = 20
+    p.checkpoint_every = None
+    return p
+
+class TestPhotRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.files = write_run(self.tmp)
+        self.p = run_params(self.tmp)
+
+    def read(self, label=''):
+        #Photometry file of the run as a dict of arrays
+        name = 'SAAO_TEST_phot%s.fits' % ('' if label == '' else '_' + label)
+        with fitsio.FITS(self.tmp + '/photometry/' + name) as f:
+            return dict((hdu.get_extname(), hdu.read()) for hdu in f if
+                    hdu.has_data())
+
+    def test_param_sets(self):
+        '''Test that extra parameter sets share the catalogue and bkg
+        apertures of the default set unless they change detection.'''
+        self.p.param_sets = {'wide':{'RADII':[5.0, 6.0]},
+                'deep':{'SOURCE_THRESH':20.0}}
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        base, wide, deep = self.read(), self.read('wide'), self.read('deep')
+        self.assertEqual(base['OBJ_FLUX'].shape, (3, 5, 4, 8))
+        self.assertEqual(wide['OBJ_FLUX'].shape, (2, 5, 4, 8))
+        for key in ['OBJ_ID', 'BKG_APP_X', 'BKG_APP_Y', 'OBJ_CCD_X']:
+            np.testing.assert_array_equal(wide[key], base[key])
+        np.testing.assert_array_equal(wide['RESIDUAL_BKG_FLUX'],
+                base['RESIDUAL_BKG_FLUX'])
+        self.assertEqual(len(deep['OBJ_ID']), 4)
+        self.assertFalse(np.array_equal(deep['BKG_APP_X'], base['BKG_APP_X']))
+
+    def test_resume(self):
+        '''Test that a run interrupted after a checkpoint resumes to the same
+        results as an uninterrupted run, and that a checkpoint made with other
+        params is not used.'''
+        self.p.tracker = "centroid"
+        self.p.bkg_search = "adaptive"
+        self.p.bkg_search_frames = 3
+        self.p.bkg_search_keep = 2
+        self.p.checkpoint_every = 2
+        self.p.prefetch_depth = 0
+        checkpoint = self.tmp + '/photometry/SAAO_TEST_checkpoint'
+        random.seed(7)
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        expect = self.read()
+        self.assertEqual(glob(checkpoint + '*'), [])
+
+        remove(self.tmp + '/photometry/SAAO_TEST_phot.fits')
+        random.seed(7)
+        with self.assertRaises(RuntimeError):
+            run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                    frames=FailingFrames(self.files, 2))
+        self.assertEqual(sorted(glob(checkpoint + '*')), [checkpoint +
+            '.npz', checkpoint + '_0001.npz', checkpoint + '_0002.npz'])
+        for n in [1, 2]:
+            with np.load(checkpoint + '_%04d.npz' % n) as f:
+                self.assertEqual(f['set0_flux_store'].shape[-1], 2)
+        random.seed(8)
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        result = self.read()
+        for key in expect:
+            np.testing.assert_array_equal(result[key], expect[key], key)
+        self.assertEqual(glob(checkpoint + '*'), [])
+
+        remove(self.tmp + '/photometry/SAAO_TEST_phot.fits')
+        with self.assertRaises(RuntimeError):
+            run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                    frames=FailingFrames(self.files, 5))
+        self.p.radii = [2.0, 3.0]
+        with self.assertRaises(RuntimeError):
+            run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                    frames=FailingFrames(self.files, 3))
+        self.assertEqual(glob(checkpoint + '*'), [])
+
+    def test_stamp_mode(self):
+        '''Test that fluxes measured on postage stamps agree with those
+        measured on the full frames.'''
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        full = self.read()
+        remove(self.tmp + '/photometry/SAAO_TEST_phot.fits')
+        self.p.phot_mode = "stamp"
+        self.p.stamp_size = 32
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        stamp = self.read()
+        np.testing.assert_array_equal(stamp['OBJ_ID'], full['OBJ_ID'])
+        np.testing.assert_allclose(stamp['OBJ_CCD_X'], full['OBJ_CCD_X'],
+                atol=0.05)
+        diff = np.abs(stamp['OBJ_FLUX'] - full['OBJ_FLUX'])
+        self.assertTrue(np.all(diff < 2 * full['OBJ_FLUX_ERR']))
+        bright = full['OBJ_FLUX'] > 5000.
+        np.testing.assert_allclose(stamp['OBJ_FLUX'][bright],
+                full['OBJ_FLUX'][bright], rtol=0.01)
+
+    def test_tracker_order(self):
+        '''Test that the centroid tracker is only fed frames in order, the
+        sample frames of an adaptive bkg search being registered by Donuts.'''
+        self.p.tracker = "centroid"
+        self.p.bkg_search = "adaptive"
+        self.p.bkg_search_frames = 3
+        self.p.bkg_search_keep = 2
+        seen = []
+        update = CentroidTracker.update
+        def record(tracker, index, shift_x, shift_y):
+            seen.append(index)
+            update(tracker, index, shift_x, shift_y)
+        CentroidTracker.update = record
+        self.addCleanup(setattr, CentroidTracker, 'update', update)
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        self.assertEqual(seen, [0, 1, 2, 4, 5, 6])
+
+    def test_retest(self):
+        '''Test that a re-test of the full bkg grid after a change of sky
+        level replaces the bkg params kept, rather than adding to them.'''
+        for k, file_ in enumerate(self.files):
+            data, header = fitsio.read(file_, header=True)
+            data += [0., 0., 0., 0., 150., 150., 450., 450.][k]
+            fitsio.write(file_, data, header=header, clobber=True)
+        self.p.tracker = "centroid"
+        self.p.bkg_search = "adaptive"
+        self.p.bkg_search_frames = 3
+        self.p.bkg_search_keep = 1
+        self.p.bkg_search_retest = 0.5
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        ncombos = np.sum(np.isfinite(self.read()['OBJ_FLUX'][0, 0]), axis=0)
+        np.testing.assert_array_equal(ncombos, [4, 1, 1, 4, 4, 1, 4, 4])
+
+    def test_rephot(self):
+        '''Test that re-measuring some objects on some frames with a new
+        radius only changes those objects and frames, keeps the earlier
+        values at the common radii and keeps the bkg residuals of stamps
+        which were not measured, also for bkg params which an adaptive
+        search leaves out.'''
+        self.p.phot_mode = "stamp"
+        self.p.stamp_size = 32
+        self.p.tracker = "centroid"
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files))
+        old = self.read()
+        self.assertTrue(np.all(np.isfinite(old['OBJ_FLUX'])))
+        self.p.bkg_search = "adaptive"
+        self.p.bkg_search_frames = 3
+        self.p.bkg_search_keep = 2
+        path = self.tmp + '/photometry/SAAO_TEST_phot.fits'
+        self.assertEqual(len(old['BKG_APP_K']), 20)
+
+        ids = list(old['OBJ_ID'][[1, 3]])
+        self.p.rephot_objects = ids
+        self.p.rephot_time_range = [float(old['JD'][2]), float(old['JD'][5])]
+        self.p.radii = [2.0, 3.0, 5.0]
+        objects, index, frame_hdus = rephot_objects(path, self.p,
+                np.zeros((120, 120)))
+        np.testing.assert_array_equal(index, [1, 3])
+        np.testing.assert_array_equal(objects[2], ids)
+        np.testing.assert_array_equal(objects[5], [{1:0, 3:1}.get(k, -1) for
+            k in old['BKG_APP_K']])
+
+        run_phot(self.tmp, 'TEST', self.p, 'TEST',
+                frames=ReducedFrames(self.files), rephot=True)
+        new = self.read()
+        np.testing.assert_array_equal(new['VARIABLES_APERTURE_RADII'],
+                [2.0, 3.0, 4.0, 5.0])
+        np.testing.assert_array_equal(new['BKG_APP_K'], old['BKG_APP_K'])
+        measured = np.zeros((5, 4, 8), dtype=bool)
+        measured[np.ix_([1, 3], range(4), range(2, 6))] = True
+        flux, old_flux = new['OBJ_FLUX'], old['OBJ_FLUX']
+        np.testing.assert_array_equal(flux[:3][:, ~measured],
+                old_flux[:, ~measured])
+        both = measured & np.all(np.isfinite(flux[[0, 1]]) & np.isfinite(
+            old_flux[[0, 1]]), axis=0)
+        self.assertTrue(np.any(both))
+        np.testing.assert_array_equal(flux[[0, 1]][:, both],
+                old_flux[[0, 1]][:, both])
+        self.assertTrue(np.all(np.isnan(flux[3][~measured])))
+
+        #Bkg params left out after the sample keep their earlier values
+        self.assertTrue(np.all(np.isfinite(flux[:3])))
+
+        #The full bkg grid is sampled on frames within the time range
+        sampled = flux[[0, 1, 3]][:, [1, 3]][..., [2, 3, 5]]
+        self.assertTrue(np.all(np.isfinite(sampled)))
+        kept = ~np.isin(old['BKG_APP_K'], [1, 3])
+        np.testing.assert_array_equal(new['RESIDUAL_BKG_FLUX'][kept],
+                old['RESIDUAL_BKG_FLUX'][kept])
+
+
+class FailingFrames(ReducedFrames):
+    #Reduced frames which fail on reading frame fail, as if interrupted
+    def __init__(self, f_list, fail):
+        ReducedFrames.__init__(self, f_list)
+        self.fail = fail
+    def read(self, idx, out=None):
+        if idx == self.fail:
+            raise RuntimeError("interrupted")
+        return ReducedFrames.read(self, idx, out)
+
+class TestBinning(unittest.TestCase):
+
+    def test_windows(self):
+        '''Test that points are binned in time windows across a change of
+        exposure time, leaving out masked and missing points, and that
+        weighted means and errors are propagated.'''
+        t = np.concatenate([np.arange(6) * 2., 12. + np.arange(4) * 5.])
+        flux = np.arange(10, dtype=float)
+        flux[3] = np.nan
+        mask = np.ones(10, dtype=bool)
+        mask[8] = False
+        binned, counts = bin_series(t / 86400., [t, flux], 10, mask=mask)
+        np.testing.assert_array_equal(counts, [[5, 3, 1], [4, 3, 1]])
+        np.testing.assert_allclose(binned[1], [1.75, 6., 9.])
+        binned, counts, err = bin_series(t / 86400., flux, 10,
+                weights=[1, 1, 1, 1, 2] + [1]*5, errors=np.ones(10))
+        np.testing.assert_allclose(binned[0, 0], 11. / 5)
+        np.testing.assert_allclose(err[0, 0], np.sqrt(7.) / 5)
+
+
+class TestDetrend(unittest.TestCase):
+
+    def test_batched_fit(self):
+        '''Test that systematics depending on the bkg params are removed
+        from every light curve, including curves with missing frames, and
+        that frames outside the fit mask do not change the fit.'''
+        rng = np.random.RandomState(5)
+        t = np.linspace(0, 0.1, 200)
+        airmass = 1.2 + 3 * (t - 0.04)**2
+        fwhm = rng.normal(2, 0.2, (3, 200))
+        flux = np.ones((4, 3, 200))
+        flux *= 1 + 0.05 * (airmass - 1.2) + 0.01 * (fwhm - 2)
+        flux[1, 2, 10:20] = np.nan
+        fit_mask = np.ones(200, dtype=bool)
+        fit_mask[80:120] = False
+        flux[:, :, 80:120] *= 0.98
+        detrender = Detrender(t, [airmass, fwhm], fit_mask, order=1)
+        detrended, err = detrender.apply(flux, np.full(flux.shape, 1e-3))
+        finite = np.isfinite(flux)
+        np.testing.assert_allclose(detrended[:, :, fit_mask][finite[:, :,
+            fit_mask]], 1, atol=2e-3)
+        np.testing.assert_allclose(detrended[:, :, 80:120], 0.98, atol=2e-3)
+
+
+class TestCompSelect(unittest.TestCase):
+
+    def test_select(self):
+        '''Test that comparisons sharing the target's systematics are
+        chosen and a variable object is left out.'''
+        rng = np.random.RandomState(7)
+        nobj, nframes = 8, 400
+        trend = 1 + 0.05 * np.sin(np.linspace(0, 3, nframes))
+        level = np.linspace(1e4, 5e4, nobj)[:, None]
+        noise = np.full((nobj, 1), 0.002)
+        noise[5] = 0.05
+        flux = level * trend * (1 + noise * rng.normal(size=(nobj, nframes)))
+        flux[3] *= 1 + 0.2 * np.sin(np.linspace(0, 40, nframes))
+        flux = flux[None, :, None, :]
+        f = {'OBJ_FLUX': flux, 'OBJ_FLUX_ERR': np.sqrt(flux)}
+        chosen = select_comparisons(f, 0, 0, np.ones(nframes, dtype=bool), 4)
+        self.assertTrue(0 < len(chosen) <= 4)
+        self.assertNotIn(0, chosen)
+        self.assertNotIn(3, chosen)
+        self.assertNotIn(5, chosen)
+
+
+class TestPlot(unittest.TestCase):
+
+    def test_pages(self):
+        '''Test that plot contexts are independent, panels being split
+        into pages, and that the most common exposure time is found.'''
+        p = get_params()
+        info = {'TARGET': 'T', 'OBSERVAT': 'SAAO', 'TELESCOP': '1.0m',
+                'FILTERA': 'V', 'FILTERB': 'Clear', 'DATE-OBS': '2020-01-01'}
+        n = p.nrows * p.ncols + 1
+        ctx_a = PlotContext(p, info, n)
+        ctx_b = PlotContext(p, info, 1)
+        for k in range(n):
+            ctx_a.add_plot(np.arange(10.), np.ones(10), inc=True)
+        ctx_b.add_plot(np.arange(10.), np.ones(10), inc=True)
+        self.assertEqual((len(ctx_a.figs), len(ctx_b.figs)), (2, 1))
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp:
+            ctx_a.save(tmp.name)
+        self.assertEqual(ctx_a.figs, [])
+        self.assertEqual(mode_exposure(np.array([2., 5., 5., 2., 5.])), 5.)
+
+    def test_stream(self):
+        '''Test that pages, including density plots of dense series, are
+        written to the PDF as they are finished and freed.'''
+        p = get_params()
+        p.plot_density_points = 50
+        info = {'TARGET': 'T', 'OBSERVAT': 'SAAO', 'TELESCOP': '1.0m',
+                'FILTERA': 'V', 'FILTERB': 'Clear', 'DATE-OBS': '2020-01-01'}
+        n = 2 * p.nrows * p.ncols
+        open_figs = plt.get_fignums()
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp:
+            ctx = PlotContext(p, info, n, pdf_file=tmp.name)
+            for k in range(n):
+                ctx.add_plot(np.arange(100.), np.ones(100), inc=True,
+                        plot_rms=True)
+                self.assertEqual(ctx.figs, [])
+            ctx.close()
+        self.assertEqual(ctx.pages, 2)
+        self.assertEqual(plt.get_fignums(), open_figs)
+
+    def test_targets(self):
+        '''Test that several photometry files are only plotted with object
+        numbers given for each target, and that each target gets its own.'''
+        d = dict((k.upper(), v) for k, v in vars(get_params()).items())
+        d["TARGET_OBJECT_NUM"] = {"A":3, "B":"4"}
+        with self.assertRaises(KeyValueError):
+            Validator(d)
+        d["TARGET_OBJECT_NUM"] = {"A":3, "B":4}
+        d["COMPARISON_OBJECT_NUMS"] = {"A":[0, 1]}
+        p = Validator(d)
+        self.assertEqual(p.object_nums("A"), (3, [0, 1]))
+        with self.assertRaises(AssertionError):
+            p.object_nums("B")
+        p.auto_comparisons = 2
+        self.assertEqual(p.object_nums("B"), (4, []))
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for name in ["A", "B"]:
+            open('%s/%s_phot.fits' % (tmp, name), 'w').close()
+            open('%s/%s_field.png' % (tmp, name), 'w').close()
+        self.assertEqual(len(find_targets(tmp, p)), 2)
+        p.target_object_num = 3
+        with self.assertRaises(AssertionError):
+            find_targets(tmp, p)
+
+
+class TestExport(unittest.TestCase):
+
+    def test_columnar(self):
+        '''Test that the light curves of a run are written to one table,
+        each with its own columns and parameters, and read back.'''
+        n = 20
+        base = Table([np.linspace(0, 1, n)] * 3 + [np.ones(n, 'f4')] * 3 +
+                [np.arange(n, dtype=float)] * 5, names=('JD_UTC', 'HJD_UTC',
+                    'BJD_TDB', 'RELATIVE_FLUX', 'FLUX_ERROR', 'BACKGROUND_FLUX',
+                    'CCD_X', 'CCD_Y', 'SEEING_ARCSECONDS',
+                    'EXPOSURE_TIME_SECONDS', 'AIRMASS'))
+        base.meta['TARGET'] = 'T'
+        lcs = None
+        for k, name in enumerate(['ensemble', 3, 7]):
+            table = update_table(base, {'RELATIVE_FLUX': np.full(n, k, 'f4')})
+            table.meta['APPRADUS'] = 2. + k
+            table.meta['BKGPARAM'] = '64,2'
+            if lcs is None:
+                lcs = LightCurveSet(table)
+            lcs.add(name, table)
+        with tempfile.NamedTemporaryFile(suffix='.fits') as tmp:
+            lcs.write(tmp.name, "table")
+            cols, meta = read_lightcurves(tmp.name)
+        np.testing.assert_array_equal(cols['RELATIVE_FLUX_C7'], 2)
+        np.testing.assert_array_equal(cols['RELATIVE_FLUX_ENSEMBLE'], 0)
+        np.testing.assert_array_equal(base['RELATIVE_FLUX'], 1)
+        self.assertEqual(cols['RELATIVE_FLUX_C3'].dtype.kind, 'f')
+        self.assertEqual(cols['RELATIVE_FLUX_C3'].dtype.itemsize, 4)
+        self.assertEqual((meta['TARGET'], meta['APPRADUS_C3'],
+            meta['BKGPARAM_C3']), ('T', 3., '64,2'))
+
+    @unittest.skipUnless(lcexport.pa is not None, "pyarrow is not installed")
+    def test_arrow(self):
+        '''Test that light curves written to an Arrow file are read back
+        with their types and metadata.'''
+        n = 20
+        base = Table([np.linspace(0, 1, n)] * 3 + [np.ones(n, 'f4')] * 3 +
+                [np.arange(n, dtype=float)] * 5, names=('JD_UTC', 'HJD_UTC',
+                    'BJD_TDB', 'RELATIVE_FLUX', 'FLUX_ERROR', 'BACKGROUND_FLUX',
+                    'CCD_X', 'CCD_Y', 'SEEING_ARCSECONDS',
+                    'EXPOSURE_TIME_SECONDS', 'AIRMASS'))
+        base.meta['TARGET'] = 'T'
+        base.meta['APPRADUS'] = 2.5
+        base.meta['BKGPARAM'] = '64,2'
+        lcs = LightCurveSet(base)
+        lcs.add('ensemble', base)
+        lcs.add(3, update_table(base, {'RELATIVE_FLUX': np.full(n, 2, 'f4')}))
+        with tempfile.NamedTemporaryFile(suffix='.arrow') as tmp:
+            lcs.write(tmp.name, "arrow")
+            cols, meta = read_lightcurves(tmp.name)
+            np.testing.assert_array_equal(cols['RELATIVE_FLUX_C3'], 2)
+            np.testing.assert_array_equal(cols['JD_UTC'], base['JD_UTC'])
+            self.assertEqual(cols['RELATIVE_FLUX_C3'].dtype, np.float32)
+        self.assertEqual((meta['TARGET'], meta['BKGPARAM_ENSEMBLE']),
+                ('T', '64,2'))
+
+    @unittest.skipIf(lcexport.pa is not None, "pyarrow is installed")
+    def test_arrow_missing(self):
+        '''Test that the Arrow format is refused before plotting without
+        pyarrow.'''
+        p = get_params()
+        p.lc_format = "arrow"
+        with self.assertRaises(AssertionError):
+            plot_photometry('missing_phot.fits', 'missing_field.png', p)
+
+
+class TestPhotFile(unittest.TestCase):
+
+    def test_lazy_slices(self):
+        '''Test that lazily read slices of a photometry HDU, including lists
+        of objects, match the same slices of the full array.'''
+        flux = np.arange(4*6*3*5, dtype=float).reshape(4, 6, 3, 5)
+        with tempfile.NamedTemporaryFile(suffix='.fits') as tmp:
+            fitsio.write(tmp.name, flux, extname='OBJ_FLUX', clobber=True)
+            with PhotFile(tmp.name) as f:
+                lazy = f['OBJ_FLUX']
+                np.testing.assert_array_equal(lazy[:, [3, 0, 5]],
+                        flux[:, [3, 0, 5]])
+                np.testing.assert_array_equal(lazy[2, [4, 1], 1, 1:4],
+                        flux[2, [4, 1], 1, 1:4])
+                np.testing.assert_array_equal(lazy[-1, 2], flux[-1, 2])
+
+
+class TestConvert(unittest.TestCase):
+
+    def test_convert_file(self):
+        '''Test that tables are converted chunk by chunk with exact floats,
+        quoted text and one column per element of vector columns, and that
+        up to date files are skipped.'''
+        data = np.zeros(3, dtype=[('JD', 'f8'), ('N', 'i4'), ('NAME', 'S8'),
+            ('POS', 'f4', (2,))])
+        data['JD'] = [2458000.123456789, 1.5, np.nan]
+        data['N'] = [1, 2, 3]
+        data['NAME'] = ['WASP 1', 'C2', '']
+        data['POS'] = [[1.25, 2.], [3., 4.], [5., 6.]]
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        fitsio.write(tmp + '/lc_comp.fits', data)
+        self.assertTrue(convert_file((tmp + '/lc_comp.fits', 2, False)))
+        with open(tmp + '/lc_comp.dat') as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines, ['JD N NAME POS_0 POS_1',
+            '2458000.1234567892 1 "WASP 1" 1.25 2', '1.5 2 "C2" 3 4',
+            'nan 3 "" 5 6'])
+        self.assertEqual(float(lines[1].split()[0]), data['JD'][0])
+        self.assertFalse(convert_file((tmp + '/lc_comp.fits', 2, False)))
+
+        fitsio.write(tmp + '/cx_comp.fits', np.zeros(2, dtype=[('Z', 'c16')]))
+        with self.assertRaises(AssertionError):
+            convert_file((tmp + '/cx_comp.fits', 2, False))
+
 
 if __name__ == "__main__":
 
@@ -1,35 +1,130 @@
 #!/usr/bin/python
 import numpy as np
 import argparse
+import os
 
 from fitsio import FITS
-from astropy.table import Table
-from glob import glob
-from os.path import join
+from fnmatch import fnmatch
+from itertools import chain
+from multiprocessing import Pool, cpu_count
+from os.path import join, getmtime, isfile
 
-''' Script to convert FITS table files into ASCII .dat files '''
+''' Script to convert FITS table files into ASCII .dat files.
+
+Every input directory is searched, with its subdirectories if requested, for
+tables matching the pattern, and the tables are converted in a pool of worker
+processes. Rows are read and written a chunk at a time with a fixed format
+for each column, so memory use does not depend on the length of the table.
+Text columns are quoted and vector columns are written as one column per
+element, named with the element index. Tables whose .dat file is already
+newer than the table are skipped. '''
+
+#Output format of each column by kind and size of its type, floats with
+#enough digits to be read back exactly
+FORMATS = {('f', 4): '%.9g', ('f', 8): '%.17g', ('i', 1): '%d', ('i', 2): '%d',
+        ('i', 4): '%d', ('i', 8): '%d', ('u', 1): '%d', ('u', 2): '%d',
+        ('u', 4): '%d', ('u', 8): '%d', ('b', 1): '%d'}
+
+def find_tables(dirs, pattern, recursive=False):
+    #Tables matching pattern in dirs and, if recursive, their subdirectories
+    file_list = []
+    for dir_ in dirs:
+        for root, subdirs, files in os.walk(dir_):
+            file_list += [join(root, name) for name in sorted(files) if
+                    fnmatch(name, pattern)]
+            if not recursive:
+                break
+    return file_list
+
+def column_formats(dtype):
+    #Output names and fixed formats of the columns, one per element of
+    #vector columns, and text quoted
+    names, fmt = [], []
+    for name in dtype.names:
+        base, shape = dtype[name].base, dtype[name].shape
+        if base.kind in 'SU':
+            f = '"%s"'
+        else:
+            f = FORMATS.get((base.kind, base.itemsize))
+            assert f is not None, "Column %s of type %s cannot be converted" \
+                    % (name, base)
+        if shape == ():
+            names.append(name)
+        else:
+            names += ['%s_%d' % (name, k) for k in range(int(np.prod(shape)))]
+        fmt += [f] * max(1, int(np.prod(shape)))
+    return names, fmt
+
+def format_rows(rows, fmt):
+    #Text of rows, formatted with one format string for the whole chunk
+    #applied once to the values of every column element in row order
+    columns = []
+    for name in rows.dtype.names:
+        data = rows[name].reshape(len(rows), -1)
+        if data.dtype.kind == 'S':
+            data = np.char.decode(data, 'ascii')
+        columns += [data[:, k].tolist() for k in range(data.shape[1])]
+    lines = "\n".join([" ".join(fmt)] * len(rows)) + "\n"
+    return lines % tuple(chain.from_iterable(zip(*columns)))
+
+def convert_file(args):
+    '''Convert the FITS table file_ to an ASCII .dat file, chunk_rows rows at
+    a time, unless the .dat file is newer. Returns whether it was
+    converted.'''
+
+    file_, chunk_rows, force = args
+    out = file_.replace(".fits", ".dat")
+    if (not force) and isfile(out) and (getmtime(out) >= getmtime(file_)):
+        return False
+
+    # Write to a temporary file so that an interrupted conversion is redone
+    tmp = out + ".tmp"
+    with FITS(file_) as f:
+        hdu = f[1]
+        nrows = hdu.get_nrows()
+        dtype = hdu.get_rec_dtype()[0]
+        names, fmt = column_formats(dtype)
+        with open(tmp, "w") as fh:
+            fh.write(" ".join(names) + "\n")
+            for start in range(0, nrows, chunk_rows):
+                fh.write(format_rows(hdu[start:min(start + chunk_rows,
+                    nrows)], fmt))
+    os.rename(tmp, out)
+
+    return True
 
 if __name__ == "__main__":
 
     #Parse arguments from command line
     parser = argparse.ArgumentParser(
         description='FITS to ASCII .dat file converter')
-    parser.add_argument('dir_in', metavar='dir_in', help='Input directory',
-            type=str, action='store')
+    parser.add_argument('dir_in', metavar='dir_in', nargs='+',
+            help='Input directories', type=str, action='store')
+    parser.add_argument('-r', '--recursive', action='store_true',
+            help='Also convert files in subdirectories, e.g. of many nights')
+    parser.add_argument('-p', '--pattern', type=str, default="*_comp*.fits",
+            help='Pattern of the file names to convert')
+    parser.add_argument('-n', '--processes', type=int, default=cpu_count(),
+            help='Number of worker processes')
+    parser.add_argument('-c', '--chunk', type=int, default=100000,
+            help='Number of rows converted at a time')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='Convert files even if their output is up to date')
     args = parser.parse_args()
 
     # Get fits files to convert
-    file_list = glob(join(args.dir_in, "*_comp*.fits"))
-
-    # Iterate over files
-    for file_ in file_list:
-
-        # Read fits data
-        with FITS(file_) as f:
-            data = f[1].read()
+    file_list = find_tables(args.dir_in, args.pattern, args.recursive)
+    jobs = [(file_, args.chunk, args.force) for file_ in file_list]
 
-        # Covert data to Table
-        t = Table(data)
+    # Convert files in a pool of worker processes
+    if (args.processes > 1) and (len(jobs) > 1):
+        pool = Pool(min(args.processes, len(jobs)))
+        converted = pool.map(convert_file, jobs, chunksize=max(1,
+            len(jobs) // (4 * args.processes)))
+        pool.close()
+        pool.join()
+    else:
+        converted = [convert_file(job) for job in jobs]
 
-        # Write table data as ascii
-        t.write(file_.replace(".fits", ".dat"), format="ascii")
+    print("Converted %d of %d files, %d up to date." % (sum(converted),
+        len(jobs), len(jobs) - sum(converted)))